@@ -1,85 +1,334 @@
 #!/usr/bin/env python3
-"""Extract WAV file from NST corpus"""
-import subprocess
-import sys
+"""Extract WAV files from NST corpus"""
+import argparse
+import functools
+import logging
+import math
+import os
+import struct
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+_LOGGER = logging.getLogger("convert-da-wav")
+
+# Maximum number of bytes to search for end_head
+_MAX_HEADER_BYTES = 64 * 1024
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class NSTHeader:
+    """Details of raw PCM audio from an NST file header"""
+
+    sample_rate: int = 16000
+    sample_width: int = 2
+    num_channels: int = 2
+    data_offset: int = 0
 
 
 def main():
     """Main entry point"""
-    sample_rate = 16000
-    sample_width = 2
-    num_channels = 2
-    # text = ""
+    parser = argparse.ArgumentParser(prog="convert-da-wav.py")
+    parser.add_argument(
+        "inputs", nargs="+", help="NST audio files or directories with them"
+    )
+    parser.add_argument(
+        "--output-dir", required=True, help="Directory to write WAV files to"
+    )
+    parser.add_argument(
+        "--glob",
+        default="*.wav",
+        help="Pattern for NST files in input directories (default: *.wav)",
+    )
+    parser.add_argument(
+        "--prefix-dir",
+        action="store_true",
+        help="Prefix output file names with the name of their input directory",
+    )
+    parser.add_argument(
+        "--jobs", type=int, help="Number of files to convert in parallel"
+    )
+    parser.add_argument(
+        "--sample-rate",
+        type=int,
+        default=16000,
+        help="Sample rate of output WAV files (default: 16000)",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Convert files even if the output WAV file already exists",
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # output path -> input path
+    wav_sources: typing.Dict[Path, Path] = {}
+
+    for input_str in args.inputs:
+        input_path = Path(input_str)
+        if input_path.is_dir():
+            input_paths = sorted(input_path.rglob(args.glob))
+        else:
+            input_paths = [input_path]
+
+        for nst_path in input_paths:
+            wav_name = nst_path.name
+            if args.prefix_dir:
+                wav_name = f"{nst_path.parent.name}_{wav_name}"
+
+            wav_path = (output_dir / wav_name).with_suffix(".wav")
+            other_path = wav_sources.get(wav_path)
+            if (other_path is not None) and (other_path != nst_path):
+                # Same-named files from different directories
+                parser.error(
+                    f"{nst_path} and {other_path} would both be written to {wav_path}"
+                    + ("" if args.prefix_dir else " (try --prefix-dir)")
+                )
+
+            wav_sources[wav_path] = nst_path
+
+    # input path -> output path
+    todo: typing.Dict[Path, Path] = {}
+    num_skipped = 0
+
+    for wav_path, nst_path in wav_sources.items():
+        if (not args.overwrite) and wav_path.is_file():
+            # Already converted
+            num_skipped += 1
+            continue
+
+        todo[nst_path] = wav_path
+
+    _LOGGER.info("Converting %s file(s) (skipped %s)", len(todo), num_skipped)
+
+    num_failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for nst_path, error in zip(
+            todo.keys(),
+            executor.map(
+                functools.partial(_convert_safe, sample_rate=args.sample_rate),
+                todo.keys(),
+                todo.values(),
+                chunksize=64,
+            ),
+        ):
+            if error:
+                num_failed += 1
+                _LOGGER.warning("Failed to convert %s: %s", nst_path, error)
+
+    _LOGGER.info("Done (%s failed)", num_failed)
+
+
+# -----------------------------------------------------------------------------
+
 
-    input_path = sys.argv[1]
-    output_path = sys.argv[2]
+def read_header(nst_path: Path) -> NSTHeader:
+    """Parse NST text header and locate the start of the PCM data"""
+    header = NSTHeader()
 
-    input_file = open(input_path, "rb")
+    with open(nst_path, "rb") as nst_file:
+        head_bytes = nst_file.read(_MAX_HEADER_BYTES)
 
-    for line in input_file:
-        line = line.decode("cp1252").strip()
-        if line.lower() == "end_head":
-            break
+    end_index = head_bytes.lower().find(b"end_head")
+    if end_index < 0:
+        raise ValueError(f"No end_head in {nst_path}")
 
+    header_fields: typing.Dict[str, str] = {}
+    for line in head_bytes[:end_index].decode("cp1252").splitlines():
         try:
-            field_name, _, field_value = line.split(maxsplit=2)
-            # if field_name == "utterance_id":
-            #     text = field_value
-            if field_name == "sample_coding":
-                assert field_value == "pcm", field_value
-            elif field_name == "sample_byte_format":
-                assert field_value == "01", field_value
-            elif field_name == "sample_n_bytes":
-                sample_width = int(field_value)
+            field_name, _, field_value = line.strip().split(maxsplit=2)
+            header_fields[field_name] = field_value
+            if field_name == "sample_n_bytes":
+                header.sample_width = int(field_value)
             elif field_name == "sample_rate":
-                sample_rate = int(field_value)
+                header.sample_rate = int(field_value)
             elif field_name == "channel_count":
-                num_channels = int(field_value)
-        except Exception:
+                header.num_channels = int(field_value)
+        except ValueError:
             pass
 
-    # Skip blank lines
-    pcm_data = input_file.read()
-    data_start = 0
-    newline = ord("\n")
-    while pcm_data[data_start] == newline:
-        data_start += 1
+    # Only little-endian PCM is supported
+    for field_name, expected_value in [
+        ("sample_coding", "pcm"),
+        ("sample_byte_format", "01"),
+    ]:
+        field_value = header_fields.get(field_name, expected_value)
+        if field_value != expected_value:
+            raise ValueError(
+                f"Expected {field_name} {expected_value} in {nst_path}, got {field_value}"
+            )
 
-    pcm_data = pcm_data[data_start:]
+    # Skip end_head line and blank lines
+    data_offset = head_bytes.find(b"\n", end_index)
+    if data_offset < 0:
+        data_offset = len(head_bytes)
 
-    # Ensure we're on an even byte
-    if (len(pcm_data) % 2) != 0:
-        pcm_data = pcm_data[1:]
+    while (data_offset < len(head_bytes)) and (head_bytes[data_offset] == ord("\n")):
+        data_offset += 1
 
-    proc = subprocess.Popen(
+    # Ensure the data is a whole number of samples (an even byte for 16-bit)
+    data_size = nst_path.stat().st_size - data_offset
+    data_offset += data_size % header.sample_width
+
+    header.data_offset = data_offset
+
+    return header
+
+
+def convert_file(nst_path: Path, wav_path: Path, sample_rate: int = 16000):
+    """Convert a single NST file to a 16-bit mono WAV file"""
+    header = read_header(nst_path)
+
+    frame_size = header.sample_width * header.num_channels
+    num_frames = (nst_path.stat().st_size - header.data_offset) // frame_size
+
+    if num_frames > 0:
+        pcm = read_pcm(nst_path, header, num_frames)
+
+        # Downmix to mono and scale to 16-bit
+        scale = 2 ** (16 - (8 * header.sample_width))
+        audio = pcm.mean(axis=1, dtype=np.float32) * scale
+    else:
+        audio = np.zeros(0, dtype=np.float32)
+
+    if header.sample_rate != sample_rate:
+        audio = resample(audio, header.sample_rate, sample_rate)
+
+    samples = np.clip(np.round(audio), -32768, 32767).astype("<i2")
+
+    # Write to a temporary file first so interrupted conversions are redone
+    wav_tmp_path = wav_path.with_suffix(".wav.tmp")
+    write_wav(wav_tmp_path, samples, sample_rate)
+    os.replace(wav_tmp_path, wav_path)
+
+
+def read_pcm(nst_path: Path, header: NSTHeader, num_frames: int) -> np.ndarray:
+    """Memory-map little-endian PCM samples as a (frames x channels) array"""
+    if header.sample_width == 3:
+        # No 24-bit dtype in NumPy, so sign-extend each 3-byte sample to int32
+        pcm_bytes = np.memmap(
+            nst_path,
+            dtype=np.uint8,
+            mode="r",
+            offset=header.data_offset,
+            shape=(num_frames, header.num_channels, 3),
+        )
+
+        return (
+            pcm_bytes[:, :, 0].astype(np.int32)
+            | (pcm_bytes[:, :, 1].astype(np.int32) << 8)
+            | (pcm_bytes[:, :, 2].astype(np.int8).astype(np.int32) << 16)
+        )
+
+    return np.memmap(
+        nst_path,
+        dtype=f"<i{header.sample_width}",
+        mode="r",
+        offset=header.data_offset,
+        shape=(num_frames, header.num_channels),
+    )
+
+
+def _convert_safe(
+    nst_path: Path, wav_path: Path, sample_rate: int = 16000
+) -> typing.Optional[str]:
+    """Convert file and return an error message instead of raising"""
+    try:
+        convert_file(nst_path, wav_path, sample_rate=sample_rate)
+    except Exception as e:
+        return str(e)
+
+    return None
+
+
+# -----------------------------------------------------------------------------
+
+
+def resample(
+    audio: np.ndarray,
+    src_rate: int,
+    dst_rate: int,
+    taps_per_phase: int = 32,
+    block_size: int = 64 * 1024,
+) -> np.ndarray:
+    """Resample float audio with a windowed-sinc polyphase filter"""
+    rate_gcd = math.gcd(src_rate, dst_rate)
+    up, down = dst_rate // rate_gcd, src_rate // rate_gcd
+
+    # Low-pass filter at the lower of the two Nyquist frequencies
+    num_taps = taps_per_phase * up
+    cutoff = 1.0 / max(up, down)
+    delay = taps_per_phase // 2
+    t = np.arange(num_taps) - (delay * up)
+    fir = cutoff * np.sinc(cutoff * t) * np.kaiser(num_taps, 8.0) * up
+
+    # phase -> taps
+    phases = fir.reshape(taps_per_phase, up).T.astype(np.float32)
+
+    num_out = (len(audio) * up) // down
+    padded: np.ndarray = np.concatenate(
         [
-            "sox",
-            "-t",
-            "raw",
-            "-r",
-            str(sample_rate),
-            "-b",
-            str(8 * sample_width),
-            "-c",
-            str(num_channels),
-            "-e",
-            "signed-integer",
-            "-",
-            "-r",
-            "16000",
-            "-b",
-            "16",
-            "-c",
-            "1",
-            "-e",
-            "signed-integer",
-            "-t",
-            "wav",
-            output_path,
-        ],
-        stdin=subprocess.PIPE,
+            np.zeros(taps_per_phase, dtype=np.float32),
+            audio.astype(np.float32),
+            np.zeros(taps_per_phase, dtype=np.float32),
+        ]
     )
-    proc.communicate(input=pcm_data)
+
+    output = np.empty(num_out, dtype=np.float32)
+    tap_offsets = np.arange(taps_per_phase)
+
+    for block_start in range(0, num_out, block_size):
+        out_index = np.arange(block_start, min(num_out, block_start + block_size))
+        in_pos = out_index * down
+        phase = in_pos % up
+        base = (in_pos // up) + delay + taps_per_phase
+
+        # Input samples under each filter tap (output x taps)
+        window = padded[base[:, None] - tap_offsets[None, :]]
+        output[out_index] = np.einsum("ij,ij->i", window, phases[phase])
+
+    return output
+
+
+def write_wav(wav_path: Path, samples: np.ndarray, sample_rate: int):
+    """Write 16-bit mono samples to a WAV file"""
+    data_size = samples.size * 2
+    with open(wav_path, "wb") as wav_file:
+        wav_file.write(
+            struct.pack(
+                "<4sI4s4sIHHIIHH4sI",
+                b"RIFF",
+                36 + data_size,
+                b"WAVE",
+                b"fmt ",
+                16,
+                1,  # PCM
+                1,  # mono
+                sample_rate,
+                sample_rate * 2,
+                2,
+                16,
+                b"data",
+                data_size,
+            )
+        )
+        wav_file.write(np.ascontiguousarray(samples, dtype="<i2").data)
 
 
 # -----------------------------------------------------------------------------
@@ -17,6 +17,6 @@ find "${this_dir}" -mindepth 1 -maxdepth 1 -type d | \
 
 
         # Convert WAV files
-        # find "${dir_path}" -name '*.wav' -type f | \
-        #     parallel "${this_dir}/convert-da-wav.py" {} "${this_dir}/${dir_name}_{/}"
+        # "${this_dir}/convert-da-wav.py" --prefix-dir \
+        #     --output-dir "${this_dir}" "${dir_path}"
     done
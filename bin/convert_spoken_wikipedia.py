@@ -1,72 +1,259 @@
 #!/usr/bin/env python3
 """Extract audio from Spoken Wikipedia"""
+import argparse
 import csv
+import logging
+import os
+import struct
+import subprocess
+import sys
+import typing
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-from pydub import AudioSegment
+import numpy as np
 
-_DIR = Path(".").absolute()
+_LOGGER = logging.getLogger("convert_spoken_wikipedia")
+
+# -----------------------------------------------------------------------------
 
 
 def main():
     """Main entry point"""
-    metadata_path = _DIR / "metadata.csv"
-    with open(metadata_path, "w") as metadata_file:
-        metadata_writer = csv.writer(metadata_file, delimiter="|")
+    parser = argparse.ArgumentParser(prog="convert_spoken_wikipedia.py")
+    parser.add_argument(
+        "article_dirs",
+        nargs="*",
+        default=["."],
+        help="Article directories with aligned.swc and audio.ogg (default: .)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, help="Number of articles to convert in parallel"
+    )
+    parser.add_argument(
+        "--sample-rate",
+        type=int,
+        default=16000,
+        help="Sample rate of output audio (default: 16000)",
+    )
+    parser.add_argument(
+        "--segments",
+        action="store_true",
+        help="Write one <article>.wav with Kaldi segments/wav.scp files instead of one WAV per sentence",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Convert articles even if they already have a metadata.csv",
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args()
 
-        article_name = _DIR.name
-        swc_path = _DIR / "aligned.swc"
-        ogg_path = _DIR / "audio.ogg"
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
 
-        print("Loading audio from", ogg_path)
-        audio = AudioSegment.from_ogg(ogg_path)
+    article_dirs = [Path(d).absolute() for d in args.article_dirs]
 
-        print("Parsing alignments from", swc_path)
-        article = ET.parse(swc_path)
-        sentence_num = 1
+    # Skip articles that have already been converted
+    todo_dirs = []
+    for article_dir in article_dirs:
+        if (not args.overwrite) and (article_dir / "metadata.csv").is_file():
+            _LOGGER.debug("Skipping %s (already converted)", article_dir)
+            continue
 
-        for s_elem in article.findall(".//s"):
-            start_ms = None
-            end_ms = None
-            tokens = []
-            for n_elem in s_elem.findall(".//n"):
-                tokens.append(n_elem.attrib["pronunciation"])
+        todo_dirs.append(article_dir)
 
-                if "start" in n_elem.attrib:
-                    n_start_ms = int(n_elem.attrib["start"])
-                    n_end_ms = int(n_elem.attrib["end"])
+    _LOGGER.info(
+        "Converting %s article(s) (skipped %s)",
+        len(todo_dirs),
+        len(article_dirs) - len(todo_dirs),
+    )
 
-                    if (start_ms is None) or (n_start_ms < start_ms):
-                        start_ms = n_start_ms
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {
+            executor.submit(
+                convert_article,
+                article_dir,
+                sample_rate=args.sample_rate,
+                use_segments=args.segments,
+            ): article_dir
+            for article_dir in todo_dirs
+        }
 
-                    if (end_ms is None) or (n_end_ms > end_ms):
-                        end_ms = n_end_ms
+        failed_dirs = []
+        for future, article_dir in futures.items():
+            try:
+                num_sentences = future.result()
+                _LOGGER.info("%s: %s sentence(s)", article_dir.name, num_sentences)
+            except Exception:
+                _LOGGER.exception("Failed to convert %s", article_dir)
+                failed_dirs.append(article_dir)
 
-            for ph_elem in s_elem.findall(".//ph"):
-                if "start" in ph_elem.attrib:
-                    ph_start_ms = int(ph_elem.attrib["start"])
-                    ph_end_ms = int(ph_elem.attrib["end"])
+    if failed_dirs:
+        _LOGGER.fatal("Failed to convert %s article(s)", len(failed_dirs))
+        sys.exit(1)
 
-                    if (start_ms is None) or (ph_start_ms < start_ms):
-                        start_ms = ph_start_ms
 
-                    if (end_ms is None) or (ph_end_ms > end_ms):
-                        end_ms = ph_end_ms
+# -----------------------------------------------------------------------------
 
-            if tokens and (start_ms is not None) and (end_ms is not None):
-                utt_id = f"{article_name}_{sentence_num}"
-                text = " ".join(tokens)
-                metadata_writer.writerow((utt_id, text))
 
-                sentence_segment = audio[start_ms:end_ms]
-                sentence_path = _DIR / f"{utt_id}.wav"
-                sentence_segment.export(
-                    sentence_path, format="wav", parameters=["-ar", "16000", "-ac", "1"]
+def convert_article(
+    article_dir: Path, sample_rate: int = 16000, use_segments: bool = False
+) -> int:
+    """Decode article audio once and write all aligned sentences"""
+    article_name = article_dir.name
+    swc_path = article_dir / "aligned.swc"
+    ogg_path = article_dir / "audio.ogg"
+
+    _LOGGER.debug("Parsing alignments from %s", swc_path)
+    sentences = list(get_sentences(swc_path, article_name))
+
+    _LOGGER.debug("Loading audio from %s", ogg_path)
+    audio = decode_audio(ogg_path, sample_rate=sample_rate)
+
+    # Written to a temporary file and renamed at the end, so a partially
+    # converted article is never mistaken for a finished one.
+    metadata_path = article_dir / "metadata.csv"
+    metadata_tmp_path = article_dir / "metadata.csv.tmp"
+
+    with open(metadata_tmp_path, "w") as metadata_file:
+        metadata_writer = csv.writer(metadata_file, delimiter="|")
+
+        if use_segments:
+            # One WAV file for the whole article.
+            # The article name is the recording id, so segments from many
+            # articles can be combined into one data directory.
+            reco_id = article_name
+            wav_path = article_dir / f"{reco_id}.wav"
+            write_wav(wav_path, audio, sample_rate)
+
+            with open(article_dir / "wav.scp", "w") as wav_scp_file:
+                print(reco_id, wav_path, file=wav_scp_file)
+
+            with open(article_dir / "segments", "w") as segments_file:
+                for utt_id, text, start_ms, end_ms in sentences:
+                    print(
+                        utt_id,
+                        reco_id,
+                        start_ms / 1000,
+                        end_ms / 1000,
+                        file=segments_file,
+                    )
+                    metadata_writer.writerow((utt_id, text))
+        else:
+            # One WAV file per sentence.
+            # Slices are views into the decoded audio, so nothing is copied.
+            for utt_id, text, start_ms, end_ms in sentences:
+                start_sample = (start_ms * sample_rate) // 1000
+                end_sample = (end_ms * sample_rate) // 1000
+                write_wav(
+                    article_dir / f"{utt_id}.wav",
+                    audio[start_sample:end_sample],
+                    sample_rate,
                 )
+                metadata_writer.writerow((utt_id, text))
+
+    os.replace(metadata_tmp_path, metadata_path)
+
+    return len(sentences)
+
+
+def get_sentences(
+    swc_path: Path, article_name: str
+) -> typing.Iterable[typing.Tuple[str, str, int, int]]:
+    """Yield utterance id, text, start/end ms for each aligned sentence"""
+    article = ET.parse(str(swc_path))
+    sentence_num = 1
+
+    for s_elem in article.findall(".//s"):
+        start_ms = None
+        end_ms = None
+        tokens = []
+        for n_elem in s_elem.findall(".//n"):
+            tokens.append(n_elem.attrib["pronunciation"])
+
+            if "start" in n_elem.attrib:
+                n_start_ms = int(n_elem.attrib["start"])
+                n_end_ms = int(n_elem.attrib["end"])
+
+                if (start_ms is None) or (n_start_ms < start_ms):
+                    start_ms = n_start_ms
+
+                if (end_ms is None) or (n_end_ms > end_ms):
+                    end_ms = n_end_ms
+
+        for ph_elem in s_elem.findall(".//ph"):
+            if "start" in ph_elem.attrib:
+                ph_start_ms = int(ph_elem.attrib["start"])
+                ph_end_ms = int(ph_elem.attrib["end"])
+
+                if (start_ms is None) or (ph_start_ms < start_ms):
+                    start_ms = ph_start_ms
+
+                if (end_ms is None) or (ph_end_ms > end_ms):
+                    end_ms = ph_end_ms
+
+        if tokens and (start_ms is not None) and (end_ms is not None):
+            utt_id = f"{article_name}_{sentence_num}"
+            yield utt_id, " ".join(tokens), start_ms, end_ms
+            sentence_num += 1
+
+
+# -----------------------------------------------------------------------------
+
+
+def decode_audio(audio_path: Path, sample_rate: int = 16000) -> np.ndarray:
+    """Decode audio file to 16-bit mono samples (requires ffmpeg)"""
+    pcm_bytes = subprocess.check_output(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-i",
+            str(audio_path),
+            "-ar",
+            str(sample_rate),
+            "-ac",
+            "1",
+            "-f",
+            "s16le",
+            "-acodec",
+            "pcm_s16le",
+            "-",
+        ]
+    )
+
+    return np.frombuffer(pcm_bytes, dtype="<i2")
+
 
-                print(utt_id, text, sentence_path)
-                sentence_num += 1
+def write_wav(wav_path: Path, samples: np.ndarray, sample_rate: int):
+    """Write 16-bit mono samples to a WAV file without copying them"""
+    data_size = samples.size * 2
+    with open(wav_path, "wb") as wav_file:
+        wav_file.write(
+            struct.pack(
+                "<4sI4s4sIHHIIHH4sI",
+                b"RIFF",
+                36 + data_size,
+                b"WAVE",
+                b"fmt ",
+                16,
+                1,  # PCM
+                1,  # mono
+                sample_rate,
+                sample_rate * 2,
+                2,
+                16,
+                b"data",
+                data_size,
+            )
+        )
+        wav_file.write(np.ascontiguousarray(samples, dtype="<i2").data)
 
 
 # -----------------------------------------------------------------------------
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Stand-in for online2-wav-nnet3-latgen-faster to test ipa2kaldi benchmark.
+
+Reads the model and graph (like loading them), then "decodes" each utterance
+by sleeping for its duration times STUB_DECODER_RTF (default: 0.05). Prints
+transcripts and logs to stderr in the same format as Kaldi.
+"""
+import io
+import os
+import subprocess
+import sys
+import time
+import wave
+
+
+def read_table(rspecifier):
+    """Read ark:/scp: text table into a dict"""
+    _, path = rspecifier.split(":", maxsplit=1)
+    table = {}
+    with open(path, "r") as table_file:
+        for line in table_file:
+            parts = line.strip().split(maxsplit=1)
+            if parts:
+                table[parts[0]] = parts[1] if len(parts) > 1 else ""
+
+    return table
+
+
+def get_duration(wav_entry):
+    """Get duration of a wav.scp entry (path or pipe) in seconds"""
+    wav_entry = wav_entry.strip()
+    if wav_entry.endswith("|"):
+        wav_bytes = subprocess.check_output(
+            wav_entry[:-1], shell=True, stderr=subprocess.DEVNULL
+        )
+        wav_file = wave.open(io.BytesIO(wav_bytes), "rb")
+    else:
+        wav_file = wave.open(wav_entry, "rb")
+
+    with wav_file:
+        return wav_file.getnframes() / wav_file.getframerate()
+
+
+def main():
+    """Main entry point"""
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) != 5:
+        print(
+            "Usage: stub-decoder.py [options] <nnet3-in> <fst-in> <spk2utt-rspecifier> <wav-rspecifier> <lattice-wspecifier>",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    model_path, fst_path, spk2utt_rspec, wav_rspec, _ = args
+    rtf = float(os.environ.get("STUB_DECODER_RTF", "0.05"))
+
+    # "Load" model and graph
+    for load_path in [model_path, fst_path]:
+        try:
+            with open(load_path, "rb") as load_file:
+                load_file.read()
+        except OSError as e:
+            print(f"ERROR (stub-decoder) {e}", file=sys.stderr)
+            sys.exit(1)
+
+    spk2utt = read_table(spk2utt_rspec)
+    wav_entries = read_table(wav_rspec)
+
+    start_time = time.perf_counter()
+    num_done = 0
+    num_err = 0
+    audio_sec = 0.0
+
+    for utt_ids in spk2utt.values():
+        for utt_id in utt_ids.split():
+            if utt_id not in wav_entries:
+                print(
+                    f"WARNING (stub-decoder) Did not find audio for utterance {utt_id}",
+                    file=sys.stderr,
+                )
+                num_err += 1
+                continue
+
+            duration = get_duration(wav_entries[utt_id])
+            time.sleep(duration * rtf)
+            audio_sec += duration
+
+            print(utt_id, file=sys.stderr, flush=True)
+            print(
+                f"LOG (stub-decoder) Decoded utterance {utt_id}",
+                file=sys.stderr,
+                flush=True,
+            )
+            num_done += 1
+
+    if audio_sec > 0:
+        elapsed = time.perf_counter() - start_time
+        print(
+            f"LOG (stub-decoder) Timing stats: real-time factor was {elapsed / audio_sec}",
+            file=sys.stderr,
+        )
+
+    print(
+        f"LOG (stub-decoder) Decoded {num_done} utterances, {num_err} with errors.",
+        file=sys.stderr,
+    )
+
+    # Like Kaldi, fail if nothing was decoded
+    sys.exit(0 if num_done else 1)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,23 @@ import logging
 import random
 import shutil
 import typing
+from collections import Counter
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
 
 from gruut_ipa import IPA
 
-from .utils import get_duration
+from .audio import AudioInfo, is_kaldi_wav
+from .datadir import (
+    VALIDATED_NAME,
+    regroup_speakers,
+    validate_data_dir,
+    write_durations,
+    write_spk2utt,
+    write_splits,
+)
+from .utils import get_duration, maybe_gzip_open
 
 _LOGGER = logging.getLogger("ipa2kaldi")
 
@@ -39,11 +49,40 @@ class DatasetItem:
     start_ms: typing.Optional[int] = None
     end_ms: typing.Optional[int] = None
 
+    # Duration of the entire audio file (from probing)
+    audio_duration_sec: typing.Optional[float] = None
+
+    # Format of the entire audio file (from probing)
+    audio_info: typing.Optional[AudioInfo] = None
+
+    # Pseudo-speaker within dataset when speakers are regrouped
+    speaker_group: typing.Optional[str] = None
+
+    # Items with the same split group always go to the same side of the
+    # test/train split (e.g., duplicates)
+    split_group: typing.Optional[str] = None
+
     @property
     def dataset_speaker(self) -> str:
         """Get globally-unique id for speaker"""
+        if self.speaker_group is not None:
+            return f"d{self.dataset_index}-{self.speaker_group}"
+
         return f"d{self.dataset_index}-s{self.speaker_index}"
 
+    @property
+    def duration_sec(self) -> typing.Optional[float]:
+        """Get duration of (possibly trimmed) audio if known"""
+        start_sec = 0.0 if (self.start_ms is None) else (self.start_ms / 1000)
+
+        if self.end_ms is not None:
+            return (self.end_ms / 1000) - start_sec
+
+        if self.audio_duration_sec is not None:
+            return max(0.0, self.audio_duration_sec - start_sec)
+
+        return None
+
 
 @dataclass
 class Dataset:
@@ -88,8 +127,35 @@ def write_test_train(
     noise_background_name: str = "_background_",
     noise_foreground_skip_prefix: str = "_",
     noise_stride: int = 4,
+    num_jobs: typing.Optional[int] = None,
+    max_speaker_utts: typing.Optional[int] = None,
+    max_speaker_sec: typing.Optional[float] = None,
+    min_speaker_utts: typing.Optional[int] = None,
+    frame_shift: typing.Optional[float] = None,
 ):
-    """Write wav.scp, text, and utt2spk files for test/train data splits."""
+    """Write wav.scp, text, utt2spk, and spk2utt files for test/train data splits.
+
+    Files are written in sorted order with the same utterances, and checked
+    with validate_data_dir, so Kaldi's fix_data_dir.sh has nothing to do.
+
+    utt2dur and reco2dur are written when all durations are known (from
+    probing), along with utt2num_frames if frame_shift is given.
+
+    If num_jobs is given, split<num_jobs> directories are also written with
+    speakers balanced by audio duration.
+
+    The source audio of each utterance is written to
+    data/local/utt2source.tsv (see ipa2kaldi alignment-qa).
+
+    Speakers with more than max_speaker_utts/max_speaker_sec are split into
+    pseudo-speakers, and speakers with fewer than min_speaker_utts are packed
+    together.
+
+    Items with the same split_group are kept on the same side of the split.
+
+    With use_ffmpeg, audio is converted to 16-bit 16Khz mono WAV in wav.scp
+    unless it's an untrimmed file already in that format (see audio_info).
+    """
 
     # path -> duration_sec
     noise_backgrounds: typing.Dict[Path, float] = {}
@@ -188,6 +254,34 @@ def write_test_train(
 
     # -------------------------------------------------------------------------
 
+    datasets = list(datasets)
+
+    if (
+        (max_speaker_utts is not None)
+        or (max_speaker_sec is not None)
+        or (min_speaker_utts is not None)
+    ):
+        # Split very large speakers and pack small ones into pseudo-speakers
+        num_regrouped = 0
+        for dataset in datasets:
+            items_by_key = {
+                str(item_idx): item for item_idx, item in enumerate(dataset.items)
+            }
+            item_groups = regroup_speakers(
+                {key: f"s{item.speaker_index}" for key, item in items_by_key.items()},
+                {key: item.duration_sec or 0.0 for key, item in items_by_key.items()},
+                max_speaker_utts=max_speaker_utts,
+                max_speaker_sec=max_speaker_sec,
+                min_speaker_utts=min_speaker_utts,
+            )
+
+            for key, group in item_groups.items():
+                items_by_key[key].speaker_group = group
+
+            num_regrouped += len(item_groups)
+
+        _LOGGER.debug("Regrouped speakers of %s utterance(s)", num_regrouped)
+
     utterances: typing.Dict[str, DatasetItem] = {}
     for dataset in datasets:
         for item in dataset.items:
@@ -200,8 +294,23 @@ def write_test_train(
     # 90% train
     # num_train_ids = len(utterances) - num_test_ids
 
-    # Split data into test/train sets
-    test_ids = set(random.sample(utterances.keys(), num_test_ids))
+    # Split data into test/train sets, keeping split groups together
+    split_groups: typing.Dict[str, typing.List[str]] = {}
+    for utt_id, group_utt in utterances.items():
+        split_group = (
+            utt_id if (group_utt.split_group is None) else group_utt.split_group
+        )
+        split_groups.setdefault(split_group, []).append(utt_id)
+
+    test_ids: typing.Set[str] = set()
+    for split_group in random.sample(sorted(split_groups), len(split_groups)):
+        if len(test_ids) >= num_test_ids:
+            break
+
+        group_ids = split_groups[split_group]
+        if (len(test_ids) + len(group_ids)) <= num_test_ids:
+            test_ids.update(group_ids)
+
     train_ids = utterances.keys() - test_ids
 
     _LOGGER.debug(
@@ -209,11 +318,26 @@ def write_test_train(
     )
 
     # Write wav.scp, text, utt2spk files for each set
+    utt2source_path = recipe_dir / "data" / "local" / "utt2source.tsv"
+    utt2source_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(utt2source_path, "w") as utt2source_file:
+        print("utt_id", "path", "start_ms", "end_ms", sep="\t", file=utt2source_file)
+        for utt_id in sorted(utterances):
+            source_utt = utterances[utt_id]
+            print(
+                utt_id,
+                source_utt.path.absolute(),
+                "" if source_utt.start_ms is None else source_utt.start_ms,
+                "" if source_utt.end_ms is None else source_utt.end_ms,
+                sep="\t",
+                file=utt2source_file,
+            )
+
     for dir_name, utt_ids in [("test", test_ids), ("train", train_ids)]:
         data_dir = recipe_dir / "data" / dir_name
         data_dir.mkdir(parents=True, exist_ok=True)
 
-        # Files need to be in sorted order
         utt_speaker = sorted(
             [(utt_id, utterances[utt_id].dataset_speaker) for utt_id in utt_ids]
         )
@@ -221,39 +345,47 @@ def write_test_train(
         # Dataset items to generate noisy variants of
         noisy_items: typing.Dict[str, DatasetItem] = {}
 
-        # wav.scp, text, utt2spk
-        with open(data_dir / "wav.scp", "w") as wav_scp, open(
-            data_dir / "text", "w"
-        ) as text_file, open(data_dir / "utt2spk", "w") as utt2spk:
-            for utt_index, (utt_id, speaker) in enumerate(utt_speaker):
-                utt: DatasetItem = utterances[utt_id]
-
-                if (noise_dir is not None) and ((utt_index % noise_stride) == 0):
-                    # Emit noisy version of audio clip
-                    noisy_items[utt_id] = utt
-
-                # wav.scp
-                file_path = utt.path.absolute()
-                if use_ffmpeg:
-                    seek_trim = []
-                    if utt.start_ms is not None:
-                        start_sec = utt.start_ms / 1000
-                        seek_trim.extend(["-ss", str(start_sec)])
-
-                    if utt.end_ms is not None:
-                        start_ms = 0 if (utt.start_ms is None) else utt.start_ms
-                        duration_ms = utt.end_ms - start_ms
-                        if duration_ms > 0:
-                            duration_sec = duration_ms / 1000
-                            seek_trim.extend(["-t", str(duration_sec)])
-                        else:
-                            _LOGGER.warning("Negative duration for %s", utt)
-
-                            # Drop utterance
-                            continue
+        # utterance id -> duration in seconds (if known)
+        utt_durations: typing.Dict[str, float] = {}
+
+        # utterance id -> (wav.scp, text, utt2spk) lines
+        utt_lines: typing.Dict[str, typing.Tuple[str, str, str]] = {}
+
+        # Number of wav.scp entries without a conversion command
+        num_direct = 0
+
+        for utt_index, (utt_id, speaker) in enumerate(utt_speaker):
+            utt: DatasetItem = utterances[utt_id]
+
+            if (noise_dir is not None) and ((utt_index % noise_stride) == 0):
+                # Emit noisy version of audio clip
+                noisy_items[utt_id] = utt
+
+            # wav.scp
+            file_path = utt.path.absolute()
+            is_trimmed = (utt.start_ms is not None) or (utt.end_ms is not None)
+            if use_ffmpeg and (is_trimmed or (not is_kaldi_wav(utt.audio_info))):
+                seek_trim = []
+                if utt.start_ms is not None:
+                    start_sec = utt.start_ms / 1000
+                    seek_trim.extend(["-ss", str(start_sec)])
+
+                if utt.end_ms is not None:
+                    start_ms = 0 if (utt.start_ms is None) else utt.start_ms
+                    duration_ms = utt.end_ms - start_ms
+                    if duration_ms > 0:
+                        duration_sec = duration_ms / 1000
+                        seek_trim.extend(["-t", str(duration_sec)])
+                    else:
+                        _LOGGER.warning("Negative duration for %s", utt)
+
+                        # Drop utterance
+                        noisy_items.pop(utt_id, None)
+                        continue
 
-                    # Convert file to a 16-bit 16khz mono WAV
-                    print(
+                # Convert file to a 16-bit 16khz mono WAV
+                wav_scp_line = " ".join(
+                    [
                         utt_id,
                         "ffmpeg",
                         "-y",
@@ -270,58 +402,135 @@ def write_test_train(
                         "wav",
                         "-",
                         "|",
-                        file=wav_scp,
-                    )
-                else:
-                    # File must already be a 16-bit 16khz mono WAV
-                    print(utt_id, str(file_path), file=wav_scp)
+                    ]
+                )
+            else:
+                # File must already be a 16-bit 16khz mono WAV
+                wav_scp_line = f"{utt_id} {file_path}"
+                num_direct += 1
+
+            # Newlines/tabs in text would break the line up
+            utt_lines[utt_id] = (
+                wav_scp_line,
+                " ".join([utt_id, *utt.text.split()]),
+                f"{utt_id} {speaker}",
+            )
 
-                # text
-                print(utt_id, utt.text.strip(), file=text_file)
+            if utt.duration_sec is not None:
+                utt_durations[utt_id] = utt.duration_sec
 
-                # utt2spk
-                print(utt_id, speaker, file=utt2spk)
+        _LOGGER.debug(
+            "%s of %s %s item(s) read directly without ffmpeg",
+            num_direct,
+            len(utt_lines),
+            dir_name,
+        )
 
-            # Generate noisy items in parallel
-            if noisy_items:
-                with ThreadPoolExecutor() as executor:
-                    _LOGGER.debug(
-                        "Generating %s noisy item(s) for %s", len(noisy_items), dir_name
+        # Generate noisy items in parallel
+        if noisy_items:
+            with ThreadPoolExecutor() as executor:
+                _LOGGER.debug(
+                    "Generating %s noisy item(s) for %s", len(noisy_items), dir_name
+                )
+
+                for (
+                    noisy_wav_scp,
+                    noisy_text,
+                    noisy_utt2spk,
+                    noisy_duration,
+                ) in executor.map(
+                    functools.partial(
+                        generate_noisy,
+                        noise_backgrounds,
+                        noise_bg_paths,
+                        noise_foregrounds,
+                        noise_fg_paths,
+                    ),
+                    noisy_items.items(),
+                ):
+                    noisy_utt_id = noisy_wav_scp.split(maxsplit=1)[0]
+                    utt_lines[noisy_utt_id] = (
+                        noisy_wav_scp,
+                        noisy_text,
+                        noisy_utt2spk,
                     )
 
-                    for wav_scp_line, text_line, utt2spk_line in executor.map(
-                        functools.partial(
-                            generate_noisy,
-                            speaker,
-                            noise_backgrounds,
-                            noise_bg_paths,
-                            noise_foregrounds,
-                            noise_fg_paths,
-                        ),
-                        noisy_items.items(),
-                    ):
-                        # Write noisy versions to files
-                        print(wav_scp_line, file=wav_scp)
-                        print(text_line, file=text_file)
-                        print(utt2spk_line, file=utt2spk)
+                    # Noise is added before and after the utterance
+                    utt_durations[noisy_utt_id] = noisy_duration
+
+        # Remove marker until the data dir is valid again
+        validated_path = data_dir / VALIDATED_NAME
+        if validated_path.is_file():
+            validated_path.unlink()
+
+        # wav.scp, text, utt2spk, spk2utt
+        # Files need to be in sorted order.
+        utt_speakers: typing.Dict[str, str] = {}
+        with open(data_dir / "wav.scp", "w") as wav_scp, open(
+            data_dir / "text", "w"
+        ) as text_file, open(data_dir / "utt2spk", "w") as utt2spk:
+            for utt_id in sorted(utt_lines):
+                wav_scp_line, text_line, utt2spk_line = utt_lines[utt_id]
+                print(wav_scp_line, file=wav_scp)
+                print(text_line, file=text_file)
+                print(utt2spk_line, file=utt2spk)
+                utt_speakers[utt_id] = utt2spk_line.split()[1]
+
+        write_spk2utt(data_dir, utt_speakers)
+
+        # Leftover files from a previous run would no longer match
+        for file_name in ["feats.scp", "cmvn.scp", "utt2uniq", "segments"]:
+            stale_path = data_dir / file_name
+            if stale_path.is_file():
+                stale_path.unlink()
+
+        # utt2dur, reco2dur, utt2num_frames
+        # Only written if every duration is known, since Kaldi won't fill in
+        # missing ones.
+        if all(utt_id in utt_durations for utt_id in utt_lines):
+            write_durations(data_dir, utt_durations, frame_shift=frame_shift)
+        else:
+            _LOGGER.debug(
+                "Not writing utt2dur for %s: %s unknown duration(s)",
+                dir_name,
+                sum(1 for utt_id in utt_lines if utt_id not in utt_durations),
+            )
+
+            for file_name in ["utt2dur", "reco2dur", "utt2num_frames"]:
+                stale_path = data_dir / file_name
+                if stale_path.is_file():
+                    stale_path.unlink()
+
+        if num_jobs is not None:
+            write_splits(data_dir, num_jobs, utt_durations)
+
+        problems = validate_data_dir(data_dir)
+        if problems:
+            raise ValueError(f"Invalid data dir {data_dir}: {'; '.join(problems)}")
+
+        # Lets local/fix_data_dir_fast.sh skip Kaldi's fix_data_dir.sh
+        validated_path.touch()
 
 
 # -----------------------------------------------------------------------------
 
 
 def generate_noisy(
-    speaker: str,
     noise_backgrounds: typing.Dict[Path, float],
     noise_bg_paths: typing.List[Path],
     noise_foregrounds: typing.Dict[Path, typing.Tuple[str, float]],
     noise_fg_paths: typing.List[Path],
     id_utt: typing.Tuple[str, DatasetItem],
-) -> typing.Tuple[str, str, str]:
-    """Emits noisy wav.scp, text, and utt2spk lines for dataset item"""
+) -> typing.Tuple[str, str, str, float]:
+    """Emits noisy wav.scp, text, and utt2spk lines for dataset item, and the
+    duration of the noisy clip"""
     utt_id, utt = id_utt
 
     # Credit: https://github.com/gooofy/zamia-speech/blob/master/speech_gen_noisy.py
-    noisy_utt_id = f"n-{utt_id}"
+    # Suffix keeps the speaker id as a prefix, so sorting by utterance or speaker
+    # gives the same order.
+    noisy_utt_id = f"{utt_id}-n"
+    speaker = utt.dataset_speaker
     file_path = utt.path.absolute()
 
     start_sec: typing.Optional[float] = None
@@ -338,6 +547,10 @@ def generate_noisy(
 
     fg_duration = duration_sec
 
+    if fg_duration is None:
+        # Use probed duration
+        fg_duration = utt.duration_sec
+
     if fg_duration is None:
         # Read audio file and get duration
         fg_duration = get_duration(file_path)
@@ -391,12 +604,13 @@ def generate_noisy(
     )
 
     # text with foreground labels on either side (e.g., NSN ...(text)... SIL)
-    noisy_text = " ".join([noisy_utt_id, fg_label_1, utt.text.strip(), fg_label_2])
+    # (whitespace is collapsed, so newlines/tabs can't break up the text file)
+    noisy_text = " ".join([noisy_utt_id, fg_label_1, *utt.text.split(), fg_label_2])
 
     # Same speaker
     utt2spk = " ".join([noisy_utt_id, speaker])
 
-    return wav_scp, noisy_text, utt2spk
+    return wav_scp, noisy_text, utt2spk, total_noise_sec
 
 
 # -----------------------------------------------------------------------------
@@ -408,11 +622,29 @@ def write_phones(
     silence_phones: typing.Optional[typing.List[str]] = None,
     optional_silence_phones: typing.Optional[typing.List[str]] = None,
     add_stress: bool = False,
+    phone_counts: typing.Optional[typing.Mapping[str, int]] = None,
 ):
-    """Write phone text files for Kaldi recipe."""
+    """Write phone text files for Kaldi recipe.
+
+    If phone_counts is given, non-silence phones (and stress variants) that
+    are not used in the lexicon are left out.
+    """
     silence_phones = silence_phones or _SILENCE_PHONES
     optional_silence_phones = optional_silence_phones or [silence_phones[0]]
 
+    def is_used(phone: str) -> bool:
+        return (phone_counts is None) or (phone_counts.get(phone, 0) > 0)
+
+    # Each line has a phone and its stress variants (shared tree root)
+    stress_marks = [""]
+    if add_stress:
+        stress_marks.extend([IPA.STRESS_PRIMARY.value, IPA.STRESS_SECONDARY.value])
+
+    phone_groups = [
+        [f"{stress}{phone}" for stress in stress_marks if is_used(f"{stress}{phone}")]
+        for phone in nonsilence_phones
+    ]
+
     # Write phone files
     dict_dir: Path = recipe_dir / "data" / "local" / "dict"
     dict_dir.mkdir(parents=True, exist_ok=True)
@@ -424,17 +656,10 @@ def write_phones(
 
     # nonsilence_phones.txt
     with open(nonsilence_path, "w") as nonsilence_file:
-        for phone in nonsilence_phones:
-            if add_stress:
+        for phone_group in phone_groups:
+            if phone_group:
                 # p ˈp ˌp
-                print(
-                    phone,
-                    f"{IPA.STRESS_PRIMARY.value}{phone}",
-                    f"{IPA.STRESS_SECONDARY.value}{phone}",
-                    file=nonsilence_file,
-                )
-            else:
-                print(phone, file=nonsilence_file)
+                print(*phone_group, file=nonsilence_file)
 
     # silence_phones.txt
     with open(silence_path, "w") as silence_file:
@@ -451,18 +676,97 @@ def write_phones(
         # Silence phones first
         print(*silence_phones, file=extra_questions_file)
 
-        # Non-silence phones next
-        print(*nonsilence_phones, file=extra_questions_file)
+        # Non-silence phones next, then primary/secondary stressed phones
+        for stress in stress_marks:
+            stress_phones = [
+                f"{stress}{p}" for p in nonsilence_phones if is_used(f"{stress}{p}")
+            ]
 
-        if add_stress:
-            # Primary stressed phones
-            print(
-                *[f"{IPA.STRESS_PRIMARY.value}{p}" for p in nonsilence_phones],
-                file=extra_questions_file,
-            )
+            if stress_phones:
+                print(*stress_phones, file=extra_questions_file)
 
-            # Secondary stressed phones
-            print(
-                *[f"{IPA.STRESS_SECONDARY.value}{p}" for p in nonsilence_phones],
-                file=extra_questions_file,
-            )
+
+def count_phones(lexicon_path: Path) -> typing.Counter[str]:
+    """Count how many lexicon entries use each phone"""
+    phone_counts: typing.Counter[str] = Counter()
+    with maybe_gzip_open(lexicon_path, "r") as lexicon_file:
+        for line in lexicon_file:
+            # word phone phone ...
+            phone_counts.update(line.split()[1:])
+
+    return phone_counts
+
+
+def merge_rare_phones(
+    phone_counts: typing.Mapping[str, int],
+    nonsilence_phones: typing.Iterable[str],
+    min_count: int,
+    add_stress: bool = False,
+    base_phones: typing.Optional[typing.Mapping[str, str]] = None,
+) -> typing.Dict[str, str]:
+    """Get replacements for phones used in fewer than min_count entries.
+
+    Rare stress variants are merged into the unstressed phone, and rare
+    variants in base_phones (e.g., tones) into their base phone. Other
+    phones are kept, since there's nothing safe to merge them into.
+
+    Returns a map from merged phones to their replacements.
+    """
+    counts = Counter(phone_counts)
+    base_phones = base_phones or {}
+    phone_map: typing.Dict[str, str] = {}
+
+    def merge(phone: str, target: str):
+        if 0 < counts[phone] < min_count:
+            counts[target] += counts.pop(phone)
+            phone_map[phone] = target
+
+    nonsilence_phones = list(nonsilence_phones)
+    if add_stress:
+        for phone in nonsilence_phones:
+            merge(f"{IPA.STRESS_PRIMARY.value}{phone}", phone)
+            merge(f"{IPA.STRESS_SECONDARY.value}{phone}", phone)
+
+    for phone in nonsilence_phones:
+        base_phone = base_phones.get(phone)
+        if base_phone is not None:
+            merge(phone, base_phone)
+
+    # ˈa˥ -> a˥ -> a
+    for phone, target in phone_map.items():
+        while target in phone_map:
+            target = phone_map[target]
+
+        phone_map[phone] = target
+
+    return phone_map
+
+
+def remap_lexicon(lexicon_path: Path, phone_map: typing.Mapping[str, str]) -> int:
+    """Replace phones in a lexicon, dropping duplicate pronunciations.
+
+    Returns the number of entries that were changed.
+    """
+    num_changed = 0
+    entries: typing.List[typing.Tuple[str, ...]] = []
+    seen_entries: typing.Set[typing.Tuple[str, ...]] = set()
+
+    with maybe_gzip_open(lexicon_path, "r") as lexicon_file:
+        for line in lexicon_file:
+            parts = line.split()
+            if not parts:
+                continue
+
+            entry = (parts[0], *(phone_map.get(p, p) for p in parts[1:]))
+            if entry != tuple(parts):
+                num_changed += 1
+
+            if entry not in seen_entries:
+                seen_entries.add(entry)
+                entries.append(entry)
+
+    with maybe_gzip_open(lexicon_path, "w") as lexicon_file:
+        for entry in entries:
+            print(*entry, file=lexicon_file)
+
+    return num_changed
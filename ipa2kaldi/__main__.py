@@ -2,7 +2,10 @@
 import argparse
 import importlib
 import logging
+import re
+import shlex
 import shutil
+import sys
 import typing
 from collections import Counter
 from pathlib import Path
@@ -13,20 +16,71 @@ from ipa2kaldi import (
     Dataset,
     DatasetItem,
     copy_recipe_files,
+    count_phones,
+    merge_rare_phones,
+    remap_lexicon,
     write_phones,
     write_test_train,
 )
+from ipa2kaldi.alignment_qa import read_exclusions
+from ipa2kaldi.arpa import filter_arpa, read_vocabulary, write_vocabulary
+from ipa2kaldi.audio import AudioCache, AudioInfo
+from ipa2kaldi.datadir import (
+    read_scp,
+    read_total_duration,
+    select_shortest,
+    select_speaker_hours,
+    write_subset,
+)
+from ipa2kaldi.dedup import HashCache, find_duplicates
+from ipa2kaldi.dedup import write_report as write_dedup_report
+from ipa2kaldi.lm import build_lm
+from ipa2kaldi.perturb import perturb_data_dir
+from ipa2kaldi.prune import prune_arpa
+from ipa2kaldi.qa import QACache, parse_thresholds, scan_audio, write_report
+from ipa2kaldi.training import (
+    get_memory_bytes,
+    get_training_profile,
+    has_gpu,
+    set_cmd_vars,
+)
 from ipa2kaldi.utils import ensure_symlink_dir, maybe_gzip_open, read_arpa
 
 _LOGGER = logging.getLogger("ipa2kaldi")
 
 _DIR = Path(__file__).parent
 
+# Sub-commands implemented in their own modules (ipa2kaldi <command> ...)
+_COMMANDS = {
+    "alignment-qa": "alignment_qa",
+    "alignments": "alignments",
+    "arpa-filter": "arpa",
+    "arpa-prune": "prune",
+    "audio-qa": "qa",
+    "batch": "batch",
+    "benchmark": "benchmark",
+    "dedup": "dedup",
+    "egs-cache": "egs_cache",
+    "export": "export",
+    "lm": "lm",
+    "plan": "plan",
+    "run": "stages",
+    "speed-perturb": "perturb",
+    "validate-data-dir": "datadir",
+}
+
 # -----------------------------------------------------------------------------
 
 
 def main():
     """Main entry point"""
+    if (len(sys.argv) > 1) and (sys.argv[1] in _COMMANDS):
+        command_module = importlib.import_module(
+            f".{_COMMANDS[sys.argv[1]]}", __package__
+        )
+        command_module.main(sys.argv[2:])  # type: ignore
+        return
+
     args = get_args()
 
     if args.debug:
@@ -36,6 +90,20 @@ def main():
 
     _LOGGER.debug(args)
 
+    make_recipe(args)
+
+
+def make_recipe(
+    args: argparse.Namespace,
+    metadata: typing.Optional[
+        typing.Mapping[typing.Tuple[Path, str], typing.Sequence[typing.Tuple]]
+    ] = None,
+):
+    """Create a Kaldi recipe from parsed command-line arguments.
+
+    metadata maps (dataset path, type) to items that were already loaded
+    (see ipa2kaldi batch). Other datasets are loaded here.
+    """
     # Convert to paths
     args.recipe_dir = Path(args.recipe_dir)
     args.lexicon = [Path(l) for l in args.lexicon]
@@ -46,6 +114,23 @@ def main():
     if args.noise_dir:
         args.noise_dir = Path(args.noise_dir)
 
+    if args.audio_cache:
+        args.audio_cache = Path(args.audio_cache)
+    else:
+        args.audio_cache = args.recipe_dir / "data" / "local" / "audio_cache.txt"
+
+    if args.qa_cache:
+        args.qa_cache = Path(args.qa_cache)
+    else:
+        args.qa_cache = args.recipe_dir / "data" / "local" / "qa" / "qa_cache.txt"
+
+    if args.hash_cache:
+        args.hash_cache = Path(args.hash_cache)
+    else:
+        args.hash_cache = (
+            args.recipe_dir / "data" / "local" / "dedup" / "hash_cache.txt"
+        )
+
     # Create recipe directory
     args.recipe_dir.mkdir(parents=True, exist_ok=True)
 
@@ -85,22 +170,13 @@ def main():
     datasets: typing.Dict[str, Dataset] = {}
     lexicon_words: typing.Set[str] = set()
     missing_words: typing.Set[str] = set()
-    missing_files = Counter()
+    missing_files: typing.Counter[str] = Counter()
 
     for dataset_index, dataset_parts in enumerate(args.dataset):
-        dataset_path = Path(dataset_parts[0])
-        dataset_name = dataset_path.name
-        dataset_type = "default"
+        dataset_path, dataset_type, dataset_name = parse_dataset(dataset_parts)
 
-        if len(dataset_parts) > 1:
-            dataset_name = dataset_parts[1]
-
-            # <type>:<name>
-            name_parts = dataset_name.split(":", maxsplit=1)
-            if len(name_parts) == 2:
-                dataset_type, dataset_name = name_parts
-
-        dataset_module = importlib.import_module(
+        # Each dataset module has get_metadata
+        dataset_module: typing.Any = importlib.import_module(
             f".dataset.{dataset_type}", __package__
         )
 
@@ -112,9 +188,13 @@ def main():
         num_items_loaded = 0
         num_items_dropped = 0
 
-        for item_index, item_details in enumerate(
-            dataset_module.get_metadata(dataset_path)
-        ):
+        if (metadata is not None) and ((dataset_path, dataset_type) in metadata):
+            # Already loaded
+            dataset_metadata = metadata[(dataset_path, dataset_type)]
+        else:
+            dataset_metadata = dataset_module.get_metadata(dataset_path)
+
+        for item_index, item_details in enumerate(dataset_metadata):
             item_speaker, item_text, audio_path = (
                 item_details[0],
                 item_details[1],
@@ -199,12 +279,148 @@ def main():
 
     # -------------------------------------------------------------------------
 
+    if args.exclude:
+        # Items from ipa2kaldi alignment-qa (or other lists of source audio)
+        exclusions: typing.Set[
+            typing.Tuple[str, typing.Optional[int], typing.Optional[int]]
+        ] = set()
+        for exclude_path in args.exclude:
+            exclusions.update(read_exclusions(exclude_path))
+
+        num_excluded = 0
+        for dataset in datasets.values():
+            num_items = len(dataset.items)
+            dataset.items = [
+                item
+                for item in dataset.items
+                if (str(item.path.absolute()), item.start_ms, item.end_ms)
+                not in exclusions
+            ]
+            num_excluded += num_items - len(dataset.items)
+
+        _LOGGER.info("Excluded %s item(s)", num_excluded)
+
+    # -------------------------------------------------------------------------
+
     for dataset_name, num_missing in missing_files.most_common():
         total_items = num_missing + len(datasets[dataset_name].items)
         _LOGGER.warning(
             "Missing files from %s: %s/%s", dataset_name, num_missing, total_items
         )
 
+    # -------------------------------------------------------------------------
+    # Probe audio files
+    # -------------------------------------------------------------------------
+
+    audio_infos: typing.Dict[Path, AudioInfo] = {}
+
+    if not args.no_probe:
+        audio_cache = AudioCache(args.audio_cache)
+        audio_cache.load()
+
+        audio_infos = audio_cache.probe(
+            item.path for dataset in datasets.values() for item in dataset.items
+        )
+        audio_cache.save()
+
+        total_seconds = 0.0
+        for dataset in datasets.values():
+            for item in dataset.items:
+                audio_info = audio_infos.get(item.path)
+                if audio_info is not None:
+                    item.audio_duration_sec = audio_info.duration_sec
+                    item.audio_info = audio_info
+                    total_seconds += item.duration_sec or 0.0
+
+        _LOGGER.info("Total audio: %0.1f hour(s)", total_seconds / (60 * 60))
+
+    # -------------------------------------------------------------------------
+    # Check audio quality
+    # -------------------------------------------------------------------------
+
+    if args.audio_qa:
+        qa_dir = args.recipe_dir / "data" / "local" / "qa"
+        qa_dir.mkdir(parents=True, exist_ok=True)
+
+        qa_cache = QACache(args.qa_cache)
+        qa_cache.load()
+
+        qa_results = scan_audio(
+            (
+                (item.path, item.start_ms, item.end_ms)
+                for dataset in datasets.values()
+                for item in dataset.items
+            ),
+            audio_infos,
+            thresholds=parse_thresholds(args.qa_threshold),
+            cache=qa_cache,
+        )
+        qa_cache.save()
+
+        for dataset in datasets.values():
+            dataset_results = [
+                qa_results[(item.path, item.start_ms, item.end_ms)]
+                for item in dataset.items
+            ]
+
+            qa_report_path = qa_dir / f"{dataset.name}.tsv"
+            with open(qa_report_path, "w") as qa_report_file:
+                status_counts = write_report(qa_report_file, dataset_results)
+
+            # Drop rejected items before wav.scp is written
+            dataset.items = [
+                item
+                for item, result in zip(dataset.items, dataset_results)
+                if result.status != "rejected"
+            ]
+
+            _LOGGER.info(
+                "Audio QA for %s: %s ok, %s flagged, %s rejected (%s)",
+                dataset.name,
+                status_counts["ok"],
+                status_counts["flagged"],
+                status_counts["rejected"],
+                qa_report_path,
+            )
+
+    # -------------------------------------------------------------------------
+    # Remove duplicate audio
+    # -------------------------------------------------------------------------
+
+    if args.dedup:
+        dedup_dir = args.recipe_dir / "data" / "local" / "dedup"
+        dedup_dir.mkdir(parents=True, exist_ok=True)
+
+        hash_cache = HashCache(args.hash_cache)
+        hash_cache.load()
+
+        all_items = [item for dataset in datasets.values() for item in dataset.items]
+        dedup_keys = [(item.path, item.start_ms, item.end_ms) for item in all_items]
+        dedup_texts = [item.text for item in all_items]
+
+        duplicates = find_duplicates(
+            dedup_keys, dedup_texts, audio_infos, cache=hash_cache
+        )
+        hash_cache.save()
+
+        with open(dedup_dir / "duplicates.tsv", "w") as dedup_report_file:
+            write_dedup_report(dedup_report_file, dedup_keys, dedup_texts, duplicates)
+
+        for item, split_group in zip(all_items, duplicates.split_groups):
+            item.split_group = str(split_group)
+
+        kept_items = set(
+            id(item) for item, keep in zip(all_items, duplicates.keep) if keep
+        )
+        for dataset in datasets.values():
+            dataset.items = [item for item in dataset.items if id(item) in kept_items]
+
+        _LOGGER.info(
+            "Dropped %s duplicate item(s) (%s)",
+            duplicates.num_dropped,
+            dedup_dir / "duplicates.tsv",
+        )
+
     # -------------------------------------------------------------------------
     # Guess missing words
     # -------------------------------------------------------------------------
@@ -223,21 +439,24 @@ def main():
         # Guess pronunciations
         missing_words_dict_path = args.recipe_dir / "missing_words.dict"
         with open(missing_words_dict_path, "w") as missing_words_dict_file:
-            for word, word_pron in gruut_lang.phonemizer.predict(
+            for word, guessed_phonemes in gruut_lang.phonemizer.predict(
                 missing_words, nbest=1
             ):
                 # Assume one guess
-                word_pron = WordPronunciation(
+                guessed_pron = WordPronunciation(
                     phonemes=[
                         p.text
                         for p in gruut_lang.phonemes.split(
-                            "".join(word_pron), keep_stress=gruut_lang.keep_stress
+                            "".join(guessed_phonemes),
+                            keep_stress=gruut_lang.keep_stress,
                         )
                     ]
                 )
-                lexicon[word] = [word_pron]
+                lexicon[word] = [guessed_pron]
                 lexicon_words.add(word)
-                print(word, " ".join(word_pron.phonemes), file=missing_words_dict_file)
+                print(
+                    word, " ".join(guessed_pron.phonemes), file=missing_words_dict_file
+                )
 
         _LOGGER.debug(
             "Wrote missing words to %s and %s. Add with --lexicon",
@@ -252,19 +471,19 @@ def main():
     recipe_lexicon_path = args.recipe_dir / "data" / "local" / "dict" / "lexicon.txt.gz"
     _LOGGER.debug("Writing final lexicon to %s", recipe_lexicon_path)
 
-    with maybe_gzip_open(recipe_lexicon_path, "w") as lexicon_file:
+    with maybe_gzip_open(recipe_lexicon_path, "w") as recipe_lexicon_file:
         if args.unknown_word:
             # Add unknown word
             lexicon_words.add(args.unknown_word)
-            print(args.unknown_word, args.unknown_phone, file=lexicon_file)
+            print(args.unknown_word, args.unknown_phone, file=recipe_lexicon_file)
 
         if args.silence_word:
             # Add silence word
-            print(args.silence_word, args.silence_phone, file=lexicon_file)
+            print(args.silence_word, args.silence_phone, file=recipe_lexicon_file)
 
         for word, word_prons in lexicon.items():
             for word_pron in word_prons:
-                print(word, *word_pron.phonemes, file=lexicon_file)
+                print(word, *word_pron.phonemes, file=recipe_lexicon_file)
 
     # -------------------------------------------------------------------------
     # Write Kaldi recipe files
@@ -278,10 +497,32 @@ def main():
         datasets.values(),
         noise_dir=args.noise_dir,
         noise_stride=args.noise_stride,
+        num_jobs=args.num_jobs,
+        max_speaker_utts=args.max_speaker_utterances,
+        max_speaker_sec=(
+            (args.max_speaker_hours * 60 * 60) if args.max_speaker_hours else None
+        ),
+        min_speaker_utts=args.min_speaker_utterances,
+        frame_shift=args.frame_shift,
     )
 
+    # Smaller training sets for mono/tri1 (like train_2kshort in Kaldi recipes)
+    write_train_subsets(args)
+
+    if args.speed_perturb:
+        # Rendered once here instead of through sox pipes in run_ivector_common.sh
+        train_dir = args.recipe_dir / "data" / "train"
+        sp_dir = train_dir.parent / "train_sp_prerendered"
+        _LOGGER.debug("Rendering speed-perturbed audio (%s)", sp_dir)
+        num_sp_utts = perturb_data_dir(train_dir, sp_dir)
+        _LOGGER.info("Rendered %s speed-perturbed utterance(s)", num_sp_utts)
+
     # Phones
     nonsilence_phones = []
+
+    # phone with tone -> phone
+    tone_bases: typing.Dict[str, str] = {}
+
     for phoneme in gruut_lang.phonemes:
         # No tones
         nonsilence_phones.append(phoneme.text)
@@ -290,12 +531,96 @@ def main():
             # Separate phoneme for each tone
             for tone in phoneme.tones:
                 nonsilence_phones.append(phoneme.text + tone)
+                tone_bases[phoneme.text + tone] = phoneme.text
+
+    phone_counts: typing.Optional[typing.Counter[str]] = None
+    if args.prune_phones:
+        # Only keep phones that are used in the final lexicon
+        dict_dir = recipe_lexicon_path.parent
+        phone_counts = count_phones(recipe_lexicon_path)
+
+        with open(dict_dir / "phone_counts.txt", "w") as phone_counts_file:
+            for phone, count in phone_counts.most_common():
+                print(phone, count, file=phone_counts_file)
+
+        phone_map = merge_rare_phones(
+            phone_counts,
+            nonsilence_phones,
+            min_count=args.min_phone_count,
+            add_stress=gruut_lang.keep_stress,
+            base_phones=tone_bases,
+        )
 
-    write_phones(args.recipe_dir, nonsilence_phones, add_stress=gruut_lang.keep_stress)
+        with open(dict_dir / "phone_map.txt", "w") as phone_map_file:
+            for phone, target in phone_map.items():
+                print(phone, target, file=phone_map_file)
+
+        if phone_map:
+            num_changed = remap_lexicon(recipe_lexicon_path, phone_map)
+            phone_counts = count_phones(recipe_lexicon_path)
+            _LOGGER.debug(
+                "Merged %s rare phone(s) in %s lexicon entries",
+                len(phone_map),
+                num_changed,
+            )
+
+        num_phones = len(nonsilence_phones) * (3 if gruut_lang.keep_stress else 1)
+        num_used = sum(1 for count in phone_counts.values() if count > 0)
+        _LOGGER.info(
+            "Using %s phone(s) of %s (merged %s)", num_used, num_phones, len(phone_map),
+        )
+
+    write_phones(
+        args.recipe_dir,
+        nonsilence_phones,
+        add_stress=gruut_lang.keep_stress,
+        phone_counts=phone_counts,
+    )
 
     # Scripts
     copy_recipe_files(args.recipe_dir, _DIR / "recipe")
 
+    # Number of jobs must match pre-built data splits
+    cmd_path = args.recipe_dir / "cmd.sh"
+    set_cmd_vars(cmd_path, {"nJobs": str(args.num_jobs)})
+
+    # nnet3 training/decoding options for this machine
+    if args.training_device == "auto":
+        use_gpu = has_gpu(kaldi_dir)
+    else:
+        use_gpu = args.training_device == "gpu"
+
+    if args.training_memory_gb:
+        memory_bytes: typing.Optional[int] = int(args.training_memory_gb * 1024 ** 3)
+    else:
+        memory_bytes = get_memory_bytes()
+
+    train_sec = read_total_duration(args.recipe_dir / "data" / "train")
+    num_decode_jobs = re.search(
+        r"^export nDecodeJobs=(\d+)", cmd_path.read_text(), flags=re.MULTILINE
+    )
+
+    training_profile = get_training_profile(
+        use_gpu,
+        cpus=args.training_cpus,
+        memory_bytes=memory_bytes,
+        train_hours=(train_sec / (60 * 60)) if train_sec is not None else None,
+        num_decode_jobs=int(num_decode_jobs.group(1)) if num_decode_jobs else 1,
+    )
+    set_cmd_vars(cmd_path, training_profile.to_cmd_vars())
+    _LOGGER.info("Training profile: %s", training_profile)
+
+    if args.egs_cache_dir:
+        # Run the cache with this Python, which has ipa2kaldi installed
+        set_cmd_vars(
+            cmd_path,
+            {
+                "egsCacheDir": shlex.quote(str(Path(args.egs_cache_dir).absolute())),
+                "egsCacheMaxGb": str(args.egs_cache_size_gb),
+                "egsCacheCmd": shlex.quote(f"{sys.executable} -m ipa2kaldi egs-cache"),
+            },
+        )
+
     # Check for ARPA LM
     lm_path = args.recipe_dir / "lm" / "lm.arpa.gz"
 
@@ -304,6 +629,16 @@ def main():
         with maybe_gzip_open(lm_path, "w") as dest_lm_file:
             with maybe_gzip_open(args.arpa_lm, "r") as src_lm_file:
                 shutil.copyfileobj(src_lm_file, dest_lm_file)
+    elif args.build_lm:
+        _LOGGER.debug("Building %s-gram language model (%s)", args.lm_order, lm_path)
+        lm_path.parent.mkdir(parents=True, exist_ok=True)
+        build_lm(
+            lm_path,
+            text_paths=args.lm_text,
+            kaldi_text_paths=[args.recipe_dir / "data" / "train" / "text"],
+            order=args.lm_order,
+            unknown_word=args.unknown_word,
+        )
 
     if lm_path.is_file():
         _LOGGER.debug("Checking if all words in the lexicon are in %s", lm_path)
@@ -317,8 +652,41 @@ def main():
                 len(missing_arpa_words),
                 missing_arpa_words,
             )
+
+        decode_lm_path = lm_path
+        pruned_lm_path = lm_path.parent / "lm.pruned.arpa.gz"
+        if (args.prune_lm_threshold is not None) or (args.prune_lm_ngrams is not None):
+            # Smaller LM for decoding graphs
+            decode_lm_path = pruned_lm_path
+            _LOGGER.debug("Pruning %s (%s)", lm_path, decode_lm_path)
+            pruned_counts = prune_arpa(
+                lm_path,
+                decode_lm_path,
+                threshold=args.prune_lm_threshold,
+                max_ngrams=args.prune_lm_ngrams,
+            )
+            _LOGGER.info("Pruned language model to %s n-gram(s)", sum(pruned_counts))
+        elif pruned_lm_path.is_file():
+            # run.sh and export would use it instead of lm.arpa.gz
+            _LOGGER.debug("Removing old pruned language model %s", pruned_lm_path)
+            pruned_lm_path.unlink()
+
+        # Pre-filter for arpa2fst (run.sh stage 2)
+        filtered_lm_path = (
+            args.recipe_dir / "data" / "local" / "lm" / "lm_filtered.arpa.gz"
+        )
+        filtered_lm_path.parent.mkdir(parents=True, exist_ok=True)
+        _LOGGER.debug("Filtering %s (%s)", decode_lm_path, filtered_lm_path)
+
+        lm_vocabulary = read_vocabulary(recipe_lexicon_path) | {"<s>", "</s>"}
+        filter_arpa(decode_lm_path, filtered_lm_path, lm_vocabulary)
+
+        # run.sh checks this against data/lang_test/words.txt
+        write_vocabulary(filtered_lm_path.with_name("lm_filtered.vocab"), lm_vocabulary)
     else:
-        _LOGGER.warning("Make sure to put ARPA language model at %s", lm_path)
+        _LOGGER.warning(
+            "Make sure to put ARPA language model at %s (or use --build-lm)", lm_path
+        )
 
     _LOGGER.info("Done")
 
@@ -326,7 +694,84 @@ def main():
 # -----------------------------------------------------------------------------
 
 
-def get_args():
+def parse_dataset(dataset_parts: typing.Sequence[str]) -> typing.Tuple[Path, str, str]:
+    """Get path, type, and name from --dataset <path> [<type>:<name>]"""
+    dataset_path = Path(dataset_parts[0])
+    dataset_name = dataset_path.name
+    dataset_type = "default"
+
+    if len(dataset_parts) > 1:
+        dataset_name = dataset_parts[1]
+
+        # <type>:<name>
+        name_parts = dataset_name.split(":", maxsplit=1)
+        if len(name_parts) == 2:
+            dataset_type, dataset_name = name_parts
+
+    return dataset_path, dataset_type, dataset_name
+
+
+def write_train_subsets(args: argparse.Namespace):
+    """Write data/train_mono and data/train_tri1 from durations in data/train.
+
+    run.sh uses all of data/train for a stage whose subset is missing.
+    """
+    train_dir = args.recipe_dir / "data" / "train"
+    mono_dir = train_dir.parent / "train_mono"
+    tri1_dir = train_dir.parent / "train_tri1"
+
+    # Remove subsets from previous runs
+    for subset_dir in [mono_dir, tri1_dir]:
+        if subset_dir.is_dir():
+            shutil.rmtree(subset_dir)
+
+    if not (args.mono_utterances or args.tri1_hours):
+        return
+
+    utt2dur_path = train_dir / "utt2dur"
+    if not utt2dur_path.is_file():
+        _LOGGER.warning(
+            "Training mono/tri1 on all data (no utt2dur in %s to pick subsets)",
+            train_dir,
+        )
+        return
+
+    utt_durations = {
+        utt_id: float(value) for utt_id, value in read_scp(utt2dur_path).items()
+    }
+
+    subsets: typing.List[typing.Tuple[Path, typing.List[str]]] = []
+    if args.mono_utterances:
+        subsets.append((mono_dir, select_shortest(utt_durations, args.mono_utterances)))
+
+    if args.tri1_hours:
+        subsets.append(
+            (
+                tri1_dir,
+                select_speaker_hours(
+                    read_scp(train_dir / "utt2spk"),
+                    utt_durations,
+                    args.tri1_hours,
+                    max_utt_sec=args.subset_max_utterance_sec,
+                ),
+            )
+        )
+
+    for subset_dir, utt_ids in subsets:
+        if (not utt_ids) or (len(utt_ids) >= len(utt_durations)):
+            # Not smaller than data/train
+            continue
+
+        write_subset(train_dir, subset_dir, utt_ids, num_jobs=args.num_jobs)
+        _LOGGER.info(
+            "Wrote %s utterance(s) (%0.1f hour(s)) to %s",
+            len(utt_ids),
+            sum(utt_durations[utt_id] for utt_id in utt_ids) / (60 * 60),
+            subset_dir,
+        )
+
+
+def get_args(argv: typing.Optional[typing.List[str]] = None):
     """Parse command-line arguments"""
     parser = argparse.ArgumentParser(prog="ipa2kaldi")
     parser.add_argument("--language", required=True, help="Language code (e.g., en-us)")
@@ -371,11 +816,55 @@ def get_args():
         "--arpa-lm",
         help="Path to ARPA language model (copied to <RECIPE>/lm/lm.arpa.gz)",
     )
+    parser.add_argument(
+        "--build-lm",
+        action="store_true",
+        help="Build <RECIPE>/lm/lm.arpa.gz from training transcriptions",
+    )
+    parser.add_argument(
+        "--lm-order",
+        type=int,
+        default=3,
+        help="Order of n-grams for --build-lm (default: 3)",
+    )
+    parser.add_argument(
+        "--lm-text",
+        action="append",
+        default=[],
+        help="Additional text file with one sentence per line for --build-lm",
+    )
+    parser.add_argument(
+        "--prune-lm-ngrams",
+        type=int,
+        help="Prune decoding language model to at most this many n-grams",
+    )
+    parser.add_argument(
+        "--prune-lm-threshold",
+        type=float,
+        help="Prune n-grams from decoding language model below this relative entropy (e.g., 1e-8)",
+    )
     parser.add_argument(
         "--drop-unknown",
         action="store_true",
         help="Drop utterances with unknown instead of guessing pronunciations",
     )
+    parser.add_argument(
+        "--prune-phones",
+        action="store_true",
+        help="Leave phones and stress variants that aren't in the final lexicon out of the recipe",
+    )
+    parser.add_argument(
+        "--min-phone-count",
+        type=int,
+        default=1,
+        help="With --prune-phones, merge stress/tone variants in fewer lexicon entries than this into their base phone (default: 1)",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        help="Path to tab-separated list of items to drop (path, start_ms, end_ms columns), e.g. from alignment-qa",
+    )
     parser.add_argument(
         "--noise-dir",
         help="Path to directory with noise WAV files (_background_, SIL, NSN, etc.)",
@@ -386,6 +875,115 @@ def get_args():
         default=4,
         help="Add noise to every nth clip (default: 4, only with --noise-dir)",
     )
+    parser.add_argument(
+        "--num-jobs",
+        type=int,
+        default=12,
+        help="Number of parallel Kaldi jobs (nJobs in cmd.sh, default: 12)",
+    )
+    parser.add_argument(
+        "--training-device",
+        choices=["auto", "cpu", "gpu"],
+        default="auto",
+        help="Train nnet3 model on CPU or GPU (default: GPU if nvidia-smi finds one)",
+    )
+    parser.add_argument(
+        "--training-cpus",
+        type=int,
+        help="CPU cores for CPU training and decoding (default: all)",
+    )
+    parser.add_argument(
+        "--training-memory-gb",
+        type=float,
+        help="Memory for CPU training in GB (default: all)",
+    )
+    parser.add_argument(
+        "--egs-cache-dir",
+        help="Keep nnet3 egs in this directory and reuse them when training inputs match",
+    )
+    parser.add_argument(
+        "--egs-cache-size-gb",
+        type=float,
+        default=100,
+        help="Size limit of egs cache before least recently used egs are removed (default: 100)",
+    )
+    parser.add_argument(
+        "--max-speaker-hours",
+        type=float,
+        help="Split speakers with more audio than this into pseudo-speakers",
+    )
+    parser.add_argument(
+        "--max-speaker-utterances",
+        type=int,
+        help="Split speakers with more utterances than this into pseudo-speakers",
+    )
+    parser.add_argument(
+        "--min-speaker-utterances",
+        type=int,
+        help="Pack speakers with fewer utterances than this into pseudo-speakers",
+    )
+    parser.add_argument(
+        "--audio-cache",
+        help="Path to cache of probed audio details (default: <RECIPE>/data/local/audio_cache.txt)",
+    )
+    parser.add_argument(
+        "--qa-cache",
+        help="Path to cache of audio QA statistics (default: <RECIPE>/data/local/qa/qa_cache.txt)",
+    )
+    parser.add_argument(
+        "--hash-cache",
+        help="Path to cache of decoded audio hashes for --dedup (default: <RECIPE>/data/local/dedup/hash_cache.txt)",
+    )
+    parser.add_argument(
+        "--no-probe",
+        action="store_true",
+        help="Don't probe audio files for durations/formats (balance jobs by utterance count, convert all audio with ffmpeg)",
+    )
+    parser.add_argument(
+        "--frame-shift",
+        type=float,
+        help="Also write utt2num_frames for this frame shift in seconds (e.g., 0.01)",
+    )
+    parser.add_argument(
+        "--mono-utterances",
+        type=int,
+        default=2000,
+        help="Train monophone model on this many of the shortest utterances (default: 2000, 0 for all)",
+    )
+    parser.add_argument(
+        "--tri1-hours",
+        type=float,
+        default=20,
+        help="Train tri1 model on this many hours, sampled from every speaker (default: 20, 0 for all)",
+    )
+    parser.add_argument(
+        "--subset-max-utterance-sec",
+        type=float,
+        default=15,
+        help="Leave longer utterances out of the tri1 subset (default: 15)",
+    )
+    parser.add_argument(
+        "--speed-perturb",
+        action="store_true",
+        help="Render 0.9x/1.0x/1.1x speed-perturbed training audio for run.sh ahead of time (data/train_sp_prerendered)",
+    )
+    parser.add_argument(
+        "--audio-qa",
+        action="store_true",
+        help="Check audio and drop broken items before writing wav.scp (reports in <RECIPE>/data/local/qa)",
+    )
+    parser.add_argument(
+        "--qa-threshold",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Override audio QA threshold (e.g., min_rms_db=-50)",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Drop duplicate audio across datasets and keep items with the same audio/text on the same side of the test/train split",
+    )
     parser.add_argument(
         "--debug", action="store_true", help="Print DEBUG messages to console"
     )
@@ -409,7 +1007,7 @@ def get_args():
     #         "--debug", action="store_true", help="Print DEBUG messages to console"
     #     )
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 # -----------------------------------------------------------------------------
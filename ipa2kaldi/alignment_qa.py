@@ -0,0 +1,717 @@
+"""Finds utterances with implausible alignments from phone durations.
+
+Phone durations come from the phone_ctm.JOB.gz files that get_phones.sh
+writes with ali-to-phones --ctm-output. Without them (e.g., for an .npz from
+ipa2kaldi alignments), each phone gets an equal share of its word's frames.
+Per-phone distributions of (log) duration are taken over the whole corpus,
+and phones far from their median (robust z-score) or outside absolute limits
+count against their utterance.
+
+Excluded utterances are written as source audio (path, start_ms, end_ms)
+using data/local/utt2source.tsv, so they can be dropped from the next
+recipe build with ipa2kaldi --exclude.
+"""
+
+import argparse
+import csv
+import dataclasses
+import logging
+import re
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from .alignments import Alignments, find_phones_files, load_alignments
+from .utils import maybe_gzip_open
+
+_LOGGER = logging.getLogger("ipa2kaldi.alignment_qa")
+
+DEFAULT_IGNORE_WORDS = ["<eps>", "!SIL", "<unk>"]
+DEFAULT_SILENCE_PHONES = ["SIL", "SPN", "NSN"]
+
+# Scales median absolute deviation to a standard deviation (normal data)
+_MAD_SCALE = 0.6745
+
+# Kaldi speed-perturbation prefix (sp0.9-) and noisy variant suffix (-n)
+_SP_PREFIX = re.compile(r"^sp[0-9.]+-")
+_NOISY_SUFFIX = "-n"
+
+# utt_id -> (phones, durations in seconds) from a phone CTM
+UttPhones = typing.Mapping[str, typing.Tuple[typing.List[str], np.ndarray]]
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class AlignmentThresholds:
+    """Limits on phone durations"""
+
+    # Phones this many robust standard deviations from their median (log
+    # duration) are outliers.
+    max_abs_z: float = 3.5
+
+    # Exclude utterances with more than this fraction of outlier phones.
+    # A single squeezed or stretched word is usually 2-4 phones.
+    max_outlier_ratio: float = 0.1
+
+    # Exclude utterances with any phone longer/shorter than these
+    max_phone_sec: float = 1.0
+    min_phone_sec: float = 0.0
+
+    # Exclude utterances with any phone shorter than this many frames (e.g.,
+    # a 4 phone word squeezed into 2 frames).
+    min_phone_frames: float = 1.0
+
+    # Lower bound on median absolute deviation of log duration, so phones
+    # with very regular durations don't produce huge z-scores.
+    min_mad: float = 0.05
+
+
+@dataclass
+class PhoneStats:
+    """Duration distribution of each phone (without word position)"""
+
+    phones: typing.List[str]
+    counts: np.ndarray
+
+    # Seconds
+    p05_sec: np.ndarray
+    median_sec: np.ndarray
+    p95_sec: np.ndarray
+
+    # Median absolute deviation of natural log duration
+    log_mad: np.ndarray
+
+
+@dataclass
+class UtteranceScores:
+    """Outlier counts and exclusion decisions for each utterance"""
+
+    utt_ids: typing.List[str]
+    num_phones: np.ndarray
+    num_outliers: np.ndarray
+    num_too_long: np.ndarray
+    num_too_short: np.ndarray
+    max_abs_z: np.ndarray
+    longest_phone_sec: np.ndarray
+    too_many_outliers: np.ndarray
+    excluded: np.ndarray
+
+    def reasons(self, utt_index: int) -> typing.List[str]:
+        """Get reasons an utterance was excluded"""
+        utt_reasons = []
+        if self.num_too_long[utt_index] > 0:
+            utt_reasons.append("long_phone")
+
+        if self.num_too_short[utt_index] > 0:
+            utt_reasons.append("short_phone")
+
+        if self.too_many_outliers[utt_index]:
+            utt_reasons.append("outlier_phones")
+
+        return utt_reasons
+
+
+# -----------------------------------------------------------------------------
+
+
+def group_quantiles(
+    group_ids: np.ndarray,
+    values: np.ndarray,
+    num_groups: int,
+    quantiles: typing.Sequence[float],
+) -> np.ndarray:
+    """Get quantiles of values within each group (NaN for empty groups).
+
+    Values are sorted once by (group, value), so this is a single pass
+    regardless of the number of groups. Returns [num_groups, len(quantiles)].
+    """
+    # Stable (radix) sort of integer groups is much faster than np.lexsort
+    value_order = np.argsort(values)
+    order = value_order[np.argsort(group_ids[value_order], kind="stable")]
+    sorted_values = values[order]
+
+    counts = np.bincount(group_ids, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+    has_values = counts > 0
+    last_index = max(0, len(sorted_values) - 1)
+
+    result = np.full((num_groups, len(quantiles)), np.nan)
+    for quantile_index, quantile in enumerate(quantiles):
+        # Linear interpolation between closest ranks
+        positions = quantile * np.maximum(counts - 1, 0)
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.ceil(positions).astype(np.int64)
+        fractions = positions - lower
+
+        lower_values = sorted_values[np.minimum(starts + lower, last_index)]
+        upper_values = sorted_values[np.minimum(starts + upper, last_index)]
+
+        result[has_values, quantile_index] = (
+            lower_values * (1 - fractions) + upper_values * fractions
+        )[has_values]
+
+    return result
+
+
+def read_phone_ctm(ctm_path: typing.Union[str, Path]) -> UttPhones:
+    """Parse a phone_ctm.JOB.gz file from get_phones.sh.
+
+    Each line is: utt_id channel start_sec duration_sec phone
+    Returns phones and their durations (seconds) for each utterance.
+    """
+    utt_phones: typing.Dict[
+        str, typing.Tuple[typing.List[str], typing.List[float]]
+    ] = {}
+    with maybe_gzip_open(ctm_path, "r") as ctm_file:
+        for line in ctm_file:
+            parts = line.split()
+            if not parts:
+                continue
+
+            phones, durations = utt_phones.setdefault(parts[0], ([], []))
+            phones.append(parts[4])
+            durations.append(float(parts[3]))
+
+    return {
+        utt_id: (phones, np.array(durations))
+        for utt_id, (phones, durations) in utt_phones.items()
+    }
+
+
+def load_phone_ctm(
+    ctm_paths: typing.Iterable[typing.Union[str, Path]],
+    max_workers: typing.Optional[int] = None,
+) -> UttPhones:
+    """Parse phone_ctm.JOB.gz files in parallel"""
+    utt_phones: typing.Dict[str, typing.Tuple[typing.List[str], np.ndarray]] = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for ctm_phones in executor.map(read_phone_ctm, ctm_paths):
+            utt_phones.update(ctm_phones)
+
+    return utt_phones
+
+
+def find_phone_ctm_files(phones_dir: Path) -> typing.List[Path]:
+    """Get phone_ctm.JOB.gz files (or concatenated phone_ctm file) in job order"""
+    job_paths = list(phones_dir.glob("phone_ctm.*.gz"))
+    if job_paths:
+        return sorted(job_paths, key=lambda p: int(p.name.split(".")[1]))
+
+    concatenated_path = phones_dir / "phone_ctm"
+    if concatenated_path.is_file():
+        return [concatenated_path]
+
+    return []
+
+
+def get_ctm_durations(
+    alignments: Alignments, utt_phones: UttPhones,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Get duration (seconds) of every alignment phone from a phone CTM.
+
+    Returns durations and a mask of phones that were found. Utterances whose
+    CTM phones don't match their word alignment are left out.
+    """
+    durations = np.zeros(len(alignments.phone_ids))
+    found = np.zeros(len(alignments.phone_ids), dtype=bool)
+    num_missing = 0
+    num_mismatched = 0
+
+    for utt_index, utt_id in enumerate(alignments.utt_ids):
+        ctm_phones = utt_phones.get(utt_id)
+        if ctm_phones is None:
+            num_missing += 1
+            continue
+
+        phone_start = int(alignments.phone_offsets[alignments.utt_offsets[utt_index]])
+        phone_end = int(alignments.phone_offsets[alignments.utt_offsets[utt_index + 1]])
+        phone_names, phone_durations = ctm_phones
+
+        if phone_names != [
+            alignments.phones[p] for p in alignments.phone_ids[phone_start:phone_end]
+        ]:
+            num_mismatched += 1
+            continue
+
+        durations[phone_start:phone_end] = phone_durations
+        found[phone_start:phone_end] = True
+
+    if (num_missing > 0) or (num_mismatched > 0):
+        _LOGGER.warning(
+            "Using equal phone shares of word durations for %s utterance(s) missing from phone CTM and %s that don't match their word alignment",
+            num_missing,
+            num_mismatched,
+        )
+
+    return durations, found
+
+
+def get_phone_durations(
+    alignments: Alignments,
+    frame_shift: float = 0.01,
+    ignore_words: typing.Optional[typing.Iterable[str]] = None,
+    silence_phones: typing.Optional[typing.Iterable[str]] = None,
+    utt_phones: typing.Optional[UttPhones] = None,
+) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, typing.List[str]]:
+    """Get utterance index, phone id, and duration (seconds) of scored phones.
+
+    Durations come from utt_phones (see load_phone_ctm) when given. Other
+    phones get an equal share of their word's frames.
+
+    Phones are stripped of word position (a_B -> a). Silence phones and
+    phones of ignored words are left out. Returns phone names too.
+    """
+    ignore_words = set(DEFAULT_IGNORE_WORDS if ignore_words is None else ignore_words)
+    silence_phones = set(
+        DEFAULT_SILENCE_PHONES if silence_phones is None else silence_phones
+    )
+
+    # a_B -> a
+    base_phones: typing.Dict[str, int] = {}
+    phone_bases = np.array(
+        [
+            base_phones.setdefault(p.split("_")[0], len(base_phones))
+            for p in alignments.phones
+        ],
+        dtype=np.int32,
+    )
+    phone_names = list(base_phones.keys())
+
+    num_words = len(alignments.word_ids)
+    word_num_phones = np.diff(alignments.phone_offsets)
+    word_utts = np.repeat(
+        np.arange(alignments.num_utterances), np.diff(alignments.utt_offsets)
+    )
+
+    # Word of each phone
+    phone_words = np.repeat(np.arange(num_words), word_num_phones)
+
+    # Equal share of the word's frames
+    phone_durations = (
+        alignments.num_frames[phone_words] / word_num_phones[phone_words]
+    ) * frame_shift
+
+    if utt_phones is not None:
+        ctm_durations, in_ctm = get_ctm_durations(alignments, utt_phones)
+        phone_durations[in_ctm] = ctm_durations[in_ctm]
+
+    phone_ids = phone_bases[alignments.phone_ids]
+
+    is_ignored_word = np.array(
+        [w in ignore_words for w in alignments.words], dtype=bool
+    )
+    is_silence_phone = np.array([p in silence_phones for p in phone_names], dtype=bool)
+
+    if len(phone_ids) > 0:
+        keep = ~(
+            is_ignored_word[alignments.word_ids[phone_words]]
+            | is_silence_phone[phone_ids]
+        )
+    else:
+        keep = np.zeros(0, dtype=bool)
+
+    return (
+        word_utts[phone_words][keep],
+        phone_ids[keep],
+        phone_durations[keep],
+        phone_names,
+    )
+
+
+def score_alignments(
+    alignments: Alignments,
+    thresholds: typing.Optional[AlignmentThresholds] = None,
+    frame_shift: float = 0.01,
+    ignore_words: typing.Optional[typing.Iterable[str]] = None,
+    silence_phones: typing.Optional[typing.Iterable[str]] = None,
+    utt_phones: typing.Optional[UttPhones] = None,
+) -> typing.Tuple[PhoneStats, UtteranceScores]:
+    """Compute phone duration distributions and score every utterance"""
+    thresholds = thresholds or AlignmentThresholds()
+    phone_utts, phone_ids, durations, phone_names = get_phone_durations(
+        alignments,
+        frame_shift=frame_shift,
+        ignore_words=ignore_words,
+        silence_phones=silence_phones,
+        utt_phones=utt_phones,
+    )
+
+    num_phones = len(phone_names)
+    num_utts = alignments.num_utterances
+
+    _LOGGER.debug("Scoring %s phone(s) in %s utterance(s)", len(phone_ids), num_utts)
+
+    # Phone distributions
+    log_durations = np.log(np.maximum(durations, 1e-6))
+    duration_quantiles = group_quantiles(
+        phone_ids, durations, num_phones, [0.05, 0.5, 0.95]
+    )
+    log_medians = group_quantiles(phone_ids, log_durations, num_phones, [0.5])[:, 0]
+    log_mads = group_quantiles(
+        phone_ids, np.abs(log_durations - log_medians[phone_ids]), num_phones, [0.5],
+    )[:, 0]
+
+    phone_stats = PhoneStats(
+        phones=phone_names,
+        counts=np.bincount(phone_ids, minlength=num_phones),
+        p05_sec=duration_quantiles[:, 0],
+        median_sec=duration_quantiles[:, 1],
+        p95_sec=duration_quantiles[:, 2],
+        log_mad=log_mads,
+    )
+
+    # Robust z-score of each phone
+    abs_z = np.abs(
+        _MAD_SCALE
+        * (log_durations - log_medians[phone_ids])
+        / np.maximum(np.nan_to_num(log_mads[phone_ids]), thresholds.min_mad)
+    )
+    is_outlier = abs_z > thresholds.max_abs_z
+    is_too_long = durations > thresholds.max_phone_sec
+    # Small tolerance for rounding of CTM times
+    is_too_short = (durations < thresholds.min_phone_sec) | (
+        durations < ((thresholds.min_phone_frames - 0.01) * frame_shift)
+    )
+
+    # Per utterance
+    utt_num_phones = np.bincount(phone_utts, minlength=num_utts)
+    utt_num_outliers = np.bincount(phone_utts, weights=is_outlier, minlength=num_utts)
+    utt_num_too_long = np.bincount(phone_utts, weights=is_too_long, minlength=num_utts)
+    utt_num_too_short = np.bincount(
+        phone_utts, weights=is_too_short, minlength=num_utts
+    )
+
+    utt_max_abs_z = np.zeros(num_utts)
+    np.maximum.at(utt_max_abs_z, phone_utts, abs_z)
+
+    utt_longest = np.zeros(num_utts)
+    np.maximum.at(utt_longest, phone_utts, durations)
+
+    too_many_outliers = (
+        utt_num_outliers / np.maximum(utt_num_phones, 1)
+    ) > thresholds.max_outlier_ratio
+    excluded = (utt_num_too_long > 0) | (utt_num_too_short > 0) | too_many_outliers
+
+    utt_scores = UtteranceScores(
+        utt_ids=alignments.utt_ids,
+        num_phones=utt_num_phones,
+        num_outliers=utt_num_outliers.astype(np.int64),
+        num_too_long=utt_num_too_long.astype(np.int64),
+        num_too_short=utt_num_too_short.astype(np.int64),
+        max_abs_z=utt_max_abs_z,
+        longest_phone_sec=utt_longest,
+        too_many_outliers=too_many_outliers,
+        excluded=excluded,
+    )
+
+    return phone_stats, utt_scores
+
+
+# -----------------------------------------------------------------------------
+
+# (path, start_ms, end_ms)
+SourceKey = typing.Tuple[str, typing.Optional[int], typing.Optional[int]]
+
+
+def _parse_ms(value: str) -> typing.Optional[int]:
+    return int(value) if value else None
+
+
+def read_utt2source(utt2source_path: Path) -> typing.Dict[str, SourceKey]:
+    """Read data/local/utt2source.tsv from write_test_train"""
+    utt_sources: typing.Dict[str, SourceKey] = {}
+    with open(utt2source_path, "r") as utt2source_file:
+        for row in csv.DictReader(utt2source_file, delimiter="\t"):
+            utt_sources[row["utt_id"]] = (
+                row["path"],
+                _parse_ms(row["start_ms"]),
+                _parse_ms(row["end_ms"]),
+            )
+
+    return utt_sources
+
+
+def get_source_utt_id(utt_id: str) -> str:
+    """Get id of original utterance for speed-perturbed/noisy variants"""
+    utt_id = _SP_PREFIX.sub("", utt_id)
+    if utt_id.endswith(_NOISY_SUFFIX):
+        utt_id = utt_id[: -len(_NOISY_SUFFIX)]
+
+    return utt_id
+
+
+def read_exclusions(exclude_path: typing.Union[str, Path]) -> typing.Set[SourceKey]:
+    """Read (path, start_ms, end_ms) of excluded items"""
+    exclusions: typing.Set[SourceKey] = set()
+    with open(exclude_path, "r") as exclude_file:
+        for row in csv.DictReader(exclude_file, delimiter="\t"):
+            if row.get("path"):
+                exclusions.add(
+                    (
+                        str(Path(row["path"]).absolute()),
+                        _parse_ms(row.get("start_ms", "")),
+                        _parse_ms(row.get("end_ms", "")),
+                    )
+                )
+
+    return exclusions
+
+
+def write_exclusions(
+    exclude_file: typing.TextIO,
+    utt_scores: UtteranceScores,
+    utt_sources: typing.Mapping[str, SourceKey],
+) -> int:
+    """Write excluded utterances by source audio. Returns number of sources."""
+    print(
+        "path", "start_ms", "end_ms", "utt_ids", "reasons", sep="\t", file=exclude_file
+    )
+
+    # source -> (utterance ids, reasons)
+    excluded_sources: typing.Dict[
+        SourceKey, typing.Tuple[typing.List[str], typing.Set[str]]
+    ] = {}
+    num_unknown = 0
+
+    for utt_index in np.flatnonzero(utt_scores.excluded):
+        utt_id = utt_scores.utt_ids[utt_index]
+        source = utt_sources.get(get_source_utt_id(utt_id))
+        if source is None:
+            num_unknown += 1
+            continue
+
+        source_utts, source_reasons = excluded_sources.setdefault(source, ([], set()))
+        source_utts.append(utt_id)
+        source_reasons.update(utt_scores.reasons(utt_index))
+
+    if num_unknown > 0:
+        _LOGGER.warning(
+            "No source audio for %s excluded utterance(s) (missing from utt2source.tsv)",
+            num_unknown,
+        )
+
+    for (path, start_ms, end_ms), (source_utts, source_reasons) in sorted(
+        excluded_sources.items(), key=lambda kv: str(kv[0])
+    ):
+        print(
+            path,
+            "" if start_ms is None else start_ms,
+            "" if end_ms is None else end_ms,
+            ",".join(source_utts),
+            ",".join(sorted(source_reasons)),
+            sep="\t",
+            file=exclude_file,
+        )
+
+    return len(excluded_sources)
+
+
+def write_phone_report(report_file: typing.TextIO, phone_stats: PhoneStats):
+    """Write tab-separated duration distribution of each phone"""
+    print(
+        "phone",
+        "count",
+        "p05_sec",
+        "median_sec",
+        "p95_sec",
+        "log_mad",
+        sep="\t",
+        file=report_file,
+    )
+
+    for phone_index in np.argsort(-phone_stats.counts, kind="stable"):
+        if phone_stats.counts[phone_index] == 0:
+            continue
+
+        print(
+            phone_stats.phones[phone_index],
+            phone_stats.counts[phone_index],
+            f"{phone_stats.p05_sec[phone_index]:.3f}",
+            f"{phone_stats.median_sec[phone_index]:.3f}",
+            f"{phone_stats.p95_sec[phone_index]:.3f}",
+            f"{phone_stats.log_mad[phone_index]:.4f}",
+            sep="\t",
+            file=report_file,
+        )
+
+
+def write_utterance_report(report_file: typing.TextIO, utt_scores: UtteranceScores):
+    """Write tab-separated scores of each utterance"""
+    field_names = [
+        f.name
+        for f in dataclasses.fields(UtteranceScores)
+        if f.name not in {"utt_ids", "too_many_outliers", "excluded"}
+    ]
+    print("utt_id", "status", *field_names, sep="\t", file=report_file)
+
+    for utt_index, utt_id in enumerate(utt_scores.utt_ids):
+        values = [getattr(utt_scores, name)[utt_index] for name in field_names]
+        print(
+            utt_id,
+            "excluded" if utt_scores.excluded[utt_index] else "ok",
+            *[f"{v:.4f}" if isinstance(v, np.floating) else v for v in values],
+            sep="\t",
+            file=report_file,
+        )
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi alignment-qa"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi alignment-qa")
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="Directories with phones.JOB.gz (and phone_ctm.JOB.gz) from get_phones.sh, the files themselves, or .npz from ipa2kaldi alignments",
+    )
+    parser.add_argument(
+        "--phone-ctm",
+        action="append",
+        default=[],
+        help="phone_ctm.JOB.gz file from get_phones.sh (or a directory with them) for phone durations (default: found in input directories)",
+    )
+    parser.add_argument(
+        "--recipe-dir", default=".", help="Path to Kaldi recipe (default: .)"
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="Directory to write exclude.tsv and reports (default: <RECIPE>/data/local/alignment_qa)",
+    )
+    parser.add_argument(
+        "--frame-shift",
+        type=float,
+        default=0.01,
+        help="Seconds per alignment frame (default: 0.01, use 0.03 for chain models)",
+    )
+    parser.add_argument(
+        "--threshold",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Override threshold (e.g., max_phone_sec=2)",
+    )
+    parser.add_argument(
+        "--ignore-word",
+        action="append",
+        help=f"Word whose phones aren't scored (default: {' '.join(DEFAULT_IGNORE_WORDS)})",
+    )
+    parser.add_argument(
+        "--silence-phone",
+        action="append",
+        help=f"Phone that isn't scored (default: {' '.join(DEFAULT_SILENCE_PHONES)})",
+    )
+    parser.add_argument("--jobs", type=int, help="Number of files to parse in parallel")
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    recipe_dir = Path(args.recipe_dir)
+    output_dir = (
+        Path(args.output_dir)
+        if args.output_dir
+        else recipe_dir / "data" / "local" / "alignment_qa"
+    )
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    thresholds = AlignmentThresholds()
+    for setting in args.threshold:
+        name, _, value = setting.partition("=")
+        if not hasattr(thresholds, name):
+            parser.error(f"Unknown threshold: {name}")
+
+        try:
+            setattr(thresholds, name, float(value))
+        except ValueError:
+            parser.error(f"Threshold {name} must be a number, got {value!r}")
+
+    # Load alignments
+    npz_paths: typing.List[Path] = []
+    phones_paths: typing.List[Path] = []
+    ctm_paths: typing.List[Path] = []
+    for input_str in args.inputs:
+        input_path = Path(input_str)
+        if input_path.is_dir():
+            phones_paths.extend(find_phones_files(input_path))
+            ctm_paths.extend(find_phone_ctm_files(input_path))
+        elif input_path.suffix == ".npz":
+            npz_paths.append(input_path)
+        else:
+            phones_paths.append(input_path)
+
+    for ctm_str in args.phone_ctm:
+        ctm_path = Path(ctm_str)
+        if ctm_path.is_dir():
+            ctm_paths.extend(find_phone_ctm_files(ctm_path))
+        else:
+            ctm_paths.append(ctm_path)
+
+    if npz_paths and phones_paths:
+        parser.error("Can't mix .npz and phones files")
+
+    if len(npz_paths) > 1:
+        parser.error("Only one .npz file is supported")
+
+    if npz_paths:
+        alignments = Alignments.load(npz_paths[0])
+    else:
+        alignments = load_alignments(phones_paths, max_workers=args.jobs)
+
+    utt_phones = None
+    if ctm_paths:
+        utt_phones = load_phone_ctm(ctm_paths, max_workers=args.jobs)
+    else:
+        _LOGGER.warning(
+            "No phone_ctm files (re-run get_phones.sh). Using equal phone shares of word durations."
+        )
+
+    phone_stats, utt_scores = score_alignments(
+        alignments,
+        thresholds=thresholds,
+        frame_shift=args.frame_shift,
+        ignore_words=args.ignore_word,
+        silence_phones=args.silence_phone,
+        utt_phones=utt_phones,
+    )
+
+    with open(output_dir / "phones.tsv", "w") as phone_report_file:
+        write_phone_report(phone_report_file, phone_stats)
+
+    with open(output_dir / "utterances.tsv", "w") as utt_report_file:
+        write_utterance_report(utt_report_file, utt_scores)
+
+    utt2source_path = recipe_dir / "data" / "local" / "utt2source.tsv"
+    utt_sources: typing.Dict[str, SourceKey] = {}
+    if utt2source_path.is_file():
+        utt_sources = read_utt2source(utt2source_path)
+    else:
+        _LOGGER.warning("Missing %s (re-run ipa2kaldi to create it)", utt2source_path)
+
+    exclude_path = output_dir / "exclude.tsv"
+    with open(exclude_path, "w") as exclude_file:
+        num_sources = write_exclusions(exclude_file, utt_scores, utt_sources)
+
+    _LOGGER.info(
+        "Excluded %s of %s utterance(s) (%s source item(s)): %s",
+        int(utt_scores.excluded.sum()),
+        alignments.num_utterances,
+        num_sources,
+        exclude_path,
+    )
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""Columnar storage for word/phone alignments from get_phones.sh"""
+import argparse
+import json
+import logging
+import sys
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from .utils import maybe_gzip_open
+
+_LOGGER = logging.getLogger("ipa2kaldi.alignments")
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class Alignments:
+    """Word alignments with phones stored as flat arrays.
+
+    Words of utterance i are utt_offsets[i]:utt_offsets[i+1].
+    Phones of word j are phone_offsets[j]:phone_offsets[j+1].
+    """
+
+    utt_ids: typing.List[str] = field(default_factory=list)
+    words: typing.List[str] = field(default_factory=list)
+    phones: typing.List[str] = field(default_factory=list)
+
+    utt_offsets: np.ndarray = field(default_factory=lambda: np.zeros(1, dtype=np.int64))
+    word_ids: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int32))
+    start_frames: np.ndarray = field(
+        default_factory=lambda: np.zeros(0, dtype=np.int32)
+    )
+    num_frames: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int32))
+    phone_offsets: np.ndarray = field(
+        default_factory=lambda: np.zeros(1, dtype=np.int64)
+    )
+    phone_ids: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int32))
+
+    @property
+    def num_utterances(self) -> int:
+        """Number of aligned utterances"""
+        return len(self.utt_ids)
+
+    def save(self, npz_path: typing.Union[str, Path]):
+        """Write arrays to a compressed .npz file"""
+        np.savez_compressed(
+            npz_path,
+            utt_ids=np.array(self.utt_ids, dtype=str),
+            words=np.array(self.words, dtype=str),
+            phones=np.array(self.phones, dtype=str),
+            utt_offsets=self.utt_offsets,
+            word_ids=self.word_ids,
+            start_frames=self.start_frames,
+            num_frames=self.num_frames,
+            phone_offsets=self.phone_offsets,
+            phone_ids=self.phone_ids,
+        )
+
+    @staticmethod
+    def load(npz_path: typing.Union[str, Path]) -> "Alignments":
+        """Read arrays from an .npz file written by save"""
+        with np.load(npz_path) as npz:
+            return Alignments(
+                utt_ids=npz["utt_ids"].tolist(),
+                words=npz["words"].tolist(),
+                phones=npz["phones"].tolist(),
+                utt_offsets=npz["utt_offsets"],
+                word_ids=npz["word_ids"],
+                start_frames=npz["start_frames"],
+                num_frames=npz["num_frames"],
+                phone_offsets=npz["phone_offsets"],
+                phone_ids=npz["phone_ids"],
+            )
+
+
+# -----------------------------------------------------------------------------
+
+
+def read_phones_file(phones_path: typing.Union[str, Path]) -> Alignments:
+    """Parse a phones.JOB.gz file from get_phones.sh.
+
+    Each line is: utt_id start_frame num_frames word phone1 phone2 ...
+    Lines for the same utterance must be consecutive.
+    """
+    utt_ids: typing.List[str] = []
+    word_index: typing.Dict[str, int] = {}
+    phone_index: typing.Dict[str, int] = {}
+
+    utt_offsets: typing.List[int] = [0]
+    word_ids: typing.List[int] = []
+    start_frames: typing.List[int] = []
+    num_frames: typing.List[int] = []
+    phone_offsets: typing.List[int] = [0]
+    phone_ids: typing.List[int] = []
+
+    with maybe_gzip_open(phones_path, "r") as phones_file:
+        for line in phones_file:
+            parts = line.split()
+            if not parts:
+                continue
+
+            if (not utt_ids) or (parts[0] != utt_ids[-1]):
+                if utt_ids:
+                    utt_offsets.append(len(word_ids))
+
+                utt_ids.append(parts[0])
+
+            start_frames.append(int(parts[1]))
+            num_frames.append(int(parts[2]))
+            word_ids.append(word_index.setdefault(parts[3], len(word_index)))
+
+            for phone in parts[4:]:
+                phone_ids.append(phone_index.setdefault(phone, len(phone_index)))
+
+            phone_offsets.append(len(phone_ids))
+
+    if utt_ids:
+        utt_offsets.append(len(word_ids))
+
+    return Alignments(
+        utt_ids=utt_ids,
+        words=list(word_index.keys()),
+        phones=list(phone_index.keys()),
+        utt_offsets=np.array(utt_offsets, dtype=np.int64),
+        word_ids=np.array(word_ids, dtype=np.int32),
+        start_frames=np.array(start_frames, dtype=np.int32),
+        num_frames=np.array(num_frames, dtype=np.int32),
+        phone_offsets=np.array(phone_offsets, dtype=np.int64),
+        phone_ids=np.array(phone_ids, dtype=np.int32),
+    )
+
+
+def merge_alignments(parts: typing.Iterable[Alignments]) -> Alignments:
+    """Concatenate alignments, remapping each part's word/phone ids"""
+    merged = Alignments()
+    word_index: typing.Dict[str, int] = {}
+    phone_index: typing.Dict[str, int] = {}
+
+    utt_offsets = [merged.utt_offsets]
+    word_ids = []
+    start_frames = []
+    num_frames = []
+    phone_offsets = [merged.phone_offsets]
+    phone_ids = []
+
+    num_words = 0
+    num_phones = 0
+
+    for part in parts:
+        word_map = np.array(
+            [word_index.setdefault(w, len(word_index)) for w in part.words],
+            dtype=np.int32,
+        )
+        phone_map = np.array(
+            [phone_index.setdefault(p, len(phone_index)) for p in part.phones],
+            dtype=np.int32,
+        )
+
+        merged.utt_ids.extend(part.utt_ids)
+        utt_offsets.append(part.utt_offsets[1:] + num_words)
+        word_ids.append(word_map[part.word_ids])
+        start_frames.append(part.start_frames)
+        num_frames.append(part.num_frames)
+        phone_offsets.append(part.phone_offsets[1:] + num_phones)
+        phone_ids.append(phone_map[part.phone_ids])
+
+        num_words += len(part.word_ids)
+        num_phones += len(part.phone_ids)
+
+    merged.words = list(word_index.keys())
+    merged.phones = list(phone_index.keys())
+    merged.utt_offsets = np.concatenate(utt_offsets)
+    merged.phone_offsets = np.concatenate(phone_offsets)
+
+    if word_ids:
+        merged.word_ids = np.concatenate(word_ids)
+        merged.start_frames = np.concatenate(start_frames)
+        merged.num_frames = np.concatenate(num_frames)
+        merged.phone_ids = np.concatenate(phone_ids)
+
+    return merged
+
+
+def load_alignments(
+    phones_paths: typing.Iterable[typing.Union[str, Path]],
+    max_workers: typing.Optional[int] = None,
+) -> Alignments:
+    """Parse phones.JOB.gz files in parallel and merge them in order"""
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return merge_alignments(executor.map(read_phones_file, phones_paths))
+
+
+def find_phones_files(phones_dir: Path) -> typing.List[Path]:
+    """Get phones.JOB.gz files (or concatenated phones file) in job order"""
+    job_paths = list(phones_dir.glob("phones.*.gz"))
+    if job_paths:
+        return sorted(job_paths, key=lambda p: int(p.name.split(".")[1]))
+
+    concatenated_path = phones_dir / "phones"
+    if concatenated_path.is_file():
+        return [concatenated_path]
+
+    return []
+
+
+def iter_json(
+    alignments: Alignments, strip_position: bool = True
+) -> typing.Iterable[typing.Dict[str, typing.Any]]:
+    """Yield one object per utterance in the format of bin/phones2json.py"""
+    phones = alignments.phones
+    if strip_position:
+        # a_B -> a
+        phones = [p.split("_")[0] for p in phones]
+
+    for utt_index, utt_id in enumerate(alignments.utt_ids):
+        prons = []
+        for word_index in range(
+            int(alignments.utt_offsets[utt_index]),
+            int(alignments.utt_offsets[utt_index + 1]),
+        ):
+            phone_ids = alignments.phone_ids[
+                int(alignments.phone_offsets[word_index]) : int(
+                    alignments.phone_offsets[word_index + 1]
+                )
+            ]
+            prons.append(
+                {
+                    "start_frame": int(alignments.start_frames[word_index]),
+                    "num_frames": int(alignments.num_frames[word_index]),
+                    "word": alignments.words[int(alignments.word_ids[word_index])],
+                    "phones": [phones[int(p)] for p in phone_ids],
+                }
+            )
+
+        yield {"utt_id": utt_id, "prons": prons}
+
+
+def write_json(alignments: Alignments, output_file: typing.TextIO):
+    """Write one JSON object per line for each utterance"""
+    for utt_obj in iter_json(alignments):
+        json.dump(utt_obj, output_file, ensure_ascii=False)
+        print("", file=output_file)
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi alignments"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi alignments")
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="Directories with phones.JOB.gz from get_phones.sh (or the files themselves)",
+    )
+    parser.add_argument(
+        "--output", help="Path to write .npz file (or JSON lines, default: stdout)"
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Write JSON lines like bin/phones2json.py instead of .npz",
+    )
+    parser.add_argument("--jobs", type=int, help="Number of files to parse in parallel")
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    phones_paths: typing.List[Path] = []
+    for input_str in args.inputs:
+        input_path = Path(input_str)
+        if input_path.is_dir():
+            phones_paths.extend(find_phones_files(input_path))
+        else:
+            phones_paths.append(input_path)
+
+    _LOGGER.debug("Loading alignments from %s file(s)", len(phones_paths))
+    alignments = load_alignments(phones_paths, max_workers=args.jobs)
+    _LOGGER.info(
+        "Loaded %s utterance(s), %s word(s), %s phone(s)",
+        alignments.num_utterances,
+        len(alignments.word_ids),
+        len(alignments.phone_ids),
+    )
+
+    if args.json:
+        if args.output:
+            with open(args.output, "w") as output_file:
+                write_json(alignments, output_file)
+        else:
+            write_json(alignments, sys.stdout)
+    else:
+        if not args.output:
+            parser.error("--output is required for .npz")
+
+        alignments.save(args.output)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""Streaming reading, filtering, and writing of ARPA language models"""
+import argparse
+import logging
+import math
+import shutil
+import tempfile
+import typing
+from pathlib import Path
+
+from .utils import maybe_gzip_open
+
+_LOGGER = logging.getLogger("ipa2kaldi.arpa")
+
+BOS = "<s>"
+EOS = "</s>"
+
+# log10 probability for impossible words (e.g., <s>)
+LOG_ZERO = -99.0
+
+# Smallest probability mass used in logarithms
+_MIN_MASS = 1e-12
+
+# (order, log10 probability, n-gram, log10 backoff weight)
+ArpaNGram = typing.Tuple[int, float, str, typing.Optional[float]]
+
+# -----------------------------------------------------------------------------
+
+
+class ArpaReader:
+    """Reads the header of an ARPA file, then streams its n-grams"""
+
+    def __init__(self, arpa_file: typing.IO[str]):
+        self.arpa_file = arpa_file
+
+        # Number of n-grams for each order (from header)
+        self.counts: typing.List[int] = []
+        self._order = 0
+
+        self._read_header()
+
+    @property
+    def max_order(self) -> int:
+        """Highest n-gram order in the header"""
+        return len(self.counts)
+
+    def ngrams(self) -> typing.Iterable[ArpaNGram]:
+        """Yield (order, log10 prob, n-gram, log10 backoff) for each n-gram"""
+        for line in self.arpa_file:
+            line = line.strip()
+            if not line:
+                continue
+
+            if line.startswith("\\"):
+                if line == "\\end\\":
+                    break
+
+                # \N-grams:
+                self._order = int(line[1:].split("-", maxsplit=1)[0])
+                continue
+
+            parts = line.split()
+            log_prob = float(parts[0])
+            words = parts[1 : 1 + self._order]
+            bow: typing.Optional[float] = None
+            if len(parts) > (1 + self._order):
+                bow = float(parts[1 + self._order])
+
+            yield self._order, log_prob, " ".join(words), bow
+
+    def _read_header(self):
+        for line in self.arpa_file:
+            line = line.strip()
+            if line.startswith("ngram "):
+                # ngram N=count
+                _, count_str = line[6:].split("=", maxsplit=1)
+                self.counts.append(int(count_str))
+            elif line.startswith("\\") and line.endswith("-grams:"):
+                self._order = int(line[1:].split("-", maxsplit=1)[0])
+                break
+
+
+class ArpaWriter:
+    """Writes n-grams to an ARPA file.
+
+    Sections are buffered in temporary files until closed, since the header
+    needs the number of n-grams of each order.
+    """
+
+    def __init__(
+        self,
+        arpa_path: typing.Union[str, Path],
+        temp_dir: typing.Optional[typing.Union[str, Path]] = None,
+    ):
+        self.arpa_path = arpa_path
+        self.temp_dir = tempfile.TemporaryDirectory(
+            prefix="ipa2kaldi-arpa-", dir=temp_dir
+        )
+
+        self.counts: typing.List[int] = []
+        self._section_files: typing.List[typing.TextIO] = []
+
+    def write(
+        self,
+        order: int,
+        log_prob: float,
+        ngram: str,
+        bow: typing.Optional[float] = None,
+    ):
+        """Add an n-gram to the section for its order"""
+        while len(self._section_files) < order:
+            self._section_files.append(
+                open(
+                    Path(self.temp_dir.name) / f"{len(self._section_files) + 1}.txt",
+                    "w+",
+                )
+            )
+            self.counts.append(0)
+
+        section_file = self._section_files[order - 1]
+        if bow is None:
+            print(f"{log_prob:.6f}", ngram, sep="\t", file=section_file)
+        else:
+            print(f"{log_prob:.6f}", ngram, f"{bow:.6f}", sep="\t", file=section_file)
+
+        self.counts[order - 1] += 1
+
+    def close(self):
+        """Write header and sections to the ARPA file"""
+        try:
+            with maybe_gzip_open(self.arpa_path, "w") as arpa_file:
+                print("", file=arpa_file)
+                print("\\data\\", file=arpa_file)
+                for order, count in enumerate(self.counts, start=1):
+                    print(f"ngram {order}={count}", file=arpa_file)
+
+                for order, section_file in enumerate(self._section_files, start=1):
+                    print("", file=arpa_file)
+                    print(f"\\{order}-grams:", file=arpa_file)
+                    section_file.seek(0)
+                    shutil.copyfileobj(section_file, arpa_file)
+
+                print("", file=arpa_file)
+                print("\\end\\", file=arpa_file)
+        finally:
+            for section_file in self._section_files:
+                section_file.close()
+
+            self.temp_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BackoffModel:
+    """In-memory n-grams of an ARPA language model with backoff lookups"""
+
+    def __init__(self):
+        # n-gram -> (log10 prob, log10 backoff) for each order
+        self.orders: typing.List[typing.Dict[str, typing.Tuple[float, float]]] = []
+
+    def add(self, order: int, log_prob: float, ngram: str, bow: float = 0.0):
+        """Add an n-gram"""
+        while len(self.orders) < order:
+            self.orders.append({})
+
+        self.orders[order - 1][ngram] = (log_prob, bow)
+
+    def log_prob(self, words: typing.Sequence[str]) -> float:
+        """Get log10 p(w|h) for words = h + [w], backing off as needed"""
+        log_bow = 0.0
+        for start in range(len(words)):
+            order = len(words) - start
+            if order <= len(self.orders):
+                entry = self.orders[order - 1].get(" ".join(words[start:]))
+                if entry is not None:
+                    return log_bow + entry[0]
+
+            if 1 < order <= (len(self.orders) + 1):
+                context_entry = self.orders[order - 2].get(" ".join(words[start:-1]))
+                if context_entry is not None:
+                    log_bow += context_entry[1]
+
+        return LOG_ZERO
+
+    def context_prob(self, context: typing.Sequence[str]) -> float:
+        """Get p(h) by the chain rule, with p(<s>) = 1"""
+        log_prob = 0.0
+        for i, word in enumerate(context):
+            if (i == 0) and (word == BOS):
+                continue
+
+            log_prob += self.log_prob(context[: i + 1])
+
+        return 10 ** log_prob
+
+
+# -----------------------------------------------------------------------------
+
+
+def filter_arpa(
+    src_path: typing.Union[str, Path],
+    dest_path: typing.Union[str, Path],
+    vocabulary: typing.Container[str],
+    temp_dir: typing.Optional[typing.Union[str, Path]] = None,
+) -> typing.List[int]:
+    """Filter an ARPA language model for arpa2fst in a single pass.
+
+    Drops n-grams with words outside of vocabulary, and degenerate n-grams
+    with <s> anywhere but the start or </s> anywhere but the end (<s> <s>,
+    </s> <s>, etc.). Unigram probabilities are re-normalized and backoff
+    weights are recomputed, so each context still has a proper distribution
+    over the kept words (like SRILM's ngram -limit-vocab -renorm).
+
+    The highest order is streamed, while lower orders are kept in memory for
+    backoff lookups.
+
+    Returns the number of n-grams kept for each order.
+    """
+    model = BackoffModel()
+
+    # context -> [sum p(w|h), sum p(w|h')] over kept words
+    context_sums: typing.Dict[str, typing.List[float]] = {}
+
+    num_dropped = 0
+    num_orphans = 0
+
+    with maybe_gzip_open(src_path, "r") as src_file:
+        reader = ArpaReader(src_file)
+        max_order = reader.max_order
+
+        with ArpaWriter(dest_path, temp_dir=temp_dir) as writer:
+            current_order = 1
+
+            for order, log_prob, ngram, _ in reader.ngrams():
+                if order != current_order:
+                    # Lower orders are complete, so backoff lookups can use them
+                    _renormalize(model, context_sums, current_order)
+                    current_order = order
+
+                words = ngram.split(" ")
+                if (
+                    any(w not in vocabulary for w in words)
+                    or (BOS in words[1:])
+                    or (EOS in words[:-1])
+                ):
+                    num_dropped += 1
+                    continue
+
+                if order > 1:
+                    context = " ".join(words[:-1])
+                    if (len(model.orders) < (order - 1)) or (
+                        context not in model.orders[order - 2]
+                    ):
+                        # No history state to extend in arpa2fst
+                        num_orphans += 1
+                        continue
+
+                    sums = context_sums.get(context)
+                    if sums is None:
+                        sums = [0.0, 0.0]
+                        context_sums[context] = sums
+
+                    sums[0] += 10 ** log_prob
+                    sums[1] += 10 ** model.log_prob(words[1:])
+
+                if (order < max_order) or (order == 1):
+                    model.add(order, log_prob, ngram)
+                else:
+                    writer.write(order, log_prob, ngram)
+
+            _renormalize(model, context_sums, current_order)
+
+            for order, ngrams in enumerate(model.orders, start=1):
+                for ngram, (log_prob, bow) in ngrams.items():
+                    writer.write(order, log_prob, ngram, bow if bow != 0 else None)
+
+        if num_orphans > 0:
+            _LOGGER.warning(
+                "Dropped %s n-gram(s) without a lower order history in %s",
+                num_orphans,
+                src_path,
+            )
+
+        _LOGGER.debug(
+            "Filtered %s: kept %s n-gram(s), dropped %s",
+            src_path,
+            writer.counts,
+            num_dropped + num_orphans,
+        )
+
+    return writer.counts
+
+
+def _renormalize(
+    model: BackoffModel, context_sums: typing.Dict[str, typing.List[float]], order: int,
+):
+    """Fix probabilities once all kept n-grams of an order have been added.
+
+    Unigrams are scaled to sum to 1. For higher orders, the backoff weights
+    of their contexts (order - 1) get the probability mass that is left over.
+    """
+    if order == 1:
+        unigrams = model.orders[0] if model.orders else {}
+        total_prob = sum(
+            10 ** log_prob for word, (log_prob, _) in unigrams.items() if word != BOS
+        )
+
+        if total_prob > 0:
+            log_total = math.log10(total_prob)
+            for word, (log_prob, bow) in unigrams.items():
+                if word != BOS:
+                    unigrams[word] = (log_prob - log_total, bow)
+
+        return
+
+    if len(model.orders) < (order - 1):
+        # No n-grams of the context order
+        return
+
+    contexts = model.orders[order - 2]
+    for context, (log_prob, _) in contexts.items():
+        bow = 0.0
+        sums = context_sums.pop(context, None)
+        if sums is not None:
+            # bow(h) = (1 - sum p(w|h)) / (1 - sum p(w|h'))
+            bow = math.log10(max(1 - sums[0], _MIN_MASS) / max(1 - sums[1], _MIN_MASS))
+
+        contexts[context] = (log_prob, bow)
+
+
+def read_vocabulary(words_path: typing.Union[str, Path]) -> typing.Set[str]:
+    """Read words from first column of a lexicon or words.txt file"""
+    vocabulary: typing.Set[str] = set()
+    with maybe_gzip_open(words_path, "r") as words_file:
+        for line in words_file:
+            parts = line.split(maxsplit=1)
+            if parts:
+                vocabulary.add(parts[0])
+
+    return vocabulary
+
+
+def write_vocabulary(
+    words_path: typing.Union[str, Path], vocabulary: typing.Iterable[str]
+):
+    """Write words one per line in C locale sort order"""
+    with maybe_gzip_open(words_path, "w") as words_file:
+        for word in sorted(vocabulary):
+            print(word, file=words_file)
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi arpa-filter"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi arpa-filter")
+    parser.add_argument("input", help="ARPA language model to filter (may be .gz)")
+    parser.add_argument("output", help="Path to write filtered ARPA language model")
+    parser.add_argument(
+        "--vocabulary",
+        required=True,
+        action="append",
+        help="Lexicon or words.txt whose first column has the words to keep",
+    )
+    parser.add_argument("--temp-dir", help="Directory for temporary files")
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    vocabulary = {BOS, EOS}
+    for words_path in args.vocabulary:
+        vocabulary.update(read_vocabulary(words_path))
+
+    counts = filter_arpa(args.input, args.output, vocabulary, temp_dir=args.temp_dir)
+    _LOGGER.info("Wrote %s n-gram(s) to %s", sum(counts), args.output)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
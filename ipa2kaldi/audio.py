@@ -0,0 +1,376 @@
+"""Audio file probing and caching for ipa2kaldi"""
+import json
+import logging
+import os
+import struct
+import subprocess
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+_LOGGER = logging.getLogger("ipa2kaldi.audio")
+
+# WAVE format tags
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class AudioInfo:
+    """Format details of an audio file"""
+
+    codec: str
+    sample_rate: int
+    channels: int
+    sample_width: int
+    duration_sec: float
+
+    # Byte offset of PCM data in WAV files (0 if unknown)
+    data_offset: int = 0
+
+
+def probe_wav(audio_path: typing.Union[str, Path]) -> typing.Optional[AudioInfo]:
+    """Get format details from a PCM WAV header (None if not a PCM WAV file)"""
+    with open(audio_path, "rb") as audio_file:
+        riff_header = audio_file.read(12)
+        if (
+            (len(riff_header) < 12)
+            or (riff_header[:4] != b"RIFF")
+            or (riff_header[8:12] != b"WAVE")
+        ):
+            return None
+
+        # Contents of fmt chunk (empty until it's been read)
+        fmt_bytes = b""
+
+        while True:
+            chunk_header = audio_file.read(8)
+            if len(chunk_header) < 8:
+                # No data chunk
+                return None
+
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"fmt ":
+                fmt_bytes = audio_file.read(chunk_size)
+
+                if (chunk_size % 2) != 0:
+                    # Chunks are padded to even sizes
+                    audio_file.seek(1, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if len(fmt_bytes) < 16:
+                    return None
+
+                format_tag, channels, sample_rate, bits_per_sample = _parse_fmt(
+                    fmt_bytes
+                )
+                if (format_tag != _WAVE_FORMAT_PCM) or (sample_rate <= 0):
+                    return None
+
+                data_offset = audio_file.tell()
+                sample_width = bits_per_sample // 8
+                frame_size = max(1, sample_width * channels)
+
+                # Streamed WAVs (e.g. from ffmpeg pipes) may have a bogus size
+                file_size = os.fstat(audio_file.fileno()).st_size
+                data_size = min(chunk_size, file_size - data_offset)
+
+                return AudioInfo(
+                    codec=f"pcm_s{bits_per_sample}le",
+                    sample_rate=sample_rate,
+                    channels=channels,
+                    sample_width=sample_width,
+                    duration_sec=(data_size // frame_size) / sample_rate,
+                    data_offset=data_offset,
+                )
+            else:
+                audio_file.seek(chunk_size + (chunk_size % 2), os.SEEK_CUR)
+
+
+def _parse_fmt(fmt_bytes: bytes) -> typing.Tuple[int, int, int, int]:
+    """Get format tag, channels, sample rate, and bits per sample from fmt chunk"""
+    format_tag, channels, sample_rate, _, _, bits_per_sample = struct.unpack(
+        "<HHIIHH", fmt_bytes[:16]
+    )
+
+    if (format_tag == _WAVE_FORMAT_EXTENSIBLE) and (len(fmt_bytes) >= 26):
+        # First two bytes of sub-format GUID
+        (format_tag,) = struct.unpack("<H", fmt_bytes[24:26])
+
+    return format_tag, channels, sample_rate, bits_per_sample
+
+
+def probe_ffprobe(audio_path: typing.Union[str, Path]) -> AudioInfo:
+    """Get format details of any audio file (requires ffmpeg/ffprobe)"""
+    probe_json = subprocess.check_output(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "stream=codec_name,sample_rate,channels,bits_per_sample,duration:format=duration",
+            "-of",
+            "json",
+            str(audio_path),
+        ],
+        universal_newlines=True,
+    )
+
+    probe = json.loads(probe_json)
+    stream = probe["streams"][0]
+
+    duration_str = stream.get("duration")
+    if (not duration_str) or (duration_str == "N/A"):
+        # Some containers (e.g., Ogg) only have a format duration
+        duration_str = probe.get("format", {}).get("duration", "0")
+
+    return AudioInfo(
+        codec=stream.get("codec_name", ""),
+        sample_rate=int(stream.get("sample_rate", 0)),
+        channels=int(stream.get("channels", 0)),
+        sample_width=int(stream.get("bits_per_sample", 0)) // 8,
+        duration_sec=float(duration_str),
+    )
+
+
+def probe_audio(audio_path: typing.Union[str, Path]) -> AudioInfo:
+    """Get format details from WAV header, falling back to ffprobe"""
+    audio_info = probe_wav(audio_path)
+    if audio_info is None:
+        audio_info = probe_ffprobe(audio_path)
+
+    return audio_info
+
+
+def is_kaldi_wav(audio_info: typing.Optional[AudioInfo]) -> bool:
+    """True if audio is a 16-bit 16Khz mono PCM WAV file"""
+    return (
+        (audio_info is not None)
+        and (audio_info.codec == "pcm_s16le")
+        and (audio_info.sample_rate == 16000)
+        and (audio_info.channels == 1)
+        and (audio_info.data_offset > 0)
+    )
+
+
+def read_pcm(
+    audio_path: typing.Union[str, Path],
+    audio_info: typing.Optional[AudioInfo] = None,
+    start_ms: typing.Optional[int] = None,
+    end_ms: typing.Optional[int] = None,
+) -> np.ndarray:
+    """Decode (possibly trimmed) audio to 16-bit 16Khz mono samples.
+
+    WAV files already in this format are read directly. Everything else is
+    converted with ffmpeg, the same way as in wav.scp.
+    """
+    if is_kaldi_wav(audio_info):
+        assert audio_info is not None
+        start_frame = 0 if (start_ms is None) else (start_ms * 16)
+        num_frames = int(audio_info.duration_sec * 16000) - start_frame
+        if end_ms is not None:
+            num_frames = min(num_frames, (end_ms * 16) - start_frame)
+
+        if num_frames <= 0:
+            return np.zeros(0, dtype=np.int16)
+
+        return np.fromfile(
+            audio_path,
+            dtype="<i2",
+            count=num_frames,
+            offset=audio_info.data_offset + (start_frame * 2),
+        )
+
+    seek_trim: typing.List[str] = []
+    if start_ms is not None:
+        seek_trim.extend(["-ss", str(start_ms / 1000)])
+
+    if end_ms is not None:
+        duration_ms = end_ms - (start_ms or 0)
+        if duration_ms <= 0:
+            return np.zeros(0, dtype=np.int16)
+
+        seek_trim.extend(["-t", str(duration_ms / 1000)])
+
+    pcm_bytes = subprocess.check_output(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-nostdin",
+            "-i",
+            str(audio_path),
+            *seek_trim,
+            "-ar",
+            "16000",
+            "-ac",
+            "1",
+            "-acodec",
+            "pcm_s16le",
+            "-f",
+            "s16le",
+            "-",
+        ],
+        stderr=subprocess.DEVNULL,
+    )
+
+    return np.frombuffer(pcm_bytes, dtype="<i2")
+
+
+# -----------------------------------------------------------------------------
+
+
+class AudioCache:
+    """Audio format details for files, re-probed when a file's size or
+    modification time changes.
+
+    Stored as text with one file per line:
+    path|size|mtime_ns|codec|sample_rate|channels|sample_width|duration_sec|data_offset
+    """
+
+    def __init__(self, cache_path: typing.Optional[typing.Union[str, Path]] = None):
+        self.cache_path = Path(cache_path) if cache_path else None
+
+        # path -> (size, mtime_ns, info)
+        self.entries: typing.Dict[str, typing.Tuple[int, int, AudioInfo]] = {}
+        self.is_dirty = False
+
+    def load(self):
+        """Load cache file if it exists"""
+        if (self.cache_path is None) or (not self.cache_path.is_file()):
+            return
+
+        with open(self.cache_path, "r") as cache_file:
+            for line in cache_file:
+                line = line.rstrip("\n")
+                if not line:
+                    continue
+
+                try:
+                    (
+                        path_str,
+                        size_str,
+                        mtime_str,
+                        codec,
+                        rate_str,
+                        channels_str,
+                        width_str,
+                        duration_str,
+                        offset_str,
+                    ) = line.rsplit("|", maxsplit=8)
+
+                    self.entries[path_str] = (
+                        int(size_str),
+                        int(mtime_str),
+                        AudioInfo(
+                            codec=codec,
+                            sample_rate=int(rate_str),
+                            channels=int(channels_str),
+                            sample_width=int(width_str),
+                            duration_sec=float(duration_str),
+                            data_offset=int(offset_str),
+                        ),
+                    )
+                except ValueError:
+                    _LOGGER.warning("Bad line in %s: %s", self.cache_path, line)
+
+        _LOGGER.debug("Loaded %s cached audio file(s)", len(self.entries))
+
+    def save(self):
+        """Write cache file if anything has changed"""
+        if (self.cache_path is None) or (not self.is_dirty):
+            return
+
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_tmp_path = self.cache_path.with_suffix(".tmp")
+
+        with open(cache_tmp_path, "w") as cache_file:
+            for path_str, (size, mtime_ns, info) in sorted(self.entries.items()):
+                print(
+                    path_str,
+                    size,
+                    mtime_ns,
+                    info.codec,
+                    info.sample_rate,
+                    info.channels,
+                    info.sample_width,
+                    info.duration_sec,
+                    info.data_offset,
+                    sep="|",
+                    file=cache_file,
+                )
+
+        os.replace(cache_tmp_path, self.cache_path)
+        self.is_dirty = False
+
+    def get(self, audio_path: typing.Union[str, Path]) -> typing.Optional[AudioInfo]:
+        """Get cached details if the file hasn't changed since it was probed"""
+        path_str = str(Path(audio_path).absolute())
+        entry = self.entries.get(path_str)
+        if entry is None:
+            return None
+
+        size, mtime_ns, info = entry
+        stat = os.stat(path_str)
+        if (stat.st_size != size) or (stat.st_mtime_ns != mtime_ns):
+            return None
+
+        return info
+
+    def probe(
+        self,
+        audio_paths: typing.Iterable[typing.Union[str, Path]],
+        max_workers: typing.Optional[int] = None,
+    ) -> typing.Dict[Path, AudioInfo]:
+        """Get details for many files, probing uncached ones in parallel"""
+        audio_infos: typing.Dict[Path, AudioInfo] = {}
+        todo_paths: typing.List[Path] = []
+
+        for audio_path in audio_paths:
+            audio_path = Path(audio_path)
+            info = self.get(audio_path)
+            if info is None:
+                todo_paths.append(audio_path)
+            else:
+                audio_infos[audio_path] = info
+
+        if todo_paths:
+            _LOGGER.debug(
+                "Probing %s audio file(s) (%s cached)",
+                len(todo_paths),
+                len(audio_infos),
+            )
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for audio_path, info in zip(
+                    todo_paths, executor.map(_probe_safe, todo_paths)
+                ):
+                    if info is None:
+                        continue
+
+                    audio_infos[audio_path] = info
+                    stat = os.stat(audio_path)
+                    self.entries[str(audio_path.absolute())] = (
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                        info,
+                    )
+                    self.is_dirty = True
+
+        return audio_infos
+
+
+def _probe_safe(audio_path: Path) -> typing.Optional[AudioInfo]:
+    """Probe audio file and log instead of raising"""
+    try:
+        return probe_audio(audio_path)
+    except Exception as e:
+        _LOGGER.warning("Failed to probe %s: %s", audio_path, e)
+
+    return None
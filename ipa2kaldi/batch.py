@@ -0,0 +1,270 @@
+"""Creates recipes for several languages that share datasets.
+
+Each dataset is loaded, probed, and (with --audio-qa/--dedup) decoded once
+for all languages. Tokenization, lexicons, and recipe files are then made
+for each language in a separate process, reading the shared caches.
+
+The config is a JSON file:
+
+{
+  "args": ["--build-lm", "--num-jobs", "8"],
+  "languages": {
+    "de-de": {
+      "recipe_dir": "/opt/kaldi/egs/ipa2kaldi_de-de/s5",
+      "datasets": [["/data/mls_german", "mls:mls_de"], ["/data/cv/de", "common_voice:cv_de"]],
+      "args": ["--lexicon", "extra_de.dict"]
+    },
+    ...
+  }
+}
+
+"args" are ipa2kaldi options used for every language, followed by each
+language's own. "language" may be set to use a gruut language code that
+is different from the key.
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import sys
+import typing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from .__main__ import get_args, make_recipe, parse_dataset
+from .audio import AudioCache
+from .dedup import HashCache, hash_keys
+from .qa import QACache, scan_audio
+
+_LOGGER = logging.getLogger("ipa2kaldi.batch")
+
+# (path, type)
+DatasetKey = typing.Tuple[Path, str]
+
+# -----------------------------------------------------------------------------
+
+
+def load_metadata(dataset_key: DatasetKey) -> typing.List[typing.Tuple]:
+    """Load all items of a dataset"""
+    dataset_path, dataset_type = dataset_key
+    # Each dataset module has get_metadata
+    dataset_module: typing.Any = importlib.import_module(
+        f".dataset.{dataset_type}", __package__
+    )
+
+    return list(dataset_module.get_metadata(dataset_path))
+
+
+def make_recipes(
+    language_args: typing.Mapping[str, argparse.Namespace],
+    cache_dir: Path,
+    max_workers: typing.Optional[int] = None,
+) -> typing.List[str]:
+    """Create recipes for parsed ipa2kaldi arguments of each language.
+
+    Returns the names of languages that failed.
+    """
+    # Datasets of each language
+    language_datasets: typing.Dict[str, typing.List[DatasetKey]] = {}
+    for name, args in language_args.items():
+        language_datasets[name] = []
+        for dataset_parts in args.dataset:
+            dataset_path, dataset_type, _ = parse_dataset(dataset_parts)
+            language_datasets[name].append((dataset_path, dataset_type))
+
+    dataset_keys = sorted(
+        set(key for keys in language_datasets.values() for key in keys)
+    )
+
+    _LOGGER.debug(
+        "Loading %s dataset(s) for %s language(s)",
+        len(dataset_keys),
+        len(language_args),
+    )
+
+    executor: Executor
+    with ThreadPoolExecutor() as executor:
+        metadata = dict(zip(dataset_keys, executor.map(load_metadata, dataset_keys)))
+
+    # (path, start_ms, end_ms) of existing audio
+    dataset_audio: typing.Dict[
+        DatasetKey,
+        typing.List[typing.Tuple[Path, typing.Optional[int], typing.Optional[int]]],
+    ] = {}
+    for key, items in metadata.items():
+        dataset_audio[key] = [
+            (
+                item[2],
+                item[3] if len(item) > 3 else None,
+                item[4] if len(item) > 4 else None,
+            )
+            for item in items
+            if item[2].is_file()
+        ]
+
+        _LOGGER.info(
+            "Loaded %s item(s) from %s (%s with audio)",
+            len(items),
+            key[0],
+            len(dataset_audio[key]),
+        )
+
+    def get_audio_keys(
+        language_filter: typing.Callable[[argparse.Namespace], bool],
+    ) -> typing.Set[typing.Tuple[Path, typing.Optional[int], typing.Optional[int]]]:
+        return set(
+            audio_key
+            for name, args in language_args.items()
+            if language_filter(args)
+            for dataset_key in language_datasets[name]
+            for audio_key in dataset_audio[dataset_key]
+        )
+
+    # -------------------------------------------------------------------------
+    # Fill shared caches
+    # -------------------------------------------------------------------------
+
+    audio_cache_path = cache_dir / "audio_cache.txt"
+    qa_cache_path = cache_dir / "qa_cache.txt"
+    hash_cache_path = cache_dir / "hash_cache.txt"
+
+    audio_cache = AudioCache(audio_cache_path)
+    audio_cache.load()
+
+    audio_infos = audio_cache.probe(
+        set(
+            audio_path
+            for audio_path, _, _ in get_audio_keys(lambda args: not args.no_probe)
+        )
+    )
+    audio_cache.save()
+
+    qa_keys = get_audio_keys(lambda args: args.audio_qa)
+    if qa_keys:
+        # Statistics don't depend on thresholds, so languages can differ
+        qa_cache = QACache(qa_cache_path)
+        qa_cache.load()
+        scan_audio(qa_keys, audio_infos, cache=qa_cache)
+        qa_cache.save()
+
+    hash_keys_todo = get_audio_keys(lambda args: args.dedup)
+    if hash_keys_todo:
+        hash_cache = HashCache(hash_cache_path)
+        hash_cache.load()
+        hash_keys(hash_keys_todo, audio_infos, cache=hash_cache)
+        hash_cache.save()
+
+    # -------------------------------------------------------------------------
+    # Create recipes
+    # -------------------------------------------------------------------------
+
+    failed_names: typing.List[str] = []
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for name, args in language_args.items():
+            args.audio_cache = args.audio_cache or audio_cache_path
+            args.qa_cache = args.qa_cache or qa_cache_path
+            args.hash_cache = args.hash_cache or hash_cache_path
+
+            futures[name] = executor.submit(
+                make_recipe,
+                args,
+                {key: metadata[key] for key in language_datasets[name]},
+            )
+
+        for name, future in futures.items():
+            try:
+                future.result()
+                _LOGGER.info("Created recipe for %s", name)
+            except Exception:
+                _LOGGER.exception("Failed to create recipe for %s", name)
+                failed_names.append(name)
+
+    return failed_names
+
+
+def get_language_args(
+    config: typing.Mapping[str, typing.Any],
+) -> typing.Dict[str, argparse.Namespace]:
+    """Parse ipa2kaldi arguments for each language in a batch config"""
+    shared_argv = [str(arg) for arg in config.get("args", [])]
+
+    language_args: typing.Dict[str, argparse.Namespace] = {}
+    for name, language_config in config["languages"].items():
+        argv = [
+            "--language",
+            language_config.get("language", name),
+            "--recipe-dir",
+            str(language_config["recipe_dir"]),
+        ]
+
+        for dataset in language_config["datasets"]:
+            if isinstance(dataset, str):
+                dataset = [dataset]
+
+            argv.extend(["--dataset", *dataset])
+
+        argv.extend(shared_argv)
+        argv.extend(str(arg) for arg in language_config.get("args", []))
+
+        language_args[name] = get_args(argv)
+
+    return language_args
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi batch"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi batch")
+    parser.add_argument("config", help="Path to JSON batch config")
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory for audio/QA/hash caches shared by all recipes (default: config directory)",
+    )
+    parser.add_argument(
+        "--language",
+        action="append",
+        default=[],
+        help="Only create recipes for these languages (keys in config)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, help="Number of languages processed at the same time"
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    config_path = Path(args.config)
+    with open(config_path, "r") as config_file:
+        config = json.load(config_file)
+
+    language_args = get_language_args(config)
+    if args.language:
+        unknown_names = set(args.language) - set(language_args)
+        if unknown_names:
+            parser.error(f"Languages not in config: {sorted(unknown_names)}")
+
+        language_args = {name: language_args[name] for name in args.language}
+
+    cache_dir = Path(args.cache_dir) if args.cache_dir else config_path.parent
+    failed_names = make_recipes(language_args, cache_dir, max_workers=args.jobs)
+
+    if failed_names:
+        _LOGGER.critical("Failed to create recipes for: %s", ", ".join(failed_names))
+        sys.exit(1)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,591 @@
+"""Measures decoding speed of an exported model with Kaldi's online decoder.
+
+A test data dir (wav.scp, spk2utt, and ideally utt2dur) is split across
+--threads decoder processes. Decode time of each utterance is taken from
+when its transcript appears on the decoder's stderr, after subtracting the
+time needed to load the model and graph, which is measured with a separate
+run over no utterances.
+
+Any program with the command-line interface of
+online2-wav-nnet3-latgen-faster can be used with --decoder (e.g.,
+bin/stub-decoder.py to test without Kaldi).
+"""
+import argparse
+import dataclasses
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from .audio import probe_wav
+from .datadir import read_scp
+
+_LOGGER = logging.getLogger("ipa2kaldi.benchmark")
+
+DEFAULT_DECODER = "online2-wav-nnet3-latgen-faster"
+
+# Same as Rhasspy's Kaldi speech to text
+DEFAULT_DECODER_ARGS = [
+    "--max-active=7000",
+    "--lattice-beam=8.0",
+    "--beam=24.0",
+    "--acoustic-scale=1.0",
+    "--do-endpointing=false",
+]
+
+_DECODED_UTTERANCE = re.compile(r"Decoded utterance (\S+)")
+
+# Written by steps/online/nnet3/prepare_online_decoding.sh
+_IVECTOR_OPTIONS = [
+    "--ivector-period=10",
+    "--num-gselect=5",
+    "--min-post=0.025",
+    "--posterior-scale=0.1",
+    "--max-remembered-frames=1000",
+    "--max-count=0",
+]
+
+LATENCY_PERCENTILES = [50, 90, 95, 99]
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class UtteranceTiming:
+    """Decode time of a single utterance"""
+
+    utt_id: str
+    job: int
+    duration_sec: typing.Optional[float] = None
+    decode_sec: typing.Optional[float] = None
+    text: str = ""
+
+    @property
+    def rtf(self) -> typing.Optional[float]:
+        """Real-time factor (decode time / audio duration)"""
+        if (self.decode_sec is None) or (not self.duration_sec):
+            return None
+
+        return self.decode_sec / self.duration_sec
+
+
+@dataclass
+class BenchmarkResult:
+    """Summary of a benchmark run"""
+
+    threads: int
+    num_utterances: int = 0
+    num_failed: int = 0
+    audio_sec: float = 0.0
+
+    # Time to load model and graph (no utterances)
+    graph_load_sec: float = 0.0
+    graph_load_rss_mb: float = 0.0
+
+    # Wall time of decoding all utterances (including loading)
+    wall_sec: float = 0.0
+
+    # Largest resident set size of any decoder process
+    peak_rss_mb: float = 0.0
+
+    # Sum of decode time / sum of audio duration
+    rtf: typing.Optional[float] = None
+
+    # Wall time / sum of audio duration (with all threads)
+    throughput_rtf: typing.Optional[float] = None
+
+    # percentile -> seconds
+    latency_sec: typing.Dict[str, float] = field(default_factory=dict)
+
+    # percentile -> RTF of single utterances
+    utterance_rtf: typing.Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class DecoderRun:
+    """Output of one decoder process"""
+
+    # (seconds since start, line)
+    lines: typing.List[typing.Tuple[float, str]]
+    wall_sec: float
+    max_rss_mb: float
+    returncode: int
+
+
+# -----------------------------------------------------------------------------
+
+
+def find_model_dir(export_dir: Path) -> Path:
+    """Get acoustic_model dir of export.sh output (or the dir itself)"""
+    if (export_dir / "acoustic_model").is_dir():
+        return export_dir / "acoustic_model"
+
+    return export_dir
+
+
+def write_online_config(model_dir: Path, config_dir: Path) -> Path:
+    """Write online decoding config for an exported model like
+    prepare_online_decoding.sh. Returns path to online.conf."""
+    extractor_dir = (model_dir / "extractor").absolute()
+    config_dir.mkdir(parents=True, exist_ok=True)
+
+    # One option per line
+    splice_path = config_dir / "splice.conf"
+    splice_path.write_text(
+        "\n".join((extractor_dir / "splice_opts").read_text().split()) + "\n"
+    )
+
+    ivector_path = config_dir / "ivector_extractor.conf"
+    with open(ivector_path, "w") as ivector_file:
+        for option in [
+            f"--cmvn-config={extractor_dir / 'online_cmvn.conf'}",
+            f"--splice-config={splice_path.absolute()}",
+            f"--lda-matrix={extractor_dir / 'final.mat'}",
+            f"--global-cmvn-stats={extractor_dir / 'global_cmvn.stats'}",
+            f"--diag-ubm={extractor_dir / 'final.dubm'}",
+            f"--ivector-extractor={extractor_dir / 'final.ie'}",
+            *_IVECTOR_OPTIONS,
+        ]:
+            print(option, file=ivector_file)
+
+    online_path = config_dir / "online.conf"
+    with open(online_path, "w") as online_file:
+        print("--feature-type=mfcc", file=online_file)
+        print(
+            f"--mfcc-config={(model_dir / 'conf' / 'mfcc_hires.conf').absolute()}",
+            file=online_file,
+        )
+        print(
+            f"--ivector-extraction-config={ivector_path.absolute()}", file=online_file,
+        )
+
+    return online_path
+
+
+def get_decoder_command(
+    decoder: str,
+    model_dir: Path,
+    online_config_path: Path,
+    spk2utt_path: Path,
+    wav_scp_path: Path,
+    decoder_args: typing.Optional[typing.Sequence[str]] = None,
+    frame_subsampling_factor: int = 3,
+) -> typing.List[str]:
+    """Get command line for online2-wav-nnet3-latgen-faster"""
+    graph_dir = model_dir / "base_graph"
+    return [
+        decoder,
+        f"--config={online_config_path.absolute()}",
+        f"--frame-subsampling-factor={frame_subsampling_factor}",
+        f"--word-symbol-table={(graph_dir / 'words.txt').absolute()}",
+        *(DEFAULT_DECODER_ARGS if decoder_args is None else decoder_args),
+        str((model_dir / "model" / "final.mdl").absolute()),
+        str((graph_dir / "HCLG.fst").absolute()),
+        f"ark:{spk2utt_path.absolute()}",
+        f"scp:{wav_scp_path.absolute()}",
+        "ark:/dev/null",
+    ]
+
+
+def run_decoder(command: typing.List[str]) -> DecoderRun:
+    """Run decoder, timestamping each line of its stderr as it arrives"""
+    _LOGGER.debug(command)
+
+    start_time = time.perf_counter()
+    proc = subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+    lines: typing.List[typing.Tuple[float, str]] = []
+    assert proc.stderr is not None
+    for line in proc.stderr:
+        lines.append((time.perf_counter() - start_time, line.rstrip("\n")))
+
+    # wait4 gives resource usage of this child only
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall_sec = time.perf_counter() - start_time
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    return DecoderRun(
+        lines=lines,
+        wall_sec=wall_sec,
+        max_rss_mb=rusage.ru_maxrss / 1024,  # KB on Linux
+        returncode=proc.returncode,
+    )
+
+
+def _split_speakers(
+    spk2utt: typing.Mapping[str, typing.List[str]], num_jobs: int
+) -> typing.List[typing.Dict[str, typing.List[str]]]:
+    """Split speakers into jobs with about the same number of utterances"""
+    jobs: typing.List[typing.Dict[str, typing.List[str]]] = [
+        {} for _ in range(num_jobs)
+    ]
+    job_sizes = [0] * num_jobs
+
+    for speaker in sorted(spk2utt, key=lambda s: len(spk2utt[s]), reverse=True):
+        job_index = min(range(num_jobs), key=lambda j: job_sizes[j])
+        jobs[job_index][speaker] = spk2utt[speaker]
+        job_sizes[job_index] += len(spk2utt[speaker])
+
+    return [job for job in jobs if job]
+
+
+def get_durations(data_dir: Path, wav_entries: typing.Mapping[str, str]):
+    """Get audio durations from utt2dur, or WAV headers of plain files"""
+    utt2dur_path = data_dir / "utt2dur"
+    if utt2dur_path.is_file():
+        return {
+            utt_id: float(value) for utt_id, value in read_scp(utt2dur_path).items()
+        }
+
+    durations: typing.Dict[str, float] = {}
+    for utt_id, wav_entry in wav_entries.items():
+        if wav_entry.strip().endswith("|"):
+            continue
+
+        audio_info = probe_wav(wav_entry.strip())
+        if audio_info is not None:
+            durations[utt_id] = audio_info.duration_sec
+
+    return durations
+
+
+def benchmark(
+    export_dir: Path,
+    data_dir: Path,
+    decoder: str = DEFAULT_DECODER,
+    threads: int = 1,
+    decoder_args: typing.Optional[typing.Sequence[str]] = None,
+    frame_subsampling_factor: int = 3,
+    max_utterances: typing.Optional[int] = None,
+) -> typing.Tuple[BenchmarkResult, typing.List[UtteranceTiming]]:
+    """Decode a data dir with an exported model and measure speed"""
+    model_dir = find_model_dir(export_dir)
+
+    wav_entries = read_scp(data_dir / "wav.scp")
+    if (data_dir / "spk2utt").is_file():
+        spk2utt = {
+            speaker: utt_ids.split()
+            for speaker, utt_ids in read_scp(data_dir / "spk2utt").items()
+        }
+    else:
+        # Each utterance is its own speaker
+        spk2utt = {utt_id: [utt_id] for utt_id in wav_entries}
+
+    if max_utterances is not None:
+        kept_utts = set(sorted(wav_entries)[:max_utterances])
+        spk2utt = {
+            speaker: [u for u in utt_ids if u in kept_utts]
+            for speaker, utt_ids in spk2utt.items()
+        }
+        spk2utt = {speaker: utt_ids for speaker, utt_ids in spk2utt.items() if utt_ids}
+
+    durations = get_durations(data_dir, wav_entries)
+    jobs = _split_speakers(spk2utt, max(1, threads))
+    result = BenchmarkResult(threads=len(jobs))
+
+    with tempfile.TemporaryDirectory(prefix="ipa2kaldi_benchmark_") as work_dir_str:
+        work_dir = Path(work_dir_str)
+        online_config_path = write_online_config(model_dir, work_dir / "conf")
+
+        def make_command(job_name: str, job_spk2utt) -> typing.List[str]:
+            spk2utt_path = work_dir / f"spk2utt.{job_name}"
+            wav_scp_path = work_dir / f"wav.{job_name}.scp"
+
+            with open(spk2utt_path, "w") as spk2utt_file, open(
+                wav_scp_path, "w"
+            ) as wav_scp_file:
+                for speaker, utt_ids in sorted(job_spk2utt.items()):
+                    print(speaker, *utt_ids, file=spk2utt_file)
+                    for utt_id in utt_ids:
+                        print(utt_id, wav_entries[utt_id], file=wav_scp_file)
+
+            return get_decoder_command(
+                decoder,
+                model_dir,
+                online_config_path,
+                spk2utt_path,
+                wav_scp_path,
+                decoder_args=decoder_args,
+                frame_subsampling_factor=frame_subsampling_factor,
+            )
+
+        # Load model and graph without decoding anything.
+        # Kaldi exits with 1 when nothing was decoded, so only errors count.
+        load_run = run_decoder(make_command("load", {}))
+        load_errors = [line for _, line in load_run.lines if line.startswith("ERROR")]
+        if load_errors:
+            raise RuntimeError("\n".join(line for _, line in load_run.lines))
+
+        result.graph_load_sec = load_run.wall_sec
+        result.graph_load_rss_mb = load_run.max_rss_mb
+        _LOGGER.debug(
+            "Loaded model in %0.2f second(s) (%0.1f MB)",
+            load_run.wall_sec,
+            load_run.max_rss_mb,
+        )
+
+        commands = [
+            make_command(str(job_index), job_spk2utt)
+            for job_index, job_spk2utt in enumerate(jobs)
+        ]
+
+        _LOGGER.debug(
+            "Decoding %s utterance(s) with %s thread(s)",
+            sum(len(u) for u in spk2utt.values()),
+            len(commands),
+        )
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(commands) or 1) as executor:
+            decoder_runs = list(executor.map(run_decoder, commands))
+
+        result.wall_sec = time.perf_counter() - start_time
+
+    # -------------------------------------------------------------------------
+
+    timings: typing.List[UtteranceTiming] = []
+    for job_index, (job_spk2utt, decoder_run) in enumerate(zip(jobs, decoder_runs)):
+        result.peak_rss_mb = max(result.peak_rss_mb, decoder_run.max_rss_mb)
+
+        job_timings = {
+            utt_id: UtteranceTiming(
+                utt_id=utt_id, job=job_index, duration_sec=durations.get(utt_id)
+            )
+            for utt_ids in job_spk2utt.values()
+            for utt_id in utt_ids
+        }
+
+        # Transcript lines (utt_id word word ...) are printed after each
+        # utterance is decoded.
+        last_sec = result.graph_load_sec
+        done_utts: typing.Set[str] = set()
+        for line_sec, line in decoder_run.lines:
+            parts = line.split(maxsplit=1)
+            utt_id = parts[0] if parts else ""
+            text = parts[1] if len(parts) > 1 else ""
+
+            if utt_id not in job_timings:
+                match = _DECODED_UTTERANCE.search(line)
+                if match is None:
+                    continue
+
+                utt_id, text = match.group(1), ""
+                if utt_id not in job_timings:
+                    continue
+
+            if utt_id in done_utts:
+                continue
+
+            timing = job_timings[utt_id]
+            timing.decode_sec = max(0.0, line_sec - last_sec)
+            timing.text = text
+            done_utts.add(utt_id)
+            last_sec = line_sec
+
+        if decoder_run.returncode != 0:
+            _LOGGER.warning(
+                "Decoder job %s exited with %s: %s",
+                job_index,
+                decoder_run.returncode,
+                decoder_run.lines[-1][1] if decoder_run.lines else "",
+            )
+
+        timings.extend(job_timings.values())
+
+    decoded = [t for t in timings if t.decode_sec is not None]
+    result.num_utterances = len(decoded)
+    result.num_failed = len(timings) - len(decoded)
+
+    with_duration = [t for t in decoded if t.duration_sec]
+    result.audio_sec = sum(t.duration_sec or 0.0 for t in with_duration)
+
+    if result.audio_sec > 0:
+        result.rtf = sum(t.decode_sec or 0.0 for t in with_duration) / result.audio_sec
+        result.throughput_rtf = result.wall_sec / result.audio_sec
+
+    if decoded:
+        latencies: np.ndarray = np.array([t.decode_sec for t in decoded])
+        for percentile, value in zip(
+            LATENCY_PERCENTILES, np.percentile(latencies, LATENCY_PERCENTILES)
+        ):
+            result.latency_sec[f"p{percentile}"] = float(value)
+
+    if with_duration:
+        rtfs: np.ndarray = np.array([t.rtf for t in with_duration])
+        for percentile, value in zip(
+            LATENCY_PERCENTILES, np.percentile(rtfs, LATENCY_PERCENTILES)
+        ):
+            result.utterance_rtf[f"p{percentile}"] = float(value)
+
+    return result, timings
+
+
+# -----------------------------------------------------------------------------
+
+
+def write_report(result: BenchmarkResult, report_file: typing.TextIO):
+    """Write summary as plain text"""
+    print(f"threads: {result.threads}", file=report_file)
+    print(
+        f"utterances: {result.num_utterances} ({result.num_failed} failed)",
+        file=report_file,
+    )
+    print(f"audio: {result.audio_sec:.1f} second(s)", file=report_file)
+    print(
+        f"graph load: {result.graph_load_sec:.2f} second(s), {result.graph_load_rss_mb:.1f} MB",
+        file=report_file,
+    )
+    print(f"wall time: {result.wall_sec:.2f} second(s)", file=report_file)
+    print(f"peak RSS: {result.peak_rss_mb:.1f} MB", file=report_file)
+
+    if result.rtf is not None:
+        print(f"RTF: {result.rtf:.4f}", file=report_file)
+
+    if result.throughput_rtf is not None:
+        print(f"throughput RTF: {result.throughput_rtf:.4f}", file=report_file)
+
+    if result.latency_sec:
+        print(
+            "latency:",
+            ", ".join(f"{p} {s:.3f}s" for p, s in result.latency_sec.items()),
+            file=report_file,
+        )
+
+    if result.utterance_rtf:
+        print(
+            "utterance RTF:",
+            ", ".join(f"{p} {r:.4f}" for p, r in result.utterance_rtf.items()),
+            file=report_file,
+        )
+
+
+def write_timings(
+    timings: typing.Iterable[UtteranceTiming], timings_file: typing.TextIO
+):
+    """Write tab-separated timing of each utterance"""
+    print(
+        "utt_id",
+        "job",
+        "duration_sec",
+        "decode_sec",
+        "rtf",
+        "text",
+        sep="\t",
+        file=timings_file,
+    )
+    for timing in timings:
+        print(
+            timing.utt_id,
+            timing.job,
+            "" if timing.duration_sec is None else f"{timing.duration_sec:.3f}",
+            "" if timing.decode_sec is None else f"{timing.decode_sec:.3f}",
+            "" if timing.rtf is None else f"{timing.rtf:.4f}",
+            timing.text,
+            sep="\t",
+            file=timings_file,
+        )
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi benchmark"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi benchmark")
+    parser.add_argument(
+        "export_dir", help="Output directory of export.sh/ipa2kaldi export"
+    )
+    parser.add_argument(
+        "--data-dir",
+        default="data/test",
+        help="Kaldi data dir with wav.scp, spk2utt, and utt2dur (default: data/test)",
+    )
+    parser.add_argument(
+        "--decoder",
+        default=DEFAULT_DECODER,
+        help=f"Decoder program (default: {DEFAULT_DECODER})",
+    )
+    parser.add_argument(
+        "--decoder-arg",
+        action="append",
+        help="Option for decoder (replaces defaults, e.g. --decoder-arg=--beam=13)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of decoder processes (default: 1)",
+    )
+    parser.add_argument(
+        "--frame-subsampling-factor",
+        type=int,
+        default=3,
+        help="Frame subsampling factor of model (default: 3)",
+    )
+    parser.add_argument(
+        "--max-utterances", type=int, help="Only decode this many utterances"
+    )
+    parser.add_argument("--json", help="Path to write summary as JSON")
+    parser.add_argument("--timings", help="Path to write per-utterance timings (TSV)")
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if (shutil.which(args.decoder) is None) and (not Path(args.decoder).is_file()):
+        _LOGGER.critical("Decoder not found: %s (is Kaldi in PATH?)", args.decoder)
+        sys.exit(1)
+
+    result, timings = benchmark(
+        Path(args.export_dir),
+        Path(args.data_dir),
+        decoder=args.decoder,
+        threads=args.threads,
+        decoder_args=args.decoder_arg,
+        frame_subsampling_factor=args.frame_subsampling_factor,
+        max_utterances=args.max_utterances,
+    )
+
+    write_report(result, sys.stdout)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(dataclasses.asdict(result), json_file, indent=4)
+
+    if args.timings:
+        with open(args.timings, "w") as timings_file:
+            write_timings(timings, timings_file)
+
+    if result.num_failed > 0:
+        _LOGGER.warning("%s utterance(s) weren't decoded", result.num_failed)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,570 @@
+"""Methods for writing Kaldi data directories"""
+import argparse
+import heapq
+import logging
+import random
+import sys
+import typing
+from collections import defaultdict
+from pathlib import Path
+
+_LOGGER = logging.getLogger("ipa2kaldi.datadir")
+
+# Files whose first column is an utterance id
+_UTT_FILES = ["wav.scp", "text", "utt2spk", "utt2dur", "utt2num_frames"]
+
+# Files checked by validate_data_dir (besides utt2spk/spk2utt)
+_VALIDATE_UTT_FILES = [
+    "wav.scp",
+    "text",
+    "utt2dur",
+    "reco2dur",
+    "utt2num_frames",
+    "utt2uniq",
+    "feats.scp",
+]
+_VALIDATE_SPK_FILES = ["cmvn.scp", "spk2gender"]
+
+# Written by ipa2kaldi after validating a data dir. Kaldi's fix_data_dir.sh
+# is skipped (see local/fix_data_dir_fast.sh) if no file is newer.
+VALIDATED_NAME = ".validated"
+
+# -----------------------------------------------------------------------------
+
+
+def read_scp(scp_path: Path) -> typing.Dict[str, str]:
+    """Read key -> rest of line from a Kaldi table file"""
+    entries: typing.Dict[str, str] = {}
+    with open(scp_path, "r") as scp_file:
+        for line in scp_file:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+
+            key, *rest = line.split(maxsplit=1)
+            entries[key] = rest[0] if rest else ""
+
+    return entries
+
+
+def read_total_duration(data_dir: Path) -> typing.Optional[float]:
+    """Get total seconds of audio from utt2dur (None if missing)"""
+    utt2dur_path = data_dir / "utt2dur"
+    if not utt2dur_path.is_file():
+        return None
+
+    return sum(float(value) for value in read_scp(utt2dur_path).values())
+
+
+def balance_speakers(
+    speaker_durations: typing.Mapping[str, float], num_jobs: int
+) -> typing.Dict[str, int]:
+    """Assign speakers to jobs (1-based) so total durations are balanced.
+
+    Longest speakers are placed first, each on the least loaded job.
+    """
+    # (total duration, job)
+    job_heap = [(0.0, job) for job in range(1, num_jobs + 1)]
+    speaker_jobs: typing.Dict[str, int] = {}
+
+    for speaker, duration in sorted(
+        speaker_durations.items(), key=lambda kv: (-kv[1], kv[0])
+    ):
+        job_duration, job = heapq.heappop(job_heap)
+        speaker_jobs[speaker] = job
+        heapq.heappush(job_heap, (job_duration + duration, job))
+
+    return speaker_jobs
+
+
+def regroup_speakers(
+    utt_speakers: typing.Mapping[str, str],
+    utt_durations: typing.Mapping[str, float],
+    max_speaker_utts: typing.Optional[int] = None,
+    max_speaker_sec: typing.Optional[float] = None,
+    min_speaker_utts: typing.Optional[int] = None,
+) -> typing.Dict[str, str]:
+    """Get a pseudo-speaker for each regrouped utterance.
+
+    Speakers over max_speaker_utts/max_speaker_sec are split into parts
+    (<speaker>-p0, <speaker>-p1, ...). Speakers with fewer than
+    min_speaker_utts utterances are packed together into groups of about
+    that size (g0, g1, ...).
+
+    Utterances that keep their original speaker are not included.
+    """
+    speaker_utts: typing.Dict[str, typing.List[str]] = defaultdict(list)
+    for utt_id, speaker in utt_speakers.items():
+        speaker_utts[speaker].append(utt_id)
+
+    def over_limit(num_utts: int, total_sec: float) -> bool:
+        return ((max_speaker_utts is not None) and (num_utts > max_speaker_utts)) or (
+            (max_speaker_sec is not None) and (total_sec > max_speaker_sec)
+        )
+
+    utt_groups: typing.Dict[str, str] = {}
+    small_speakers: typing.List[typing.List[str]] = []
+
+    for speaker, utt_ids in speaker_utts.items():
+        if (min_speaker_utts is not None) and (len(utt_ids) < min_speaker_utts):
+            # Pack with other small speakers
+            small_speakers.append(utt_ids)
+            continue
+
+        total_sec = sum(utt_durations.get(utt_id, 0.0) for utt_id in utt_ids)
+        if not over_limit(len(utt_ids), total_sec):
+            continue
+
+        # Split into parts
+        part = 0
+        part_utts = 0
+        part_sec = 0.0
+        for utt_id in utt_ids:
+            utt_sec = utt_durations.get(utt_id, 0.0)
+            if (part_utts > 0) and over_limit(part_utts + 1, part_sec + utt_sec):
+                part += 1
+                part_utts = 0
+                part_sec = 0.0
+
+            utt_groups[utt_id] = f"{speaker}-p{part}"
+            part_utts += 1
+            part_sec += utt_sec
+
+    # Small speakers are kept whole within a group
+    group = 0
+    group_utts = 0
+    for utt_ids in small_speakers:
+        if (min_speaker_utts is not None) and (group_utts >= min_speaker_utts):
+            group += 1
+            group_utts = 0
+
+        for utt_id in utt_ids:
+            utt_groups[utt_id] = f"g{group}"
+
+        group_utts += len(utt_ids)
+
+    return utt_groups
+
+
+def write_durations(
+    data_dir: Path,
+    utt_durations: typing.Mapping[str, float],
+    frame_shift: typing.Optional[float] = None,
+    frame_length: float = 0.025,
+    sample_rate: int = 16000,
+):
+    """Write utt2dur and reco2dur (and utt2num_frames if frame_shift is given)
+    so Kaldi doesn't have to read every audio file to get them.
+
+    Each wav.scp entry is a single utterance, so reco2dur is the same as
+    utt2dur. Frames are counted like Kaldi with --snip-edges=true.
+    """
+    with open(data_dir / "utt2dur", "w") as utt2dur, open(
+        data_dir / "reco2dur", "w"
+    ) as reco2dur:
+        for utt_id, duration in sorted(utt_durations.items()):
+            print(utt_id, f"{duration:.3f}", file=utt2dur)
+            print(utt_id, f"{duration:.3f}", file=reco2dur)
+
+    if frame_shift is not None:
+        with open(data_dir / "utt2num_frames", "w") as utt2num_frames:
+            for utt_id, duration in sorted(utt_durations.items()):
+                num_frames = get_num_frames(
+                    duration,
+                    frame_shift,
+                    frame_length=frame_length,
+                    sample_rate=sample_rate,
+                )
+                print(utt_id, num_frames, file=utt2num_frames)
+
+
+def get_num_frames(
+    duration: float,
+    frame_shift: float,
+    frame_length: float = 0.025,
+    sample_rate: int = 16000,
+) -> int:
+    """Number of feature frames like Kaldi with --snip-edges=true.
+
+    Counted in whole samples, since dividing durations in seconds is off by
+    one for many lengths (e.g., 16.025 / 0.01).
+    """
+    num_samples = round(duration * sample_rate)
+    window_samples = round(frame_length * sample_rate)
+    shift_samples = round(frame_shift * sample_rate)
+
+    if num_samples < window_samples:
+        return 0
+
+    return 1 + ((num_samples - window_samples) // shift_samples)
+
+
+def write_spk2utt(data_dir: Path, utt_speakers: typing.Mapping[str, str]):
+    """Write spk2utt with speakers and their utterances in sorted order"""
+    spk2utt: typing.Dict[str, typing.List[str]] = defaultdict(list)
+    for utt_id, speaker in sorted(utt_speakers.items()):
+        spk2utt[speaker].append(utt_id)
+
+    with open(data_dir / "spk2utt", "w") as spk2utt_file:
+        for speaker, utt_ids in sorted(spk2utt.items()):
+            print(speaker, *utt_ids, file=spk2utt_file)
+
+
+def validate_data_dir(data_dir: Path, max_problems: int = 10) -> typing.List[str]:
+    """Check a data dir like utils/validate_data_dir.sh, in a single pass.
+
+    Each file must have unique keys in C locale order (the same as Python's
+    str order for UTF-8) and exactly the utterances of utt2spk (or speakers
+    of spk2utt). spk2utt must match utt2spk, and sorting utt2spk by speaker
+    must not change its order.
+
+    Returns descriptions of up to max_problems problems (empty if valid).
+    """
+    problems: typing.List[str] = []
+
+    def read_table(
+        file_name: str,
+    ) -> typing.Optional[typing.List[typing.Tuple[str, str]]]:
+        table_path = data_dir / file_name
+        if not table_path.is_file():
+            return None
+
+        entries: typing.List[typing.Tuple[str, str]] = []
+        prev_key: typing.Optional[str] = None
+        with open(table_path, "r", encoding="utf-8") as table_file:
+            for line_num, line in enumerate(table_file, start=1):
+                line = line.rstrip("\n")
+                if ("\r" in line) or (not line) or line[0].isspace():
+                    problems.append(f"{file_name}:{line_num}: malformed line")
+                    continue
+
+                key, *rest = line.split(maxsplit=1)
+                if (prev_key is not None) and (key <= prev_key):
+                    problems.append(
+                        f"{file_name}:{line_num}: {key} is "
+                        + ("duplicated" if key == prev_key else "out of order")
+                    )
+
+                prev_key = key
+                entries.append((key, rest[0] if rest else ""))
+
+        return entries
+
+    try:
+        utt2spk = read_table("utt2spk")
+        spk2utt = read_table("spk2utt")
+        if (utt2spk is None) or (spk2utt is None):
+            return ["Missing utt2spk or spk2utt"]
+
+        utt_ids = [utt_id for utt_id, _ in utt2spk]
+        speakers = [speaker for speaker, _ in spk2utt]
+
+        # spk2utt must be utt2spk grouped by speaker
+        expected_spk2utt: typing.Dict[str, typing.List[str]] = defaultdict(list)
+        for utt_id, speaker in utt2spk:
+            if (not speaker) or (len(speaker.split()) > 1):
+                problems.append(f"utt2spk: {utt_id} needs exactly one speaker")
+
+            expected_spk2utt[speaker].append(utt_id)
+
+        if dict(expected_spk2utt) != {
+            speaker: value.split() for speaker, value in spk2utt
+        }:
+            problems.append("spk2utt doesn't match utt2spk")
+
+        if sorted(utt2spk, key=lambda kv: (kv[1], kv[0])) != utt2spk:
+            problems.append("utt2spk order changes when sorted by speaker")
+
+        # Utterances with a segments file are not recordings
+        utt_file_names = list(_VALIDATE_UTT_FILES)
+        if (data_dir / "segments").is_file():
+            utt_file_names = [
+                f for f in utt_file_names if f not in {"wav.scp", "reco2dur"}
+            ] + ["segments"]
+
+        for file_names, expected_keys in [
+            (utt_file_names, utt_ids),
+            (_VALIDATE_SPK_FILES, speakers),
+        ]:
+            for file_name in file_names:
+                entries = read_table(file_name)
+                if entries is None:
+                    continue
+
+                # Order was checked while reading
+                file_keys = set(key for key, _ in entries)
+                missing_keys = set(expected_keys) - file_keys
+                extra_keys = file_keys - set(expected_keys)
+                if missing_keys or extra_keys:
+                    problems.append(
+                        f"{file_name}: {len(missing_keys)} missing and "
+                        f"{len(extra_keys)} extra key(s), "
+                        f"e.g. {sorted(missing_keys | extra_keys)[0]}"
+                    )
+    except UnicodeDecodeError as e:
+        problems.append(f"Not UTF-8: {e}")
+
+    return problems[:max_problems]
+
+
+def select_shortest(
+    utt_durations: typing.Mapping[str, float], num_utts: int
+) -> typing.List[str]:
+    """Get the num_utts shortest utterances (like subset_data_dir.sh --shortest)"""
+    return sorted(
+        sorted(utt_durations, key=lambda utt_id: (utt_durations[utt_id], utt_id))[
+            :num_utts
+        ]
+    )
+
+
+def select_speaker_hours(
+    utt_speakers: typing.Mapping[str, str],
+    utt_durations: typing.Mapping[str, float],
+    hours: float,
+    max_utt_sec: typing.Optional[float] = None,
+    rng: typing.Optional[random.Random] = None,
+) -> typing.List[str]:
+    """Get random utterances with about hours of audio, stratified by speaker.
+
+    Each speaker contributes in proportion to their share of the audio, and
+    with at least one utterance. Utterances longer than max_utt_sec are
+    skipped.
+    """
+    rng = rng or random.Random()
+
+    speaker_utts: typing.Dict[str, typing.List[str]] = defaultdict(list)
+    for utt_id, speaker in sorted(utt_speakers.items()):
+        duration = utt_durations.get(utt_id)
+        if (duration is None) or (
+            (max_utt_sec is not None) and (duration > max_utt_sec)
+        ):
+            continue
+
+        speaker_utts[speaker].append(utt_id)
+
+    total_sec = sum(
+        utt_durations[utt_id] for utt_ids in speaker_utts.values() for utt_id in utt_ids
+    )
+    if total_sec <= 0:
+        return []
+
+    target_fraction = min(1.0, (hours * 60 * 60) / total_sec)
+
+    selected_ids: typing.List[str] = []
+    for speaker, utt_ids in sorted(speaker_utts.items()):
+        speaker_target = target_fraction * sum(utt_durations[u] for u in utt_ids)
+        speaker_sec = 0.0
+        for utt_id in rng.sample(utt_ids, len(utt_ids)):
+            if (speaker_sec > 0) and (
+                (speaker_sec + utt_durations[utt_id]) > speaker_target
+            ):
+                continue
+
+            selected_ids.append(utt_id)
+            speaker_sec += utt_durations[utt_id]
+
+    return sorted(selected_ids)
+
+
+def write_subset(
+    data_dir: Path,
+    subset_dir: Path,
+    utt_ids: typing.Iterable[str],
+    num_jobs: typing.Optional[int] = None,
+):
+    """Write a validated data dir with only some utterances of data_dir.
+
+    Features are not copied, since data_dir usually doesn't have them yet
+    (see local/subset_features.sh).
+    """
+    utt_ids = set(utt_ids)
+    subset_dir.mkdir(parents=True, exist_ok=True)
+
+    validated_path = subset_dir / VALIDATED_NAME
+    if validated_path.is_file():
+        validated_path.unlink()
+
+    for file_name in _VALIDATE_UTT_FILES + ["utt2spk"]:
+        data_path = data_dir / file_name
+        subset_path = subset_dir / file_name
+        if not data_path.is_file():
+            if subset_path.is_file():
+                # Stale
+                subset_path.unlink()
+
+            continue
+
+        with open(data_path, "r") as data_file, open(subset_path, "w") as subset_file:
+            for line in data_file:
+                if line.split(maxsplit=1)[0] in utt_ids:
+                    subset_file.write(line)
+
+    utt_speakers = read_scp(subset_dir / "utt2spk")
+    write_spk2utt(subset_dir, utt_speakers)
+
+    for file_name in _VALIDATE_SPK_FILES:
+        stale_path = subset_dir / file_name
+        if stale_path.is_file():
+            stale_path.unlink()
+
+    if num_jobs is not None:
+        # Can't have more jobs than speakers
+        num_speakers = len(set(utt_speakers.values()))
+        utt2dur_path = subset_dir / "utt2dur"
+        write_splits(
+            subset_dir,
+            min(num_jobs, num_speakers),
+            utt_durations=(
+                {
+                    utt_id: float(value)
+                    for utt_id, value in read_scp(utt2dur_path).items()
+                }
+                if utt2dur_path.is_file()
+                else None
+            ),
+        )
+
+    problems = validate_data_dir(subset_dir)
+    if problems:
+        raise ValueError(f"Invalid data dir {subset_dir}: {'; '.join(problems)}")
+
+    validated_path.touch()
+
+
+def write_splits(
+    data_dir: Path,
+    num_jobs: int,
+    utt_durations: typing.Optional[typing.Mapping[str, float]] = None,
+):
+    """Pre-build split<num_jobs> directories like utils/split_data.sh, but
+    with speakers bin-packed by total audio duration.
+
+    Speaker assignments are written to split<num_jobs>/spk2job so that
+    local/split_data_balanced.sh can re-split after files change.
+    """
+    utt_durations = utt_durations or {}
+    utt2spk = read_scp(data_dir / "utt2spk")
+
+    # Utterances with unknown duration count as an average utterance
+    known_durations = [d for d in utt_durations.values() if d > 0]
+    default_duration = (
+        (sum(known_durations) / len(known_durations)) if known_durations else 1.0
+    )
+
+    speaker_durations: typing.Dict[str, float] = defaultdict(float)
+    for utt_id, speaker in utt2spk.items():
+        speaker_durations[speaker] += utt_durations.get(utt_id) or default_duration
+
+    if len(speaker_durations) < num_jobs:
+        _LOGGER.warning(
+            "Not splitting %s: %s speaker(s) for %s job(s)",
+            data_dir,
+            len(speaker_durations),
+            num_jobs,
+        )
+        return
+
+    speaker_jobs = balance_speakers(speaker_durations, num_jobs)
+
+    job_durations = [0.0] * num_jobs
+    for speaker, job in speaker_jobs.items():
+        job_durations[job - 1] += speaker_durations[speaker]
+
+    _LOGGER.debug(
+        "Split %s into %s job(s): %0.1f-%0.1f second(s) per job",
+        data_dir,
+        num_jobs,
+        min(job_durations),
+        max(job_durations),
+    )
+
+    split_dir = data_dir / f"split{num_jobs}"
+    for job in range(1, num_jobs + 1):
+        (split_dir / str(job)).mkdir(parents=True, exist_ok=True)
+
+    with open(split_dir / "spk2job", "w") as spk2job_file:
+        for speaker, job in sorted(speaker_jobs.items()):
+            print(speaker, job, file=spk2job_file)
+
+    # Utterance files
+    for file_name in _UTT_FILES:
+        data_path = data_dir / file_name
+        if not data_path.is_file():
+            continue
+
+        job_files = [
+            open(split_dir / str(job) / file_name, "w")
+            for job in range(1, num_jobs + 1)
+        ]
+
+        try:
+            for utt_id, value in read_scp(data_path).items():
+                utt_speaker = utt2spk.get(utt_id)
+                if utt_speaker is None:
+                    continue
+
+                print(utt_id, value, file=job_files[speaker_jobs[utt_speaker] - 1])
+        finally:
+            for job_file in job_files:
+                job_file.close()
+
+    # spk2utt
+    spk2utt: typing.Dict[str, typing.List[str]] = defaultdict(list)
+    for utt_id, speaker in utt2spk.items():
+        spk2utt[speaker].append(utt_id)
+
+    job_files = [
+        open(split_dir / str(job) / "spk2utt", "w") for job in range(1, num_jobs + 1)
+    ]
+
+    try:
+        for speaker, utt_ids in sorted(spk2utt.items()):
+            print(speaker, *utt_ids, file=job_files[speaker_jobs[speaker] - 1])
+    finally:
+        for job_file in job_files:
+            job_file.close()
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi validate-data-dir"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi validate-data-dir")
+    parser.add_argument("data_dir", nargs="+", help="Kaldi data directories")
+    parser.add_argument(
+        "--max-problems",
+        type=int,
+        default=10,
+        help="Maximum number of problems to report per data dir (default: 10)",
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    num_invalid = 0
+    for data_dir_str in args.data_dir:
+        data_dir = Path(data_dir_str)
+        problems = validate_data_dir(data_dir, max_problems=args.max_problems)
+        if problems:
+            num_invalid += 1
+            for problem in problems:
+                _LOGGER.error("%s: %s", data_dir, problem)
+        else:
+            _LOGGER.info("%s: OK", data_dir)
+
+    if num_invalid > 0:
+        sys.exit(1)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -47,7 +47,7 @@ def get_metadata(dataset_dir: Path) -> typing.Iterable[typing.Tuple[str, str, Pa
 
             # Assume each utterance is from a unique speaker
             for text, wav_path in _load_metadata(book_dir):
-                speaker_id = "speaker_{utt_idx}"
+                speaker_id = f"speaker_{utt_idx}"
                 yield speaker_id, text, wav_path
                 utt_idx += 1
 
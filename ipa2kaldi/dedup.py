@@ -0,0 +1,430 @@
+"""Content-based deduplication of audio and transcripts across datasets"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sys
+import typing
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .audio import AudioCache, AudioInfo, read_pcm
+from .qa import QAKey
+
+_LOGGER = logging.getLogger("ipa2kaldi.dedup")
+
+_NON_WORD = re.compile(r"[^\w\s']+")
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class Duplicates:
+    """Outcome of deduplicating items.
+
+    Lists are parallel to the items that were given.
+    """
+
+    # Hash of decoded audio (None if audio couldn't be decoded)
+    audio_hashes: typing.List[typing.Optional[str]] = field(default_factory=list)
+
+    # Index of the first item with the same audio
+    clusters: typing.List[int] = field(default_factory=list)
+
+    # False for redundant copies
+    keep: typing.List[bool] = field(default_factory=list)
+
+    # Items with the same group must end up on the same side of a test/train
+    # split (same audio or same transcript).
+    split_groups: typing.List[int] = field(default_factory=list)
+
+    @property
+    def num_dropped(self) -> int:
+        """Number of redundant copies"""
+        return sum(1 for k in self.keep if not k)
+
+
+# -----------------------------------------------------------------------------
+
+
+def normalize_text(text: str) -> str:
+    """Case-fold and remove punctuation/extra whitespace from a transcript"""
+    return " ".join(_NON_WORD.sub(" ", text.casefold()).split())
+
+
+def hash_audio(
+    audio_path: typing.Union[str, Path],
+    audio_info: typing.Optional[AudioInfo] = None,
+    start_ms: typing.Optional[int] = None,
+    end_ms: typing.Optional[int] = None,
+) -> str:
+    """Hash of decoded 16-bit 16Khz mono samples.
+
+    Different containers or lossless encodings of the same audio (WAV, FLAC,
+    etc.) have the same hash.
+    """
+    samples = read_pcm(audio_path, audio_info, start_ms=start_ms, end_ms=end_ms)
+    return hashlib.sha1(samples.tobytes()).hexdigest()
+
+
+class HashCache:
+    """Audio hashes for files, recomputed when a file's size or modification
+    time changes.
+
+    Stored as text with one (possibly trimmed) file per line:
+    path|start_ms|end_ms|size|mtime_ns|sha1
+    """
+
+    def __init__(self, cache_path: typing.Optional[typing.Union[str, Path]] = None):
+        self.cache_path = Path(cache_path) if cache_path else None
+
+        # (path, start_ms, end_ms) -> (size, mtime_ns, hash)
+        self.entries: typing.Dict[
+            typing.Tuple[str, typing.Optional[int], typing.Optional[int]],
+            typing.Tuple[int, int, str],
+        ] = {}
+        self.is_dirty = False
+
+    def load(self):
+        """Load cache file if it exists"""
+        if (self.cache_path is None) or (not self.cache_path.is_file()):
+            return
+
+        with open(self.cache_path, "r") as cache_file:
+            for line in cache_file:
+                line = line.rstrip("\n")
+                if not line:
+                    continue
+
+                try:
+                    (
+                        path_str,
+                        start_str,
+                        end_str,
+                        size_str,
+                        mtime_str,
+                        audio_hash,
+                    ) = line.rsplit("|", maxsplit=5)
+
+                    key = (
+                        path_str,
+                        int(start_str) if start_str else None,
+                        int(end_str) if end_str else None,
+                    )
+                    self.entries[key] = (int(size_str), int(mtime_str), audio_hash)
+                except ValueError:
+                    _LOGGER.warning("Bad line in %s: %s", self.cache_path, line)
+
+        _LOGGER.debug("Loaded %s cached audio hash(es)", len(self.entries))
+
+    def save(self):
+        """Write cache file if anything has changed"""
+        if (self.cache_path is None) or (not self.is_dirty):
+            return
+
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_tmp_path = self.cache_path.with_suffix(".tmp")
+
+        with open(cache_tmp_path, "w") as cache_file:
+            for (path_str, start_ms, end_ms), (size, mtime_ns, audio_hash) in sorted(
+                self.entries.items(), key=lambda kv: (kv[0][0], kv[0][1] or 0)
+            ):
+                print(
+                    path_str,
+                    "" if start_ms is None else start_ms,
+                    "" if end_ms is None else end_ms,
+                    size,
+                    mtime_ns,
+                    audio_hash,
+                    sep="|",
+                    file=cache_file,
+                )
+
+        os.replace(cache_tmp_path, self.cache_path)
+        self.is_dirty = False
+
+    def get(self, key: QAKey) -> typing.Optional[str]:
+        """Get cached hash if the file hasn't changed since"""
+        audio_path, start_ms, end_ms = key
+        path_str = str(Path(audio_path).absolute())
+        entry = self.entries.get((path_str, start_ms, end_ms))
+        if entry is None:
+            return None
+
+        size, mtime_ns, audio_hash = entry
+        try:
+            stat = os.stat(path_str)
+        except OSError:
+            # Deleted since it was cached (hashed again, which fails)
+            return None
+
+        if (stat.st_size != size) or (stat.st_mtime_ns != mtime_ns):
+            return None
+
+        return audio_hash
+
+    def put(self, key: QAKey, audio_hash: str):
+        """Store hash for a file"""
+        audio_path, start_ms, end_ms = key
+        path_str = str(Path(audio_path).absolute())
+        try:
+            stat = os.stat(path_str)
+        except OSError:
+            # Deleted after it was hashed
+            return
+
+        self.entries[(path_str, start_ms, end_ms)] = (
+            stat.st_size,
+            stat.st_mtime_ns,
+            audio_hash,
+        )
+        self.is_dirty = True
+
+
+# -----------------------------------------------------------------------------
+
+
+def hash_keys(
+    keys: typing.Iterable[QAKey],
+    audio_infos: typing.Optional[typing.Mapping[Path, AudioInfo]] = None,
+    cache: typing.Optional[HashCache] = None,
+    max_workers: typing.Optional[int] = None,
+) -> typing.Dict[QAKey, typing.Optional[str]]:
+    """Hash unique (path, start, end) once, in parallel (None if undecodable)"""
+    # Non-Optional for get_key_hash
+    path_infos = audio_infos or {}
+
+    key_hashes: typing.Dict[QAKey, typing.Optional[str]] = {}
+    todo_keys: typing.List[QAKey] = []
+    for key in keys:
+        if key in key_hashes:
+            continue
+
+        key_hashes[key] = cache.get(key) if (cache is not None) else None
+        if key_hashes[key] is None:
+            todo_keys.append(key)
+
+    if todo_keys:
+        _LOGGER.debug(
+            "Hashing %s audio file(s) (%s cached)",
+            len(todo_keys),
+            len(key_hashes) - len(todo_keys),
+        )
+
+        def get_key_hash(key: QAKey) -> typing.Optional[str]:
+            audio_path, start_ms, end_ms = key
+            try:
+                return hash_audio(
+                    audio_path, path_infos.get(audio_path), start_ms, end_ms
+                )
+            except Exception as e:
+                _LOGGER.warning("Failed to hash %s: %s", audio_path, e)
+
+            return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for key, audio_hash in zip(
+                todo_keys, executor.map(get_key_hash, todo_keys)
+            ):
+                key_hashes[key] = audio_hash
+                if (cache is not None) and (audio_hash is not None):
+                    cache.put(key, audio_hash)
+
+    return key_hashes
+
+
+def find_duplicates(
+    keys: typing.Sequence[QAKey],
+    texts: typing.Sequence[str],
+    audio_infos: typing.Optional[typing.Mapping[Path, AudioInfo]] = None,
+    cache: typing.Optional[HashCache] = None,
+    max_workers: typing.Optional[int] = None,
+) -> Duplicates:
+    """Find items with the same decoded audio, hashing in parallel.
+
+    One copy is kept from each cluster: the first one whose transcript is
+    the most common in the cluster. Items that share audio or a normalized
+    transcript are put in the same split group.
+    """
+    assert len(keys) == len(texts)
+    key_hashes = hash_keys(
+        keys, audio_infos=audio_infos, cache=cache, max_workers=max_workers
+    )
+
+    duplicates = Duplicates()
+    norm_texts = [normalize_text(text) for text in texts]
+
+    # audio hash -> item indexes
+    hash_items: typing.Dict[str, typing.List[int]] = defaultdict(list)
+    for item_idx, key in enumerate(keys):
+        audio_hash = key_hashes[key]
+        duplicates.audio_hashes.append(audio_hash)
+        duplicates.clusters.append(item_idx)
+        duplicates.keep.append(True)
+
+        if audio_hash is not None:
+            hash_items[audio_hash].append(item_idx)
+
+    for item_idxs in hash_items.values():
+        if len(item_idxs) < 2:
+            continue
+
+        for item_idx in item_idxs:
+            duplicates.clusters[item_idx] = item_idxs[0]
+
+        text_counts = Counter(norm_texts[i] for i in item_idxs)
+        if len(text_counts) > 1:
+            _LOGGER.warning(
+                "Same audio has %s different transcript(s): %s",
+                len(text_counts),
+                keys[item_idxs[0]][0],
+            )
+
+        best_text = text_counts.most_common(1)[0][0]
+        keep_idx = next(i for i in item_idxs if norm_texts[i] == best_text)
+        for item_idx in item_idxs:
+            duplicates.keep[item_idx] = item_idx == keep_idx
+
+    # Union items with the same audio or transcript
+    parents = list(range(len(keys)))
+
+    def find(item_idx: int) -> int:
+        while parents[item_idx] != item_idx:
+            parents[item_idx] = parents[parents[item_idx]]
+            item_idx = parents[item_idx]
+
+        return item_idx
+
+    text_firsts: typing.Dict[str, int] = {}
+    for item_idx, norm_text in enumerate(norm_texts):
+        cluster_root = find(duplicates.clusters[item_idx])
+        parents[find(item_idx)] = cluster_root
+
+        if norm_text:
+            first_idx = text_firsts.setdefault(norm_text, item_idx)
+            parents[find(item_idx)] = find(first_idx)
+
+    duplicates.split_groups = [find(item_idx) for item_idx in range(len(keys))]
+
+    _LOGGER.debug(
+        "Found %s redundant copies in %s cluster(s) of duplicate audio",
+        duplicates.num_dropped,
+        sum(1 for item_idxs in hash_items.values() if len(item_idxs) > 1),
+    )
+
+    return duplicates
+
+
+def write_report(
+    report_file: typing.TextIO,
+    keys: typing.Sequence[QAKey],
+    texts: typing.Sequence[str],
+    duplicates: Duplicates,
+):
+    """Write tab-separated report of duplicate audio clusters"""
+    print(
+        "cluster",
+        "status",
+        "path",
+        "start_ms",
+        "end_ms",
+        "text",
+        sep="\t",
+        file=report_file,
+    )
+
+    cluster_items: typing.Dict[int, typing.List[int]] = defaultdict(list)
+    for item_idx, cluster in enumerate(duplicates.clusters):
+        cluster_items[cluster].append(item_idx)
+
+    for cluster, item_idxs in sorted(cluster_items.items()):
+        if len(item_idxs) < 2:
+            continue
+
+        for item_idx in item_idxs:
+            audio_path, start_ms, end_ms = keys[item_idx]
+            print(
+                duplicates.audio_hashes[item_idx],
+                "kept" if duplicates.keep[item_idx] else "dropped",
+                audio_path,
+                "" if start_ms is None else start_ms,
+                "" if end_ms is None else end_ms,
+                texts[item_idx],
+                sep="\t",
+                file=report_file,
+            )
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi dedup"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi dedup")
+    parser.add_argument(
+        "audio", nargs="+", help="Audio files or directories with audio files"
+    )
+    parser.add_argument(
+        "--extension",
+        action="append",
+        help="Extension of audio files in directories (default: .wav, .mp3, .flac)",
+    )
+    parser.add_argument("--report", help="Path to write report (default: stdout)")
+    parser.add_argument("--audio-cache", help="Path to cache of probed audio details")
+    parser.add_argument("--hash-cache", help="Path to cache of audio hashes")
+    parser.add_argument("--jobs", type=int, help="Number of files to hash at once")
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    extensions = set(args.extension or [".wav", ".mp3", ".flac"])
+
+    audio_paths: typing.List[Path] = []
+    for audio_path_str in args.audio:
+        audio_path = Path(audio_path_str)
+        if audio_path.is_dir():
+            audio_paths.extend(
+                sorted(p for p in audio_path.rglob("*") if p.suffix in extensions)
+            )
+        else:
+            audio_paths.append(audio_path)
+
+    audio_cache = AudioCache(args.audio_cache)
+    audio_cache.load()
+    audio_infos = audio_cache.probe(audio_paths, max_workers=args.jobs)
+    audio_cache.save()
+
+    hash_cache = HashCache(args.hash_cache)
+    hash_cache.load()
+
+    keys: typing.List[QAKey] = [(p, None, None) for p in audio_paths]
+    texts = [""] * len(keys)
+    duplicates = find_duplicates(
+        keys, texts, audio_infos, cache=hash_cache, max_workers=args.jobs
+    )
+    hash_cache.save()
+
+    if args.report:
+        with open(args.report, "w") as report_file:
+            write_report(report_file, keys, texts, duplicates)
+    else:
+        write_report(sys.stdout, keys, texts, duplicates)
+
+    _LOGGER.info(
+        "Found %s redundant copies in %s file(s)", duplicates.num_dropped, len(keys)
+    )
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+"""Cache of nnet3 chain training examples (egs) shared between trainings.
+
+steps/nnet3/chain/train.py dumps egs from the hires features, i-vectors,
+lattices, and tree before training, which can take hours on large
+corpora. Egs only depend on those inputs and a few options (chunk width,
+frames per iteration, model context), so they can be reused when only
+other hyperparameters change.
+
+run.sh computes a fingerprint of the inputs before training and passes a
+cached egs directory with the same fingerprint as --egs.dir. Otherwise,
+the egs that train.py dumps are moved into the cache afterwards. The least
+recently used entries are removed when the cache grows past its size limit.
+
+Each entry is a directory named after its fingerprint, with a JSON file of
+the same name next to it (size, source, when it was created and last used).
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import re
+import shutil
+import sys
+import time
+import typing
+from dataclasses import dataclass
+from pathlib import Path
+
+from .export import hash_file
+
+_LOGGER = logging.getLogger("ipa2kaldi.egs_cache")
+
+_GB = 1024 ** 3
+
+# Files larger than this are fingerprinted by size and modification time
+_MAX_HASH_SIZE = 16 * 1024 * 1024
+
+# Sub-directories that change without changing the egs
+_IGNORE_DIR_PATTERN = re.compile(r"^(log|q|split\d+(utt)?)$")
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class EgsEntry:
+    """A directory of dumped egs in the cache"""
+
+    key: str
+    path: Path
+    size_bytes: int
+    created: float
+    last_used: float
+    source: str = ""
+
+
+class EgsCache:
+    """Directory of dumped egs keyed by input fingerprint"""
+
+    def __init__(self, cache_dir: Path, max_bytes: typing.Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def entries(self) -> typing.List[EgsEntry]:
+        """Get complete entries, least recently used first"""
+        entries: typing.List[EgsEntry] = []
+        if not self.cache_dir.is_dir():
+            return entries
+
+        for info_path in self.cache_dir.glob("*.json"):
+            entry_dir = info_path.with_suffix("")
+            if not entry_dir.is_dir():
+                continue
+
+            try:
+                with open(info_path, "r") as info_file:
+                    info = json.load(info_file)
+
+                entries.append(
+                    EgsEntry(
+                        key=entry_dir.name,
+                        path=entry_dir,
+                        size_bytes=int(info["size_bytes"]),
+                        created=float(info["created"]),
+                        last_used=float(info["last_used"]),
+                        source=info.get("source", ""),
+                    )
+                )
+            except Exception:
+                _LOGGER.exception("Skipping cache entry %s", entry_dir)
+
+        return sorted(entries, key=lambda e: e.last_used)
+
+    def lookup(self, key: str) -> typing.Optional[Path]:
+        """Get egs directory for a fingerprint (None if not cached)"""
+        for entry in self.entries():
+            if entry.key == key:
+                entry.last_used = time.time()
+                self._write_info(entry)
+                return entry.path
+
+        return None
+
+    def store(self, key: str, egs_dir: Path, source: str = "") -> Path:
+        """Move dumped egs into the cache and evict old entries"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry_dir = self.cache_dir / key
+        if entry_dir.exists():
+            # Same inputs were already cached (e.g., by another recipe)
+            _LOGGER.debug("Replacing %s", entry_dir)
+            self.remove(key)
+
+        # Move to a temporary name first so lookups never see partial egs
+        tmp_dir = self.cache_dir / f"{key}.tmp"
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+
+        shutil.move(str(egs_dir), str(tmp_dir))
+        relocate_egs(tmp_dir, egs_dir, entry_dir)
+        tmp_dir.rename(entry_dir)
+
+        now = time.time()
+        entry = EgsEntry(
+            key=key,
+            path=entry_dir,
+            size_bytes=get_dir_size(entry_dir),
+            created=now,
+            last_used=now,
+            source=source,
+        )
+        self._write_info(entry)
+
+        _LOGGER.info(
+            "Cached %0.1f GB of egs from %s", entry.size_bytes / _GB, source or egs_dir
+        )
+
+        self.evict(keep={key})
+
+        return entry_dir
+
+    def remove(self, key: str):
+        """Delete an entry"""
+        (self.cache_dir / f"{key}.json").unlink()
+        shutil.rmtree(self.cache_dir / key)
+
+    def evict(self, keep: typing.Collection[str] = ()) -> typing.List[EgsEntry]:
+        """Remove least recently used entries until the cache fits max_bytes"""
+        evicted: typing.List[EgsEntry] = []
+        if self.max_bytes is None:
+            return evicted
+
+        entries = self.entries()
+        total_bytes = sum(e.size_bytes for e in entries)
+
+        for entry in entries:
+            if total_bytes <= self.max_bytes:
+                break
+
+            if entry.key in keep:
+                continue
+
+            _LOGGER.info(
+                "Evicting %s (%0.1f GB, last used %s)",
+                entry.key,
+                entry.size_bytes / _GB,
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_used)),
+            )
+            self.remove(entry.key)
+            total_bytes -= entry.size_bytes
+            evicted.append(entry)
+
+        if total_bytes > self.max_bytes:
+            _LOGGER.warning(
+                "Egs cache is %0.1f GB, over its limit of %0.1f GB",
+                total_bytes / _GB,
+                self.max_bytes / _GB,
+            )
+
+        return evicted
+
+    def _write_info(self, entry: EgsEntry):
+        info_path = self.cache_dir / f"{entry.key}.json"
+        info_tmp_path = info_path.with_suffix(".json.tmp")
+        with open(info_tmp_path, "w") as info_file:
+            json.dump(
+                {
+                    "size_bytes": entry.size_bytes,
+                    "created": entry.created,
+                    "last_used": entry.last_used,
+                    "source": entry.source,
+                },
+                info_file,
+                indent=4,
+            )
+
+        info_tmp_path.replace(info_path)
+
+
+# -----------------------------------------------------------------------------
+
+
+def fingerprint_egs_inputs(
+    input_paths: typing.Iterable[Path], options: typing.Mapping[str, str]
+) -> str:
+    """Hash of the files/directories and options that egs are dumped from.
+
+    Small files are hashed by content. Large files (and archives referenced
+    by .scp files) are hashed by size and modification time, so a rebuilt
+    input always changes the fingerprint.
+    """
+    hasher = hashlib.sha256()
+
+    for name, value in sorted(options.items()):
+        hasher.update(f"{name}={value}\n".encode())
+
+    for input_path in input_paths:
+        hasher.update(f"{input_path}\n".encode())
+        if input_path.is_dir():
+            files = sorted(_walk_files(input_path))
+        elif input_path.is_file():
+            files = [input_path]
+        else:
+            raise FileNotFoundError(input_path)
+
+        for file_path in files:
+            hasher.update(str(file_path.relative_to(input_path)).encode())
+            hasher.update(_file_fingerprint(file_path).encode())
+
+            if file_path.suffix == ".scp":
+                for ark_path in sorted(_read_scp_archives(file_path)):
+                    hasher.update(str(ark_path).encode())
+                    hasher.update(_stat_fingerprint(ark_path).encode())
+
+    return hasher.hexdigest()
+
+
+def relocate_egs(egs_dir: Path, old_dir: Path, new_dir: Path):
+    """Point .scp files in egs_dir at new_dir instead of old_dir"""
+    old_prefixes = sorted(
+        set([str(old_dir), str(old_dir.absolute()), str(old_dir.resolve())]),
+        key=len,
+        reverse=True,
+    )
+    old_pattern = re.compile("|".join(re.escape(p) for p in old_prefixes))
+    new_prefix = str(new_dir.resolve())
+
+    for scp_path in egs_dir.rglob("*.scp"):
+        scp_text = scp_path.read_text()
+        new_scp_text = old_pattern.sub(lambda m: new_prefix, scp_text)
+        if new_scp_text != scp_text:
+            scp_path.write_text(new_scp_text)
+
+
+def get_dir_size(dir_path: Path) -> int:
+    """Total bytes of files in a directory (following symlinks)"""
+    return sum(p.stat().st_size for p in dir_path.rglob("*") if p.is_file())
+
+
+def _walk_files(dir_path: Path) -> typing.Iterable[Path]:
+    for child_path in dir_path.iterdir():
+        if child_path.is_dir():
+            if not _IGNORE_DIR_PATTERN.match(child_path.name):
+                yield from _walk_files(child_path)
+        elif child_path.is_file():
+            yield child_path
+
+
+def _file_fingerprint(file_path: Path) -> str:
+    if file_path.stat().st_size > _MAX_HASH_SIZE:
+        return _stat_fingerprint(file_path)
+
+    return hash_file(file_path)[1]
+
+
+def _stat_fingerprint(file_path: Path) -> str:
+    try:
+        file_stat = file_path.stat()
+        return f"{file_stat.st_size} {file_stat.st_mtime_ns}"
+    except OSError:
+        return "missing"
+
+
+def _read_scp_archives(scp_path: Path) -> typing.Set[Path]:
+    """Get archive paths referenced in a Kaldi .scp file (without offsets)"""
+    ark_paths: typing.Set[Path] = set()
+    with open(scp_path, "r") as scp_file:
+        for line in scp_file:
+            parts = line.strip().split(maxsplit=1)
+            if len(parts) < 2 or parts[1].endswith("|"):
+                # Skip commands
+                continue
+
+            ark_path = re.sub(r":\d+$", "", parts[1])
+            ark_paths.add(Path(ark_path))
+
+    return ark_paths
+
+
+# -----------------------------------------------------------------------------
+
+
+def do_fingerprint(args: argparse.Namespace):
+    """Print fingerprint of egs inputs"""
+    options: typing.Dict[str, str] = {}
+    for option_str in args.option:
+        name, value = option_str.split("=", maxsplit=1)
+        options[name] = value
+
+    print(fingerprint_egs_inputs([Path(p) for p in args.input], options))
+
+
+def do_lookup(args: argparse.Namespace):
+    """Print cached egs directory for a fingerprint (nothing if not cached)"""
+    egs_dir = EgsCache(Path(args.cache_dir)).lookup(args.key)
+    if egs_dir is not None:
+        _LOGGER.info("Using cached egs from %s", egs_dir)
+        print(egs_dir.resolve())
+
+
+def do_store(args: argparse.Namespace):
+    """Move dumped egs into the cache"""
+    egs_dir = Path(args.egs_dir)
+    if not (egs_dir / "info").is_dir():
+        _LOGGER.critical("Not an egs directory (missing info/): %s", egs_dir)
+        sys.exit(1)
+
+    cache = EgsCache(Path(args.cache_dir), max_bytes=int(args.max_size_gb * _GB))
+    print(cache.store(args.key, egs_dir, source=args.source or str(egs_dir)))
+
+
+def do_list(args: argparse.Namespace):
+    """Print cache entries"""
+    for entry in EgsCache(Path(args.cache_dir)).entries():
+        print(
+            entry.key,
+            f"{entry.size_bytes / _GB:0.2f}GB",
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_used)),
+            entry.source or "-",
+            sep="\t",
+        )
+
+
+def do_evict(args: argparse.Namespace):
+    """Remove least recently used entries"""
+    cache = EgsCache(Path(args.cache_dir), max_bytes=int(args.max_size_gb * _GB))
+    for entry in cache.evict():
+        print(entry.key)
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi egs-cache"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi egs-cache")
+    sub_parsers = parser.add_subparsers()
+    sub_parsers.required = True
+    sub_parsers.dest = "command"
+
+    # fingerprint
+    fingerprint_parser = sub_parsers.add_parser(
+        "fingerprint", help="Print fingerprint of egs inputs"
+    )
+    fingerprint_parser.add_argument(
+        "--input",
+        action="append",
+        required=True,
+        help="File/directory that egs are dumped from",
+    )
+    fingerprint_parser.add_argument(
+        "--option",
+        action="append",
+        default=[],
+        help="name=value of a train.py option that changes the egs",
+    )
+    fingerprint_parser.set_defaults(func=do_fingerprint)
+
+    # lookup
+    lookup_parser = sub_parsers.add_parser(
+        "lookup", help="Print cached egs directory for a fingerprint"
+    )
+    lookup_parser.add_argument("key", help="Fingerprint of egs inputs")
+    lookup_parser.set_defaults(func=do_lookup)
+
+    # store
+    store_parser = sub_parsers.add_parser(
+        "store", help="Move dumped egs into the cache"
+    )
+    store_parser.add_argument("key", help="Fingerprint of egs inputs")
+    store_parser.add_argument("egs_dir", help="Directory of egs from train.py")
+    store_parser.add_argument("--source", help="Description of where egs came from")
+    store_parser.set_defaults(func=do_store)
+
+    # list
+    list_parser = sub_parsers.add_parser("list", help="Print cache entries")
+    list_parser.set_defaults(func=do_list)
+
+    # evict
+    evict_parser = sub_parsers.add_parser(
+        "evict", help="Remove least recently used entries over the size limit"
+    )
+    evict_parser.set_defaults(func=do_evict)
+
+    # Shared arguments
+    for sub_parser in [lookup_parser, store_parser, list_parser, evict_parser]:
+        sub_parser.add_argument(
+            "--cache-dir", required=True, help="Directory of cached egs"
+        )
+
+    for sub_parser in [store_parser, evict_parser]:
+        sub_parser.add_argument(
+            "--max-size-gb",
+            type=float,
+            default=100,
+            help="Size limit of the cache (default: 100)",
+        )
+
+    for sub_parser in [
+        fingerprint_parser,
+        lookup_parser,
+        store_parser,
+        list_parser,
+        evict_parser,
+    ]:
+        sub_parser.add_argument(
+            "--debug", action="store_true", help="Print DEBUG messages to console"
+        )
+
+    args = parser.parse_args(argv)
+
+    # Log to stderr, since stdout is read by run.sh
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    args.func(args)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
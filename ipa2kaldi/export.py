@@ -0,0 +1,529 @@
+"""Export a trained Kaldi recipe for Rhasspy (like recipe/export.sh).
+
+Files are compressed/copied in parallel, and a manifest.json with sizes and
+SHA-256 checksums is written to the output directory. Files whose source
+content hasn't changed since the last export are skipped.
+
+Exports can also be packed into a single tar archive with the manifest as
+its first member, so it can be verified while being unpacked from a stream.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tarfile
+import typing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+_LOGGER = logging.getLogger("ipa2kaldi.export")
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+_CHUNK_SIZE = 1024 * 1024
+
+_EMPTY_SHA256 = hashlib.sha256().hexdigest()
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class ExportFile:
+    """A file to export from the recipe directory"""
+
+    # Path relative to output directory
+    path: str
+
+    # Source file (None for an empty file)
+    source: typing.Optional[Path] = None
+
+    # gzip file (after decompressing source if it ends in .gz)
+    compress: bool = False
+
+
+def get_export_files(recipe_dir: Path) -> typing.List[ExportFile]:
+    """Get files to export from a trained recipe directory"""
+    lm_dir = recipe_dir / "lm"
+    dict_dir = recipe_dir / "data" / "local" / "dict"
+    nnet3_dir = recipe_dir / "exp" / "nnet3_chain"
+    model_dir = nnet3_dir / "tdnn_250"
+    output_dir = recipe_dir / "data" / "output"
+
+    export_files = [
+        ExportFile(
+            "base_dictionary.txt.gz",
+            _first_existing(dict_dir / "lexicon.txt", dict_dir / "lexicon.txt.gz"),
+            compress=True,
+        ),
+        ExportFile(
+            "base_language_model.txt.gz", get_decoding_lm(lm_dir), compress=True
+        ),
+    ]
+
+    # Grapheme to phoneme model
+    if (output_dir / "g2p.fst").is_file():
+        export_files.extend(
+            [
+                ExportFile("g2p.fst.gz", output_dir / "g2p.fst", compress=True),
+                ExportFile("g2p.corpus.gz", output_dir / "g2p.corpus", compress=True),
+            ]
+        )
+
+    export_files.append(ExportFile("acoustic_model/path.sh"))
+
+    for conf_path in sorted((recipe_dir / "conf").glob("*.conf")):
+        export_files.append(
+            ExportFile(f"acoustic_model/conf/{conf_path.name}", conf_path)
+        )
+
+    for file_name in [
+        "final.dubm",
+        "final.ie",
+        "final.mat",
+        "global_cmvn.stats",
+        "online_cmvn.conf",
+        "splice_opts",
+    ]:
+        export_files.append(
+            ExportFile(
+                f"acoustic_model/extractor/{file_name}",
+                nnet3_dir / "extractor" / file_name,
+            )
+        )
+
+    for conf_path in sorted(
+        (nnet3_dir / "ivectors_test_hires" / "conf").glob("*.conf")
+    ):
+        export_files.append(
+            ExportFile(
+                f"acoustic_model/ivectors_test_hires/conf/{conf_path.name}", conf_path
+            )
+        )
+
+    for file_name in [
+        "cmvn_opts",
+        "den.fst",
+        "final.mdl",
+        "normalization.fst",
+        "tree",
+    ]:
+        export_files.append(
+            ExportFile(f"acoustic_model/model/{file_name}", model_dir / file_name)
+        )
+
+    for file_name in [
+        "extra_questions.txt",
+        "nonsilence_phones.txt",
+        "optional_silence.txt",
+        "silence_phones.txt",
+    ]:
+        export_files.append(
+            ExportFile(f"acoustic_model/phones/{file_name}", dict_dir / file_name)
+        )
+
+    # Base graph (following symlinks)
+    graph_dir = model_dir / "graph"
+    for dir_path, _, file_names in os.walk(graph_dir, followlinks=True):
+        for file_name in sorted(file_names):
+            graph_path = Path(dir_path) / file_name
+            export_files.append(
+                ExportFile(
+                    f"acoustic_model/base_graph/{graph_path.relative_to(graph_dir).as_posix()}",
+                    graph_path,
+                )
+            )
+
+    return export_files
+
+
+def get_decoding_lm(lm_dir: Path) -> Path:
+    """Get the ARPA language model that run.sh made the base graph from.
+
+    This is the pruned model from --prune-lm-ngrams/threshold, unless it is
+    missing or older than lm.arpa.gz.
+    """
+    lm_path = _first_existing(lm_dir / "lm.arpa.gz", lm_dir / "lm.arpa")
+    pruned_lm_path = lm_dir / "lm.pruned.arpa.gz"
+
+    if pruned_lm_path.is_file() and (
+        (not lm_path.is_file())
+        or (pruned_lm_path.stat().st_mtime >= lm_path.stat().st_mtime)
+    ):
+        return pruned_lm_path
+
+    return lm_path
+
+
+def _first_existing(*paths: Path) -> Path:
+    """Get the first path that exists (or the first path)"""
+    for path in paths:
+        if path.exists():
+            return path
+
+    return paths[0]
+
+
+# -----------------------------------------------------------------------------
+
+
+def export_recipe(
+    recipe_dir: Path,
+    output_dir: Path,
+    max_workers: typing.Optional[int] = None,
+    force: bool = False,
+) -> typing.Dict[str, typing.Any]:
+    """Export recipe files to output_dir and write its manifest.
+
+    Returns the manifest.
+    """
+    export_files = get_export_files(recipe_dir)
+    missing_paths = [
+        str(f.source)
+        for f in export_files
+        if (f.source is not None) and (not f.source.is_file())
+    ]
+    if missing_paths:
+        raise FileNotFoundError(f"Missing file(s) to export: {missing_paths}")
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    old_manifest = read_manifest(output_dir) if not force else {}
+    old_entries = {e["path"]: e for e in old_manifest.get("files", [])}
+
+    # Hash sources to find what has changed
+    executor: Executor
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        source_hashes = list(
+            executor.map(
+                lambda f: hash_file(f.source)[1] if f.source else _EMPTY_SHA256,
+                export_files,
+            )
+        )
+
+    entries: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+    todo_files: typing.List[typing.Tuple[ExportFile, str]] = []
+
+    for export_file, source_hash in zip(export_files, source_hashes):
+        old_entry = old_entries.get(export_file.path)
+        dest_path = output_dir / export_file.path
+        if (
+            old_entry
+            and (old_entry.get("source_sha256") == source_hash)
+            and dest_path.is_file()
+            and (dest_path.stat().st_size == old_entry.get("size"))
+        ):
+            # Unchanged
+            entries[export_file.path] = old_entry
+        else:
+            todo_files.append((export_file, source_hash))
+
+    _LOGGER.debug("Exporting %s file(s) (%s unchanged)", len(todo_files), len(entries))
+
+    if todo_files:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for (export_file, source_hash), (size, sha256) in zip(
+                todo_files,
+                executor.map(
+                    _export_file,
+                    [f.source for f, _ in todo_files],
+                    [output_dir / f.path for f, _ in todo_files],
+                    [f.compress for f, _ in todo_files],
+                ),
+            ):
+                _LOGGER.debug("Exported %s", export_file.path)
+                entries[export_file.path] = {
+                    "path": export_file.path,
+                    "size": size,
+                    "sha256": sha256,
+                    "source_sha256": source_hash,
+                }
+
+    # Remove files from previous export that are no longer exported
+    for old_path in old_entries:
+        if old_path not in entries:
+            stale_path = output_dir / old_path
+            if stale_path.is_file():
+                _LOGGER.debug("Removing %s", stale_path)
+                stale_path.unlink()
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "files": [entries[f.path] for f in export_files],
+    }
+
+    manifest_tmp_path = output_dir / (MANIFEST_NAME + ".tmp")
+    with open(manifest_tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+    os.replace(manifest_tmp_path, output_dir / MANIFEST_NAME)
+
+    return manifest
+
+
+def _export_file(
+    source_path: typing.Optional[Path], dest_path: Path, compress: bool
+) -> typing.Tuple[int, str]:
+    """Copy or gzip a file, returning the size and SHA-256 of what was written"""
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    dest_tmp_path = dest_path.with_name(dest_path.name + ".tmp")
+
+    with open(dest_tmp_path, "wb") as dest_file:
+        hashing_file = _HashingWriter(dest_file)
+        if source_path is not None:
+            with open(source_path, "rb") as raw_source_file:
+                source_file: typing.BinaryIO = raw_source_file
+                if compress and (source_path.suffix == ".gz"):
+                    # Re-compress at maximum level
+                    source_file = gzip.GzipFile(fileobj=raw_source_file, mode="rb")  # type: ignore
+
+                if compress:
+                    # Like gzip -9 --no-name
+                    with gzip.GzipFile(
+                        filename="",
+                        mode="wb",
+                        compresslevel=9,
+                        fileobj=hashing_file,  # type: ignore
+                        mtime=0,
+                    ) as gzip_file:
+                        shutil.copyfileobj(source_file, gzip_file, _CHUNK_SIZE)
+                else:
+                    shutil.copyfileobj(source_file, hashing_file, _CHUNK_SIZE)  # type: ignore
+
+    os.replace(dest_tmp_path, dest_path)
+
+    return hashing_file.size, hashing_file.hasher.hexdigest()
+
+
+class _HashingWriter:
+    """Writes to a file while computing its size and SHA-256"""
+
+    def __init__(self, target_file: typing.BinaryIO):
+        self.target_file = target_file
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        """Write data to the target file and hash it"""
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.target_file.write(data)
+
+    def flush(self):
+        """Flush the target file"""
+        self.target_file.flush()
+
+
+def hash_file(file_path: typing.Union[str, Path]) -> typing.Tuple[int, str]:
+    """Get size and SHA-256 of a file"""
+    hasher = hashlib.sha256()
+    size = 0
+    with open(file_path, "rb") as hash_input:
+        for chunk in iter(lambda: hash_input.read(_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+            size += len(chunk)
+
+    return size, hasher.hexdigest()
+
+
+def read_manifest(output_dir: Path) -> typing.Dict[str, typing.Any]:
+    """Load manifest from an export directory (empty if missing)"""
+    manifest_path = output_dir / MANIFEST_NAME
+    if not manifest_path.is_file():
+        return {}
+
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def verify_export(
+    output_dir: Path, max_workers: typing.Optional[int] = None
+) -> typing.List[str]:
+    """Check exported files against the manifest.
+
+    Returns paths of files that are missing or don't match.
+    """
+    manifest = read_manifest(output_dir)
+    if not manifest:
+        raise ValueError(f"No {MANIFEST_NAME} in {output_dir}")
+
+    def check(entry: typing.Dict[str, typing.Any]) -> bool:
+        file_path = output_dir / entry["path"]
+        if (not file_path.is_file()) or (file_path.stat().st_size != entry["size"]):
+            return False
+
+        return hash_file(file_path) == (entry["size"], entry["sha256"])
+
+    entries = manifest["files"]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [
+            entry["path"]
+            for entry, is_ok in zip(entries, executor.map(check, entries))
+            if not is_ok
+        ]
+
+
+# -----------------------------------------------------------------------------
+
+
+def write_archive(output_dir: Path, archive_path: Path):
+    """Pack an export directory into a tar archive (manifest first)"""
+    manifest = read_manifest(output_dir)
+    if not manifest:
+        raise ValueError(f"No {MANIFEST_NAME} in {output_dir}")
+
+    archive_tmp_path = archive_path.with_name(archive_path.name + ".tmp")
+    with tarfile.open(archive_tmp_path, mode="w|") as archive:
+        archive.add(str(output_dir / MANIFEST_NAME), arcname=MANIFEST_NAME)
+        for entry in manifest["files"]:
+            archive.add(str(output_dir / entry["path"]), arcname=entry["path"])
+
+    os.replace(archive_tmp_path, archive_path)
+
+
+def unpack_archive(
+    archive_file: typing.BinaryIO, output_dir: Path
+) -> typing.Dict[str, typing.Any]:
+    """Unpack an archive from write_archive, verifying each file as it's read.
+
+    Files are written with a .tmp suffix and renamed once verified.
+    Returns the manifest.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest: typing.Dict[str, typing.Any] = {}
+    entries: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+    unpacked: typing.Set[str] = set()
+
+    with tarfile.open(fileobj=archive_file, mode="r|") as archive:
+        for member in archive:
+            member_file = archive.extractfile(member)
+            if member_file is None:
+                # Directories, etc.
+                continue
+
+            if not manifest:
+                if member.name != MANIFEST_NAME:
+                    raise ValueError(
+                        f"Expected {MANIFEST_NAME} first, got {member.name}"
+                    )
+
+                manifest = json.load(member_file)
+                entries = {e["path"]: e for e in manifest["files"]}
+                continue
+
+            entry = entries.get(member.name)
+            if entry is None:
+                raise ValueError(f"{member.name} is not in {MANIFEST_NAME}")
+
+            dest_path = (output_dir / member.name).resolve()
+            if output_dir.resolve() not in dest_path.parents:
+                raise ValueError(
+                    f"Refusing to unpack outside {output_dir}: {member.name}"
+                )
+
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            dest_tmp_path = dest_path.with_name(dest_path.name + ".tmp")
+            with open(dest_tmp_path, "wb") as dest_file:
+                hashing_file = _HashingWriter(dest_file)
+                shutil.copyfileobj(member_file, hashing_file, _CHUNK_SIZE)  # type: ignore
+
+            if (hashing_file.size, hashing_file.hasher.hexdigest()) != (
+                entry["size"],
+                entry["sha256"],
+            ):
+                dest_tmp_path.unlink()
+                raise ValueError(f"Checksum mismatch: {member.name}")
+
+            os.replace(dest_tmp_path, dest_path)
+            unpacked.add(member.name)
+
+    missing_paths = set(entries) - unpacked
+    if missing_paths:
+        raise ValueError(f"Missing file(s) from archive: {sorted(missing_paths)}")
+
+    with open(output_dir / MANIFEST_NAME, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+    return manifest
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi export"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi export")
+    parser.add_argument(
+        "--output-dir", required=True, help="Directory to export to (or unpack into)"
+    )
+    parser.add_argument("--recipe-dir", help="Path to trained Kaldi recipe dir")
+    parser.add_argument("--archive", help="Also pack export into this tar file")
+    parser.add_argument(
+        "--unpack",
+        help="Unpack and verify an archive into --output-dir instead (- for stdin)",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Verify files in --output-dir against its manifest instead",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Re-export files even if unchanged"
+    )
+    parser.add_argument(
+        "--jobs", type=int, help="Number of files to export in parallel"
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    output_dir = Path(args.output_dir)
+
+    if args.unpack:
+        if args.unpack == "-":
+            manifest = unpack_archive(sys.stdin.buffer, output_dir)
+        else:
+            with open(args.unpack, "rb") as archive_file:
+                manifest = unpack_archive(archive_file, output_dir)
+
+        _LOGGER.info("Unpacked %s file(s) to %s", len(manifest["files"]), output_dir)
+        return
+
+    if args.verify:
+        bad_paths = verify_export(output_dir, max_workers=args.jobs)
+        if bad_paths:
+            _LOGGER.error(
+                "%s file(s) failed verification: %s", len(bad_paths), bad_paths
+            )
+            sys.exit(1)
+
+        _LOGGER.info("All files verified")
+        return
+
+    if not args.recipe_dir:
+        parser.error("--recipe-dir is required (unless --unpack or --verify)")
+
+    manifest = export_recipe(
+        Path(args.recipe_dir), output_dir, max_workers=args.jobs, force=args.force
+    )
+    _LOGGER.info("Exported %s file(s) to %s", len(manifest["files"]), output_dir)
+
+    if args.archive:
+        write_archive(output_dir, Path(args.archive))
+        _LOGGER.info("Wrote %s", args.archive)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,866 @@
+"""Streaming n-gram language model builder for ipa2kaldi.
+
+Counts are kept on disk in sorted text files ("key<TAB>value" lines, where
+key is an n-gram with words separated by spaces). Every pass streams over
+these files and merges them, so memory use is bounded by the size of the
+in-memory sort buffers rather than the number of distinct n-grams.
+"""
+import argparse
+import heapq
+import logging
+import math
+import os
+import tempfile
+import typing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from .utils import maybe_gzip_open
+
+_LOGGER = logging.getLogger("ipa2kaldi.lm")
+
+BOS = "<s>"
+EOS = "</s>"
+
+# log10 probability for impossible words (e.g., <s>)
+LOG_ZERO = -99.0
+
+# Noisy variants of utterances (see generate_noisy) have noise labels
+_NOISY_SUFFIX = "-n"
+
+# Maximum number of sorted runs to merge at once
+_MAX_MERGE_RUNS = 128
+
+# Size of plain text shards for parallel counting
+_SHARD_BYTES = 64 * 1024 * 1024
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class TextShard:
+    """Byte range of a text file to count n-grams from"""
+
+    path: Path
+    is_kaldi_text: bool = False
+    start: int = 0
+    end: typing.Optional[int] = None
+
+
+def build_lm(
+    arpa_path: typing.Union[str, Path],
+    text_paths: typing.Iterable[typing.Union[str, Path]] = (),
+    kaldi_text_paths: typing.Iterable[typing.Union[str, Path]] = (),
+    order: int = 3,
+    smoothing: str = "kneser-ney",
+    min_counts: typing.Optional[typing.List[int]] = None,
+    unknown_word: typing.Optional[str] = "<unk>",
+    max_ngrams_in_memory: int = 5_000_000,
+    max_workers: typing.Optional[int] = None,
+    temp_dir: typing.Optional[typing.Union[str, Path]] = None,
+):
+    """Count n-grams from text files and write a smoothed ARPA language model.
+
+    text_paths have one sentence per line. kaldi_text_paths are Kaldi text
+    files, where the first word of each line is the utterance id.
+
+    min_counts has the minimum raw count for each order (1-grams are never
+    pruned). Counts must not decrease with order, so that every kept n-gram
+    still has its prefix and suffix.
+    """
+    if order < 1:
+        raise ValueError(f"Order must be at least 1: {order}")
+
+    if smoothing not in {"kneser-ney", "witten-bell"}:
+        raise ValueError(f"Bad smoothing: {smoothing}")
+
+    min_counts = list(min_counts or [])
+    min_counts = (min_counts + [min_counts[-1] if min_counts else 1] * order)[:order]
+    min_counts[0] = 1
+    for n in range(1, order):
+        min_counts[n] = max(min_counts[n], min_counts[n - 1])
+
+    shards = list(make_shards(text_paths, kaldi_text_paths))
+    if not shards:
+        raise ValueError("No text to build language model from")
+
+    with tempfile.TemporaryDirectory(prefix="ipa2kaldi-lm-", dir=temp_dir) as work_str:
+        work_dir = Path(work_str)
+        run_dir = work_dir / "runs"
+        run_dir.mkdir()
+
+        # ---------------------------------------------------------------------
+        # 1. Count n-grams of all orders in parallel shards
+        # ---------------------------------------------------------------------
+
+        _LOGGER.debug("Counting n-grams in %s shard(s)", len(shards))
+        order_runs: typing.List[typing.List[str]] = [[] for _ in range(order)]
+
+        # Same default as ProcessPoolExecutor, but no more workers than shards
+        num_workers = min(len(shards), max_workers or os.cpu_count() or 1)
+        worker_max_ngrams = max(1, max_ngrams_in_memory // num_workers)
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for shard_runs in executor.map(
+                _count_shard,
+                shards,
+                [order] * len(shards),
+                [worker_max_ngrams] * len(shards),
+                [str(run_dir)] * len(shards),
+            ):
+                for n, runs in enumerate(shard_runs):
+                    order_runs[n].extend(runs)
+
+        counts_paths = []
+        for n in range(1, order + 1):
+            counts_path = work_dir / f"counts.{n}.txt"
+            num_ngrams = _write_records(
+                counts_path,
+                (
+                    (key, str(count))
+                    for key, count in _merge_counts(order_runs[n - 1], run_dir)
+                ),
+            )
+            _LOGGER.debug("%s-grams: %s", n, num_ngrams)
+            counts_paths.append(counts_path)
+
+            for run_path in order_runs[n - 1]:
+                os.unlink(run_path)
+
+        # ---------------------------------------------------------------------
+        # 2. Adjusted counts (Kneser-Ney continuation counts) and pruning
+        # ---------------------------------------------------------------------
+
+        adjusted_paths = []
+        counts_of_counts = []
+        for n in range(1, order + 1):
+            adjusted_path = work_dir / f"adjusted.{n}.txt"
+            continuations: typing.Optional[typing.Iterator[typing.Tuple[str, int]]] = (
+                None
+            )
+
+            if (smoothing == "kneser-ney") and (n < order):
+                # Number of distinct words to the left of each n-gram
+                sorter = ExternalSorter(
+                    work_dir, max_ngrams_in_memory, combine_counts=True
+                )
+                for key, _ in _read_records(counts_paths[n]):
+                    sorter.add_count(key.split(" ", maxsplit=1)[1])
+
+                continuations = sorter.counts()
+
+            coc = [0] * 5
+            _write_records(
+                adjusted_path,
+                _adjust_counts(
+                    _read_records(counts_paths[n - 1]),
+                    continuations,
+                    min_count=min_counts[n - 1],
+                    counts_of_counts=coc,
+                ),
+            )
+            counts_of_counts.append(coc)
+            adjusted_paths.append(adjusted_path)
+
+        # ---------------------------------------------------------------------
+        # 3. Probabilities and backoff weights, lowest order first
+        # ---------------------------------------------------------------------
+
+        prob_paths = []
+        bow_paths: typing.List[typing.Optional[Path]] = [None] * order
+        prev_rev_path: typing.Optional[Path] = None
+        num_unigrams = 0
+
+        for n in range(1, order + 1):
+            discounts = _get_discounts(counts_of_counts[n - 1])
+            if smoothing == "kneser-ney":
+                _LOGGER.debug("%s-gram discounts: %s", n, discounts)
+
+            # Context statistics
+            contexts_path = work_dir / f"contexts.{n}.txt"
+            _write_records(
+                contexts_path, _context_stats(_read_records(adjusted_paths[n - 1]))
+            )
+
+            # alpha/gamma sorted by reversed n-gram
+            rev_sorter = ExternalSorter(work_dir, max_ngrams_in_memory)
+            has_unknown = False
+            for key, alpha, gamma in _interpolation_weights(
+                _read_records(adjusted_paths[n - 1]),
+                _read_records(contexts_path),
+                smoothing,
+                discounts,
+            ):
+                if (n == 1) and (key == unknown_word):
+                    has_unknown = True
+
+                rev_sorter.add(_reverse_key(key), f"{alpha!r}\t{gamma!r}")
+
+            if (n == 1) and unknown_word and (not has_unknown):
+                # <unk> only gets interpolated probability
+                gamma_empty = _empty_context_gamma(
+                    _read_records(contexts_path), smoothing, discounts
+                )
+                rev_sorter.add(unknown_word, f"0.0\t{gamma_empty!r}")
+
+            if n == 1:
+                num_unigrams = sum(1 for key, _ in rev_sorter.records() if key != BOS)
+
+            # Interpolate with lower order
+            rev_path = work_dir / f"probs_rev.{n}.txt"
+            fwd_sorter = ExternalSorter(work_dir, max_ngrams_in_memory)
+
+            with open(rev_path, "w") as rev_file:
+                for rev_key, prob, lower_prob in _interpolate(
+                    rev_sorter.records(),
+                    _read_records(prev_rev_path) if prev_rev_path else None,
+                    uniform_prob=1.0 / max(1, num_unigrams),
+                ):
+                    print(rev_key, repr(prob), sep="\t", file=rev_file)
+                    fwd_sorter.add(_reverse_key(rev_key), f"{prob!r}\t{lower_prob!r}")
+
+            # Backoff weights for contexts of this order
+            prob_path = work_dir / f"probs.{n}.txt"
+            bows = _backoff_weights(fwd_sorter.records(), prob_path)
+            if n > 1:
+                bow_path = work_dir / f"bows.{n - 1}.txt"
+                _write_records(bow_path, bows)
+                bow_paths[n - 2] = bow_path
+            else:
+                for _ in bows:
+                    pass
+
+            prob_paths.append(prob_path)
+            prev_rev_path = rev_path
+
+        # ---------------------------------------------------------------------
+        # 4. ARPA file
+        # ---------------------------------------------------------------------
+
+        write_arpa(arpa_path, prob_paths, bow_paths)
+
+
+# -----------------------------------------------------------------------------
+
+
+def write_arpa(
+    arpa_path: typing.Union[str, Path],
+    prob_paths: typing.List[Path],
+    bow_paths: typing.List[typing.Optional[Path]],
+):
+    """Write ARPA file from sorted probability and backoff weight records"""
+    ngram_counts = [sum(1 for _ in _read_records(p)) for p in prob_paths]
+
+    with maybe_gzip_open(arpa_path, "w") as arpa_file:
+        print("", file=arpa_file)
+        print("\\data\\", file=arpa_file)
+        for n, num_ngrams in enumerate(ngram_counts, start=1):
+            print(f"ngram {n}={num_ngrams}", file=arpa_file)
+
+        for n, (prob_path, bow_path) in enumerate(zip(prob_paths, bow_paths), start=1):
+            print("", file=arpa_file)
+            print(f"\\{n}-grams:", file=arpa_file)
+
+            bows = _read_records(bow_path) if bow_path else iter(())
+            bow_key, bow_value = next(bows, (None, ""))
+
+            for key, prob_str in _read_records(prob_path):
+                prob = float(prob_str)
+                log_prob = math.log10(prob) if prob > 0 else LOG_ZERO
+
+                while (bow_key is not None) and (bow_key < key):
+                    bow_key, bow_value = next(bows, (None, ""))
+
+                if bow_key == key:
+                    print(
+                        f"{log_prob:.6f}",
+                        key,
+                        f"{math.log10(float(bow_value)):.6f}",
+                        sep="\t",
+                        file=arpa_file,
+                    )
+                else:
+                    print(f"{log_prob:.6f}", key, sep="\t", file=arpa_file)
+
+        print("", file=arpa_file)
+        print("\\end\\", file=arpa_file)
+
+    _LOGGER.debug("Wrote %s n-gram(s) to %s", sum(ngram_counts), arpa_path)
+
+
+def make_shards(
+    text_paths: typing.Iterable[typing.Union[str, Path]],
+    kaldi_text_paths: typing.Iterable[typing.Union[str, Path]] = (),
+    shard_bytes: int = _SHARD_BYTES,
+) -> typing.Iterable[TextShard]:
+    """Split text files into byte ranges that can be counted in parallel"""
+    for paths, is_kaldi_text in [(text_paths, False), (kaldi_text_paths, True)]:
+        for path in paths:
+            path = Path(path)
+            if path.suffix == ".gz":
+                # Can't seek in gzip files, so they're counted by one worker
+                _LOGGER.info(
+                    "Counting %s in a single shard (decompress it to count in parallel)",
+                    path,
+                )
+                yield TextShard(path=path, is_kaldi_text=is_kaldi_text)
+                continue
+
+            file_size = path.stat().st_size
+            for start in range(0, max(1, file_size), shard_bytes):
+                yield TextShard(
+                    path=path,
+                    is_kaldi_text=is_kaldi_text,
+                    start=start,
+                    end=start + shard_bytes,
+                )
+
+
+def read_shard(shard: TextShard) -> typing.Iterable[typing.List[str]]:
+    """Yield words of each sentence that starts in the shard"""
+    if shard.path.suffix == ".gz":
+        with maybe_gzip_open(shard.path, "r") as text_file:
+            for line in text_file:
+                words = _line_words(line, shard.is_kaldi_text)
+                if words:
+                    yield words
+
+        return
+
+    with open(shard.path, "rb") as text_file:
+        if shard.start > 0:
+            # Skip partial line (belongs to previous shard)
+            text_file.seek(shard.start - 1)
+            text_file.readline()
+
+        while (shard.end is None) or (text_file.tell() < shard.end):
+            line_bytes = text_file.readline()
+            if not line_bytes:
+                break
+
+            words = _line_words(line_bytes.decode("utf-8"), shard.is_kaldi_text)
+            if words:
+                yield words
+
+
+def _line_words(line: str, is_kaldi_text: bool) -> typing.List[str]:
+    """Split line into words, dropping Kaldi utterance id"""
+    words = line.split()
+    if is_kaldi_text and words:
+        if words[0].endswith(_NOISY_SUFFIX):
+            # Skip noisy variants
+            return []
+
+        words = words[1:]
+
+    return words
+
+
+def _count_shard(
+    shard: TextShard, order: int, max_ngrams: int, run_dir: str
+) -> typing.List[typing.List[str]]:
+    """Count n-grams in a shard, writing sorted runs when memory is full"""
+    counts: typing.List[typing.Counter[str]] = [Counter() for _ in range(order)]
+    runs: typing.List[typing.List[str]] = [[] for _ in range(order)]
+
+    def flush():
+        for n, order_counts in enumerate(counts):
+            if order_counts:
+                runs[n].append(
+                    _write_run(
+                        Path(run_dir),
+                        ((key, str(count)) for key, count in order_counts.items()),
+                    )
+                )
+                order_counts.clear()
+
+    for words in read_shard(shard):
+        words = [BOS] + words + [EOS]
+        for n in range(1, order + 1):
+            order_counts = counts[n - 1]
+            for i in range(len(words) - n + 1):
+                order_counts[" ".join(words[i : i + n])] += 1
+
+        if sum(len(c) for c in counts) >= max_ngrams:
+            flush()
+
+    flush()
+
+    return runs
+
+
+def _adjust_counts(
+    raw_counts: typing.Iterator[typing.Tuple[str, str]],
+    continuations: typing.Optional[typing.Iterator[typing.Tuple[str, int]]],
+    min_count: int,
+    counts_of_counts: typing.List[int],
+) -> typing.Iterable[typing.Tuple[str, str]]:
+    """Yield n-gram -> adjusted count, keep flag.
+
+    Adjusted counts are continuation counts, except for n-grams that start
+    with <s> (which can't be extended to the left).
+    """
+    cont_key, cont_count = (None, 0)
+    if continuations is not None:
+        cont_key, cont_count = next(continuations, (None, 0))
+
+    for key, count_str in raw_counts:
+        count = int(count_str)
+        adjusted = count
+
+        if continuations is not None:
+            while (cont_key is not None) and (cont_key < key):
+                cont_key, cont_count = next(continuations, (None, 0))
+
+            if (cont_key == key) and (not key.startswith(BOS + " ")) and (key != BOS):
+                adjusted = cont_count
+
+        counts_of_counts[min(adjusted, 4)] += 1
+        keep = 1 if (count >= min_count) else 0
+
+        yield key, f"{adjusted}\t{keep}"
+
+
+def _get_discounts(coc: typing.List[int]) -> typing.Tuple[float, float, float]:
+    """Modified Kneser-Ney discounts from counts of counts"""
+    defaults = (0.5, 1.0, 1.5)
+    n1, n2, n3, n4 = coc[1], coc[2], coc[3], coc[4]
+    if min(n1, n2, n3, n4) <= 0:
+        return defaults
+
+    y = n1 / (n1 + (2 * n2))
+    discounts = (
+        1 - (2 * y * n2 / n1),
+        2 - (3 * y * n3 / n2),
+        3 - (4 * y * n4 / n3),
+    )
+
+    return tuple(  # type: ignore
+        min(max(d, 0.0), float(i + 1)) if d > 0 else defaults[i]
+        for i, d in enumerate(discounts)
+    )
+
+
+def _context_of(key: str) -> str:
+    """Get context (all but last word) of an n-gram"""
+    return key.rsplit(" ", maxsplit=1)[0] if (" " in key) else ""
+
+
+def _context_stats(
+    adjusted: typing.Iterator[typing.Tuple[str, str]],
+) -> typing.Iterable[typing.Tuple[str, str]]:
+    """Yield context -> total, types, n1, n2, n3+ over adjusted counts"""
+    context: typing.Optional[str] = None
+    stats = [0] * 5
+
+    for key, value in adjusted:
+        if key == BOS:
+            # <s> is never predicted
+            continue
+
+        key_context = _context_of(key)
+        if key_context != context:
+            if context is not None:
+                yield context, "\t".join(str(s) for s in stats)
+
+            context = key_context
+            stats = [0] * 5
+
+        count = int(value.split("\t", maxsplit=1)[0])
+        stats[0] += count
+        stats[1] += 1
+        stats[1 + min(count, 3)] += 1
+
+    if context is not None:
+        yield context, "\t".join(str(s) for s in stats)
+
+
+def _gamma(
+    stats: typing.List[int], smoothing: str, discounts: typing.Tuple[float, ...]
+) -> float:
+    """Weight of lower order distribution for a context"""
+    total, types, n1, n2, n3p = stats
+    if smoothing == "kneser-ney":
+        if total <= 0:
+            return 1.0
+
+        return (
+            (discounts[0] * n1) + (discounts[1] * n2) + (discounts[2] * n3p)
+        ) / total
+
+    # Witten-Bell
+    return types / (total + types) if (total + types) > 0 else 1.0
+
+
+def _empty_context_gamma(
+    contexts: typing.Iterator[typing.Tuple[str, str]],
+    smoothing: str,
+    discounts: typing.Tuple[float, ...],
+) -> float:
+    """Get gamma of the unigram (empty) context"""
+    for context, value in contexts:
+        if context == "":
+            return _gamma([int(v) for v in value.split("\t")], smoothing, discounts)
+
+    return 1.0
+
+
+def _interpolation_weights(
+    adjusted: typing.Iterator[typing.Tuple[str, str]],
+    contexts: typing.Iterator[typing.Tuple[str, str]],
+    smoothing: str,
+    discounts: typing.Tuple[float, ...],
+) -> typing.Iterable[typing.Tuple[str, float, float]]:
+    """Yield kept n-gram, alpha, gamma where
+    p(w|h) = alpha(h, w) + gamma(h) * p(w|h')
+    """
+    context, stats_str = next(contexts, ("", "0\t0\t0\t0\t0"))
+    stats = [int(v) for v in stats_str.split("\t")]
+    gamma = _gamma(stats, smoothing, discounts)
+
+    for key, value in adjusted:
+        count_str, keep_str = value.split("\t")
+        if keep_str != "1":
+            continue
+
+        if key == BOS:
+            # <s> is never predicted
+            yield key, 0.0, 0.0
+            continue
+
+        key_context = _context_of(key)
+        while key_context != context:
+            next_context = next(contexts, None)
+            if next_context is None:
+                raise ValueError(f"No context statistics for n-gram {key!r}")
+
+            context, stats_str = next_context
+            stats = [int(v) for v in stats_str.split("\t")]
+            gamma = _gamma(stats, smoothing, discounts)
+
+        count = int(count_str)
+        total, types = stats[0], stats[1]
+        if smoothing == "kneser-ney":
+            discount = discounts[min(count, 3) - 1] if count > 0 else 0.0
+            alpha = max(count - discount, 0.0) / total if total > 0 else 0.0
+        else:
+            alpha = count / (total + types) if (total + types) > 0 else 0.0
+
+        yield key, alpha, gamma
+
+
+def _interpolate(
+    weights: typing.Iterator[typing.Tuple[str, str]],
+    lower_probs: typing.Optional[typing.Iterator[typing.Tuple[str, str]]],
+    uniform_prob: float,
+) -> typing.Iterable[typing.Tuple[str, float, float]]:
+    """Yield reversed n-gram, probability, lower order probability.
+
+    Both inputs are sorted by reversed n-gram, so the lower order n-gram
+    (reversed n-gram without its last word) is found by merging.
+    """
+    lower_key, lower_prob = (None, uniform_prob)
+    if lower_probs is not None:
+        lower_key, lower_value = next(lower_probs, (None, "0"))
+        lower_prob = float(lower_value)
+
+    for rev_key, value in weights:
+        alpha_str, gamma_str = value.split("\t")
+        alpha, gamma = float(alpha_str), float(gamma_str)
+
+        if rev_key == BOS:
+            yield rev_key, 0.0, 0.0
+            continue
+
+        if lower_probs is not None:
+            rev_lower = _context_of(rev_key)
+            while (lower_key is not None) and (lower_key < rev_lower):
+                lower_key, lower_value = next(lower_probs, (None, "0"))
+                lower_prob = float(lower_value)
+
+            if lower_key != rev_lower:
+                # Should not happen if counts are monotonic
+                _LOGGER.warning("Missing lower order n-gram: %s", rev_lower)
+                yield rev_key, alpha, 0.0
+                continue
+
+        yield rev_key, alpha + (gamma * lower_prob), lower_prob
+
+
+def _backoff_weights(
+    probs: typing.Iterator[typing.Tuple[str, str]], prob_path: Path
+) -> typing.Iterable[typing.Tuple[str, str]]:
+    """Write forward-sorted probabilities and yield context -> backoff weight.
+
+    bow(h) = (1 - sum p(w|h)) / (1 - sum p(w|h')) over kept words w
+    """
+    context: typing.Optional[str] = None
+    sum_prob = 0.0
+    sum_lower = 0.0
+
+    with open(prob_path, "w") as prob_file:
+        for key, value in probs:
+            prob_str, lower_str = value.split("\t")
+            print(key, prob_str, sep="\t", file=prob_file)
+
+            key_context = _context_of(key)
+            if key_context != context:
+                if context is not None:
+                    yield context, repr(_backoff(sum_prob, sum_lower))
+
+                context = key_context
+                sum_prob = 0.0
+                sum_lower = 0.0
+
+            sum_prob += float(prob_str)
+            sum_lower += float(lower_str)
+
+        if context is not None:
+            yield context, repr(_backoff(sum_prob, sum_lower))
+
+
+def _backoff(sum_prob: float, sum_lower: float) -> float:
+    """Backoff weight that normalizes a context's distribution"""
+    return max(1.0 - sum_prob, 1e-12) / max(1.0 - sum_lower, 1e-12)
+
+
+def _reverse_key(key: str) -> str:
+    """Reverse words of an n-gram"""
+    return " ".join(reversed(key.split(" ")))
+
+
+# -----------------------------------------------------------------------------
+
+
+class ExternalSorter:
+    """Sorts key/value records with bounded memory using sorted runs on disk"""
+
+    def __init__(self, temp_dir: Path, max_records: int, combine_counts: bool = False):
+        self.temp_dir = temp_dir
+        self.max_records = max(1, max_records)
+        self.combine_counts = combine_counts
+
+        self.buffer: typing.List[typing.Tuple[str, str]] = []
+        self.count_buffer: typing.Counter[str] = Counter()
+        self.runs: typing.List[str] = []
+
+    def add(self, key: str, value: str):
+        """Add a record"""
+        self.buffer.append((key, value))
+        if len(self.buffer) >= self.max_records:
+            self._flush()
+
+    def add_count(self, key: str, count: int = 1):
+        """Add to the count of a key (combine_counts only)"""
+        self.count_buffer[key] += count
+        if len(self.count_buffer) >= self.max_records:
+            self._flush()
+
+    def records(self) -> typing.Iterator[typing.Tuple[str, str]]:
+        """Get all records sorted by key"""
+        if not self.runs:
+            return iter(sorted(self._buffered(), key=_record_key))
+
+        self._flush()
+        return iter(_merge_runs(self.runs, self.temp_dir))
+
+    def counts(self) -> typing.Iterator[typing.Tuple[str, int]]:
+        """Get summed counts sorted by key (combine_counts only)"""
+        if not self.runs:
+            return iter(sorted(self.count_buffer.items()))
+
+        self._flush()
+        return _merge_counts(self.runs, self.temp_dir)
+
+    def _buffered(self) -> typing.Iterable[typing.Tuple[str, str]]:
+        if self.combine_counts:
+            return ((key, str(count)) for key, count in self.count_buffer.items())
+
+        return self.buffer
+
+    def _flush(self):
+        records = list(self._buffered())
+        if records:
+            self.runs.append(_write_run(self.temp_dir, records))
+
+        self.buffer = []
+        self.count_buffer = Counter()
+
+
+def _record_key(record: typing.Tuple[str, str]) -> str:
+    return record[0]
+
+
+def _write_run(run_dir: Path, records: typing.Iterable[typing.Tuple[str, str]]) -> str:
+    """Write sorted records to a temporary run file"""
+    run_fd, run_path = tempfile.mkstemp(dir=run_dir, suffix=".run")
+    with open(run_fd, "w") as run_file:
+        for key, value in sorted(records, key=_record_key):
+            print(key, value, sep="\t", file=run_file)
+
+    return run_path
+
+
+def _write_records(
+    records_path: Path, records: typing.Iterable[typing.Tuple[str, str]]
+) -> int:
+    """Write records to a file and return how many were written"""
+    num_records = 0
+    with open(records_path, "w") as records_file:
+        for key, value in records:
+            print(key, value, sep="\t", file=records_file)
+            num_records += 1
+
+    return num_records
+
+
+def _read_records(
+    records_path: typing.Union[str, Path],
+) -> typing.Iterator[typing.Tuple[str, str]]:
+    """Read key/value records from a file"""
+    with open(records_path, "r") as records_file:
+        for line in records_file:
+            key, value = line.rstrip("\n").split("\t", maxsplit=1)
+            yield key, value
+
+
+def _merge_runs(
+    run_paths: typing.List[str], temp_dir: Path
+) -> typing.Iterable[typing.Tuple[str, str]]:
+    """Merge sorted runs, a limited number of files at a time"""
+    run_paths = list(run_paths)
+    while len(run_paths) > _MAX_MERGE_RUNS:
+        batch, run_paths = run_paths[:_MAX_MERGE_RUNS], run_paths[_MAX_MERGE_RUNS:]
+        run_fd, merged_path = tempfile.mkstemp(dir=temp_dir, suffix=".run")
+        with open(run_fd, "w") as merged_file:
+            for key, value in heapq.merge(
+                *[_read_records(p) for p in batch], key=_record_key
+            ):
+                print(key, value, sep="\t", file=merged_file)
+
+        run_paths.append(merged_path)
+
+    return heapq.merge(*[_read_records(p) for p in run_paths], key=_record_key)
+
+
+def _merge_counts(
+    run_paths: typing.List[str], temp_dir: Path
+) -> typing.Iterator[typing.Tuple[str, int]]:
+    """Merge sorted runs of counts, summing counts of equal keys"""
+    current_key: typing.Optional[str] = None
+    current_count = 0
+
+    for key, count_str in _merge_runs(run_paths, temp_dir):
+        if key != current_key:
+            if current_key is not None:
+                yield current_key, current_count
+
+            current_key = key
+            current_count = 0
+
+        current_count += int(count_str)
+
+    if current_key is not None:
+        yield current_key, current_count
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi lm"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi lm")
+    parser.add_argument(
+        "--recipe-dir",
+        help="Kaldi recipe dir (uses data/train/text and writes lm/lm.arpa.gz)",
+    )
+    parser.add_argument(
+        "--text",
+        action="append",
+        default=[],
+        help="Text file with one sentence per line (may be .gz)",
+    )
+    parser.add_argument(
+        "--kaldi-text",
+        action="append",
+        default=[],
+        help="Kaldi text file with utterance ids (may be .gz)",
+    )
+    parser.add_argument("--output", help="Path to write ARPA language model")
+    parser.add_argument(
+        "--order", type=int, default=3, help="Order of n-grams (default: 3)"
+    )
+    parser.add_argument(
+        "--smoothing",
+        choices=["kneser-ney", "witten-bell"],
+        default="kneser-ney",
+        help="Smoothing method (default: kneser-ney)",
+    )
+    parser.add_argument(
+        "--min-counts",
+        type=int,
+        nargs="+",
+        help="Minimum count for each order (e.g., 1 1 2)",
+    )
+    parser.add_argument(
+        "--unknown-word",
+        default="<unk>",
+        help="Word to add for unknown words (default: <unk>)",
+    )
+    parser.add_argument(
+        "--max-ngrams-in-memory",
+        type=int,
+        default=5_000_000,
+        help="Number of n-grams to hold in memory before sorting on disk",
+    )
+    parser.add_argument("--jobs", type=int, help="Number of parallel counting jobs")
+    parser.add_argument("--temp-dir", help="Directory for temporary files")
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    kaldi_text_paths = [Path(p) for p in args.kaldi_text]
+    output_path = args.output
+
+    if args.recipe_dir:
+        recipe_dir = Path(args.recipe_dir)
+        kaldi_text_paths.append(recipe_dir / "data" / "train" / "text")
+        output_path = output_path or (recipe_dir / "lm" / "lm.arpa.gz")
+
+    if not output_path:
+        parser.error("--output or --recipe-dir is required")
+
+    if not (args.text or kaldi_text_paths):
+        parser.error("--text, --kaldi-text, or --recipe-dir is required")
+
+    if args.order < 1:
+        parser.error("--order must be at least 1")
+
+    build_lm(
+        output_path,
+        text_paths=[Path(p) for p in args.text],
+        kaldi_text_paths=kaldi_text_paths,
+        order=args.order,
+        smoothing=args.smoothing,
+        min_counts=args.min_counts,
+        unknown_word=args.unknown_word,
+        max_ngrams_in_memory=args.max_ngrams_in_memory,
+        max_workers=args.jobs,
+        temp_dir=args.temp_dir,
+    )
+
+    _LOGGER.info("Wrote language model to %s", output_path)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
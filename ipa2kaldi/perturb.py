@@ -0,0 +1,337 @@
+"""Pre-rendered speed perturbation of Kaldi data directories.
+
+Kaldi's perturb_data_dir_speed_3way.sh wraps every wav.scp entry in sox
+pipes, so each pass over the speed-perturbed data decodes and resamples the
+whole corpus again. Here, the 0.9x/1.0x/1.1x variants are rendered once to
+16-bit 16Khz mono WAV files, and the data directory (with utt2dur, utt2uniq,
+and spk2utt) points straight at them.
+"""
+
+import argparse
+import io
+import logging
+import math
+import subprocess
+import typing
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from pathlib import Path
+
+import numpy as np
+
+from .audio import probe_wav, read_pcm
+from .datadir import read_scp
+
+_LOGGER = logging.getLogger("ipa2kaldi.perturb")
+
+_SAMPLE_RATE = 16000
+
+# Zero crossings of the windowed sinc on each side
+_FILTER_ZEROS = 16
+_KAISER_BETA = 8.6
+
+# Output samples resampled at once (bounds memory use)
+_CHUNK_SAMPLES = 1 << 16
+
+# Utterances rendered by each worker task
+_BATCH_SIZE = 64
+
+DEFAULT_FACTORS = [0.9, 1.0, 1.1]
+
+# -----------------------------------------------------------------------------
+
+
+def resample_poly(samples: np.ndarray, up: int, down: int) -> np.ndarray:
+    """Resample by up/down with a polyphase windowed-sinc filter.
+
+    Only the filter phases needed for each output sample are evaluated, so
+    the upsampled signal is never materialized.
+    """
+    divisor = math.gcd(up, down)
+    up, down = up // divisor, down // divisor
+
+    audio = samples.astype(np.float32)
+    if up == down:
+        return audio
+
+    # Low-pass filter on the upsampled grid
+    max_rate = max(up, down)
+    half_len = _FILTER_ZEROS * max_rate
+    offsets = np.arange(-half_len, half_len + 1)
+    cutoff = 0.5 / max_rate
+    fir = (
+        2
+        * cutoff
+        * np.sinc(2 * cutoff * offsets)
+        * np.kaiser(len(offsets), _KAISER_BETA)
+        * up
+    )
+
+    # polyphase[p, i] = fir[p + i*up]
+    num_taps = int(math.ceil(len(fir) / up))
+    padded_fir = np.zeros(num_taps * up, dtype=np.float32)
+    padded_fir[: len(fir)] = fir
+    polyphase = np.ascontiguousarray(padded_fir.reshape(num_taps, up).T)
+
+    num_out = int(math.ceil(len(audio) * up / down))
+    padded_audio: np.ndarray = np.concatenate(
+        [
+            np.zeros(num_taps, dtype=np.float32),
+            audio,
+            np.zeros(num_taps + 1, dtype=np.float32),
+        ]
+    )
+    tap_offsets = np.arange(num_taps)
+
+    output = np.empty(num_out, dtype=np.float32)
+    for chunk_start in range(0, num_out, _CHUNK_SAMPLES):
+        out_idxs = np.arange(chunk_start, min(num_out, chunk_start + _CHUNK_SAMPLES))
+
+        # Position of each output sample on the (shifted) upsampled grid
+        positions = (out_idxs * down) + half_len
+        phases = positions % up
+        last_inputs = (positions // up) + num_taps
+
+        # output[m] = sum_i polyphase[phase_m, i] * audio[last_input_m - i]
+        inputs = padded_audio[last_inputs[:, None] - tap_offsets[None, :]]
+        output[out_idxs] = np.einsum("ij,ij->i", polyphase[phases], inputs)
+
+    return output
+
+
+def speed_perturb(samples: np.ndarray, factor: float) -> np.ndarray:
+    """Change speed (tempo and pitch) like sox speed, keeping the sample rate"""
+    ratio = Fraction(1 / factor).limit_denominator(100)
+    resampled = resample_poly(samples, ratio.numerator, ratio.denominator)
+    rounded: np.ndarray = np.round(resampled)
+    return np.clip(rounded, -32768, 32767).astype(np.int16)
+
+
+def factor_prefix(factor: float) -> str:
+    """Utterance/speaker prefix used by Kaldi (e.g., sp0.9-), empty for 1.0"""
+    if factor == 1:
+        return ""
+
+    return f"sp{factor:g}-"
+
+
+# -----------------------------------------------------------------------------
+
+
+def read_wav_entry(wav_entry: str) -> np.ndarray:
+    """Get 16-bit 16Khz mono samples from a wav.scp entry (path or pipe)"""
+    wav_entry = wav_entry.strip()
+    if not wav_entry.endswith("|"):
+        audio_path = Path(wav_entry)
+        return read_pcm(audio_path, probe_wav(audio_path))
+
+    wav_bytes = subprocess.check_output(
+        wav_entry[:-1], shell=True, stderr=subprocess.DEVNULL
+    )
+
+    with wave.open(io.BytesIO(wav_bytes), "rb") as wav_file:
+        assert (wav_file.getframerate() == _SAMPLE_RATE) and (
+            wav_file.getsampwidth() == 2
+        ), f"Expected 16-bit {_SAMPLE_RATE}Hz audio: {wav_entry}"
+
+        # Piped WAVs often have bogus sizes, so read everything
+        samples = np.frombuffer(wav_file.readframes(len(wav_bytes)), dtype="<i2")
+        channels = wav_file.getnchannels()
+
+    if channels > 1:
+        samples = samples[: (len(samples) // channels) * channels]
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+
+    return samples
+
+
+def write_wav(wav_path: Path, samples: np.ndarray):
+    """Write 16-bit 16Khz mono WAV file"""
+    with wave.open(str(wav_path), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(_SAMPLE_RATE)
+        wav_file.writeframes(samples.astype("<i2").tobytes())
+
+
+def _render_batch(
+    batch: typing.List[typing.Tuple[str, str, str]],
+    factors: typing.List[float],
+    wav_dir: Path,
+) -> typing.List[typing.Tuple[str, float, str, int]]:
+    """Render speed variants of (utt_id, speaker, wav entry) in a worker.
+
+    Returns (utt_id, factor, wav path, number of samples) for each variant.
+    """
+    rendered: typing.List[typing.Tuple[str, float, str, int]] = []
+    for utt_id, speaker, wav_entry in batch:
+        try:
+            samples = read_wav_entry(wav_entry)
+        except Exception as e:
+            _LOGGER.warning("Failed to read audio for %s: %s", utt_id, e)
+            continue
+
+        for factor in factors:
+            prefix = factor_prefix(factor)
+            if (factor == 1) and (not wav_entry.strip().endswith("|")):
+                # Already a 16-bit 16Khz mono WAV file
+                rendered.append((utt_id, factor, wav_entry.strip(), len(samples)))
+                continue
+
+            factor_samples = (
+                samples if (factor == 1) else speed_perturb(samples, factor)
+            )
+
+            speaker_dir = wav_dir / f"{prefix}{speaker}"
+            speaker_dir.mkdir(parents=True, exist_ok=True)
+            wav_path = speaker_dir / f"{prefix}{utt_id}.wav"
+            write_wav(wav_path, factor_samples)
+
+            rendered.append(
+                (utt_id, factor, str(wav_path.absolute()), len(factor_samples))
+            )
+
+    return rendered
+
+
+def perturb_data_dir(
+    src_dir: typing.Union[str, Path],
+    dest_dir: typing.Union[str, Path],
+    factors: typing.Optional[typing.Sequence[float]] = None,
+    max_workers: typing.Optional[int] = None,
+) -> int:
+    """Render speed-perturbed copies of a data directory's audio.
+
+    The destination has the same layout as the output of Kaldi's
+    perturb_data_dir_speed_3way.sh (sp0.9-<utt>, etc.), with utt2dur and
+    reco2dur already filled in. Returns the number of utterances written.
+    """
+    src_dir, dest_dir = Path(src_dir), Path(dest_dir)
+    factors = list(factors or DEFAULT_FACTORS)
+
+    wav_entries = read_scp(src_dir / "wav.scp")
+    utt_speakers = read_scp(src_dir / "utt2spk")
+    utt_texts = read_scp(src_dir / "text") if (src_dir / "text").is_file() else {}
+
+    utt_ids = sorted(utt_id for utt_id in wav_entries if utt_id in utt_speakers)
+    batches = [
+        [
+            (utt_id, utt_speakers[utt_id], wav_entries[utt_id])
+            for utt_id in utt_ids[batch_start : batch_start + _BATCH_SIZE]
+        ]
+        for batch_start in range(0, len(utt_ids), _BATCH_SIZE)
+    ]
+
+    wav_dir = dest_dir / "wav"
+    wav_dir.mkdir(parents=True, exist_ok=True)
+
+    _LOGGER.debug(
+        "Rendering %s utterance(s) from %s at speed(s) %s",
+        len(utt_ids),
+        src_dir,
+        factors,
+    )
+
+    # perturbed utterance id -> (original id, speaker, wav path, duration)
+    perturbed: typing.Dict[str, typing.Tuple[str, str, str, float]] = {}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for rendered in executor.map(
+            _render_batch, batches, [factors] * len(batches), [wav_dir] * len(batches)
+        ):
+            for utt_id, factor, wav_path, num_samples in rendered:
+                prefix = factor_prefix(factor)
+                perturbed[f"{prefix}{utt_id}"] = (
+                    utt_id,
+                    f"{prefix}{utt_speakers[utt_id]}",
+                    wav_path,
+                    num_samples / _SAMPLE_RATE,
+                )
+
+    # Kaldi files must be sorted (speaker ids are prefixes of utterance ids)
+    speaker_utts: typing.Dict[str, typing.List[str]] = {}
+    with open(dest_dir / "wav.scp", "w") as wav_scp, open(
+        dest_dir / "utt2spk", "w"
+    ) as utt2spk, open(dest_dir / "utt2dur", "w") as utt2dur, open(
+        dest_dir / "reco2dur", "w"
+    ) as reco2dur, open(
+        dest_dir / "utt2uniq", "w"
+    ) as utt2uniq, open(
+        dest_dir / "text", "w"
+    ) as text_file:
+        for new_utt_id in sorted(perturbed):
+            utt_id, speaker, wav_path, duration = perturbed[new_utt_id]
+            speaker_utts.setdefault(speaker, []).append(new_utt_id)
+
+            print(new_utt_id, wav_path, file=wav_scp)
+            print(new_utt_id, speaker, file=utt2spk)
+            print(new_utt_id, duration, file=utt2dur)
+            print(new_utt_id, duration, file=reco2dur)
+            print(new_utt_id, utt_id, file=utt2uniq)
+
+            if utt_id in utt_texts:
+                print(new_utt_id, utt_texts[utt_id], file=text_file)
+
+    with open(dest_dir / "spk2utt", "w") as spk2utt:
+        for speaker in sorted(speaker_utts):
+            print(speaker, *speaker_utts[speaker], file=spk2utt)
+
+    _LOGGER.debug("Wrote %s utterance(s) to %s", len(perturbed), dest_dir)
+
+    return len(perturbed)
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi speed-perturb"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi speed-perturb")
+    parser.add_argument(
+        "--recipe-dir", default=".", help="Path to Kaldi recipe (default: .)"
+    )
+    parser.add_argument(
+        "--data-dir",
+        default="data/train",
+        help="Data directory to perturb, relative to recipe (default: data/train)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="Directory to write, relative to recipe (default: <DATA_DIR>_sp_prerendered)",
+    )
+    parser.add_argument(
+        "--factor",
+        type=float,
+        action="append",
+        help="Speed factor (default: 0.9, 1.0, 1.1)",
+    )
+    parser.add_argument("--jobs", type=int, help="Number of worker processes")
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    recipe_dir = Path(args.recipe_dir)
+    data_dir = recipe_dir / args.data_dir
+    output_dir = (
+        (recipe_dir / args.output_dir)
+        if args.output_dir
+        else data_dir.parent / f"{data_dir.name}_sp_prerendered"
+    )
+
+    num_utts = perturb_data_dir(
+        data_dir, output_dir, factors=args.factor, max_workers=args.jobs
+    )
+    _LOGGER.info("Wrote %s speed-perturbed utterance(s) to %s", num_utts, output_dir)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+"""Estimates disk, memory, and time needed by a recipe before running it.
+
+Corpus size comes from a recipe's utt2dur files when they exist, or from
+dataset metadata with the durations of a random sample of audio files.
+Disk and memory use are projected with per-frame/per-n-gram sizes, and
+stage runtimes with per-hour costs that are calibrated from the timings
+recorded by previous runs of ipa2kaldi run (data/local/stages/state.json).
+
+Nothing is written to the recipe directory.
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import math
+import random
+import statistics
+import sys
+import typing
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .audio import AudioCache
+from .stages import RECIPE_STAGES, Stage, get_recipe_stats, read_num_jobs
+from .utils import maybe_gzip_open
+
+_LOGGER = logging.getLogger("ipa2kaldi.plan")
+
+_FRAMES_PER_HOUR = 100 * 60 * 60
+_GB = 1024 ** 3
+
+# Bytes per 10ms frame (compressed Kaldi matrices are about 1 byte/value)
+_MFCC_BYTES = 13
+_MFCC_HIRES_BYTES = 40
+
+# 100-dim float iVectors every 10 frames
+_IVECTOR_BYTES = (100 * 4) / 10
+
+# Chain egs (hires features, iVectors, supervision) and lattices
+_EGS_BYTES = 60
+_LATTICE_BYTES = 20
+_ALIGNMENT_BYTES = 2
+
+# 16-bit 16Khz audio
+_AUDIO_BYTES_PER_HOUR = 16000 * 2 * 60 * 60
+
+# Speed perturbation (0.9x, 1.0x, 1.1x)
+_NUM_SPEEDS = 3
+
+# Peak memory of graph compilation per LM n-gram (HCLG determinization)
+_GRAPH_BYTES_PER_NGRAM = 4 * 1024
+_GRAPH_BASE_BYTES = 512 * 1024 ** 2
+
+# Memory of prepare_lang.sh per lexicon entry
+_LEXICON_BYTES_PER_ENTRY = 1024
+
+# Memory of each iVector extractor training process
+_IVECTOR_JOB_BYTES = 512 * 1024 ** 2
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class StageCost:
+    """How a stage's runtime grows with the corpus"""
+
+    # train_hours, test_hours, lm_ngrams, or None (constant)
+    scale: typing.Optional[str] = None
+
+    # CPU seconds per unit of scale
+    rate: float = 0.0
+
+    # Seconds regardless of corpus size
+    fixed_sec: float = 60.0
+
+
+# Rough defaults (CPU seconds per hour of audio), replaced by calibration
+DEFAULT_COSTS: typing.Dict[str, StageCost] = {
+    "lang": StageCost(fixed_sec=60),
+    "lm": StageCost("lm_ngrams", 2e-5, 30),
+    "mfcc_train": StageCost("train_hours", 90, 30),
+    "mfcc_test": StageCost("test_hours", 90, 30),
+    "mono": StageCost("train_hours", 400, 120),
+    "tri1": StageCost("train_hours", 700, 120),
+    "tri2b": StageCost("train_hours", 1000, 120),
+    "tri2b_graph": StageCost("lm_ngrams", 2e-3, 120),
+    "ivector": StageCost("train_hours", 5000, 600),
+    "lang_chain": StageCost(fixed_sec=10),
+    "lats": StageCost("train_hours", 1800, 120),
+    "tree": StageCost("train_hours", 150, 120),
+    "tdnn": StageCost("train_hours", 1500, 600),
+    "tdnn_graph": StageCost("lm_ngrams", 2e-3, 120),
+    "decode": StageCost("test_hours", 3600, 60),
+}
+
+
+@dataclass
+class CorpusStats:
+    """Size of the corpus a recipe will be trained on"""
+
+    num_items: int = 0
+    num_speakers: int = 0
+    train_hours: float = 0.0
+    test_hours: float = 0.0
+
+    # Standard error of total hours when estimated from a sample
+    hours_stderr: float = 0.0
+    lm_ngrams: typing.Optional[int] = None
+    lexicon_entries: typing.Optional[int] = None
+
+    def get(self, scale: typing.Optional[str]) -> float:
+        """Get value for a stage cost's scale"""
+        if scale is None:
+            return 0.0
+
+        return float(getattr(self, scale) or 0)
+
+
+@dataclass
+class Plan:
+    """Projected resources of a recipe"""
+
+    stats: CorpusStats
+    num_jobs: int
+    max_cpus: int
+
+    # name -> bytes
+    disk: typing.Dict[str, float] = field(default_factory=dict)
+    memory: typing.Dict[str, float] = field(default_factory=dict)
+
+    # stage -> (wall seconds, calibrated)
+    stage_seconds: typing.Dict[str, typing.Tuple[float, bool]] = field(
+        default_factory=dict
+    )
+    total_seconds: float = 0.0
+
+
+# -----------------------------------------------------------------------------
+
+
+def stats_from_recipe(recipe_dir: Path) -> typing.Optional[CorpusStats]:
+    """Get corpus statistics from a recipe's data dirs (None if no utt2dur)"""
+    recipe_stats = get_recipe_stats(recipe_dir)
+    if "train_hours" not in recipe_stats:
+        return None
+
+    stats = CorpusStats(
+        train_hours=recipe_stats["train_hours"],
+        test_hours=recipe_stats.get("test_hours", 0.0),
+    )
+
+    if "lm_ngrams" in recipe_stats:
+        stats.lm_ngrams = int(recipe_stats["lm_ngrams"])
+
+    speakers: typing.Set[str] = set()
+    for data_name in ["train", "test"]:
+        utt2spk_path = recipe_dir / "data" / data_name / "utt2spk"
+        if utt2spk_path.is_file():
+            with open(utt2spk_path, "r") as utt2spk_file:
+                for line in utt2spk_file:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        stats.num_items += 1
+                        speakers.add(parts[1])
+
+    stats.num_speakers = len(speakers)
+    stats.lexicon_entries = count_lexicon_entries(recipe_dir)
+
+    return stats
+
+
+def stats_from_datasets(
+    datasets: typing.Iterable[typing.Tuple[Path, str]],
+    sample_size: int = 500,
+    test_percentage: float = 5,
+    audio_cache: typing.Optional[AudioCache] = None,
+    max_workers: typing.Optional[int] = None,
+) -> CorpusStats:
+    """Estimate corpus statistics from dataset metadata and a sample of audio.
+
+    datasets are (path, type) pairs, with type a module in ipa2kaldi.dataset.
+    Only sampled audio files are probed, so this is fast for large corpora.
+    """
+    stats = CorpusStats()
+
+    # (path, start_ms, end_ms)
+    items: typing.List[
+        typing.Tuple[Path, typing.Optional[int], typing.Optional[int]]
+    ] = []
+
+    for dataset_index, (dataset_path, dataset_type) in enumerate(datasets):
+        # Each dataset module has get_metadata
+        dataset_module: typing.Any = importlib.import_module(
+            f".dataset.{dataset_type}", __package__
+        )
+
+        num_items = len(items)
+        speakers: typing.Set[str] = set()
+        for item_details in dataset_module.get_metadata(dataset_path):
+            speakers.add(item_details[0])
+            items.append(
+                (
+                    item_details[2],
+                    item_details[3] if len(item_details) > 3 else None,
+                    item_details[4] if len(item_details) > 4 else None,
+                )
+            )
+
+        stats.num_speakers += len(speakers)
+        _LOGGER.debug(
+            "Dataset %s: %s item(s), %s speaker(s)",
+            dataset_index,
+            len(items) - num_items,
+            len(speakers),
+        )
+
+    stats.num_items = len(items)
+    if not items:
+        return stats
+
+    sample = random.sample(items, min(sample_size, len(items)))
+    audio_cache = audio_cache or AudioCache()
+    audio_infos = audio_cache.probe(
+        (path for path, _, _ in sample if path.is_file()), max_workers=max_workers
+    )
+
+    sample_durations: typing.List[float] = []
+    for audio_path, start_ms, end_ms in sample:
+        audio_info = audio_infos.get(audio_path)
+        start_sec = (start_ms or 0) / 1000
+        if end_ms is not None:
+            sample_durations.append(max(0.0, (end_ms / 1000) - start_sec))
+        elif audio_info is not None:
+            sample_durations.append(max(0.0, audio_info.duration_sec - start_sec))
+
+    if not sample_durations:
+        _LOGGER.warning("No durations in sample of %s item(s)", len(sample))
+        return stats
+
+    # Missing/broken files are dropped by ipa2kaldi, so scale by the
+    # fraction that could be probed.
+    mean_sec = statistics.mean(sample_durations)
+    num_valid = stats.num_items * (len(sample_durations) / len(sample))
+    total_hours = (mean_sec * num_valid) / (60 * 60)
+
+    if len(sample_durations) > 1:
+        stats.hours_stderr = (
+            statistics.stdev(sample_durations)
+            / math.sqrt(len(sample_durations))
+            * num_valid
+        ) / (60 * 60)
+
+    stats.test_hours = total_hours * (test_percentage / 100)
+    stats.train_hours = total_hours - stats.test_hours
+
+    return stats
+
+
+def count_lexicon_entries(recipe_dir: Path) -> typing.Optional[int]:
+    """Count entries in the recipe's lexicon (None if missing)"""
+    for lexicon_path in [
+        recipe_dir / "data" / "local" / "dict" / "lexicon.txt.gz",
+        recipe_dir / "data" / "local" / "dict" / "lexicon.txt",
+    ]:
+        if lexicon_path.is_file():
+            with maybe_gzip_open(lexicon_path, "r") as lexicon_file:
+                return sum(1 for line in lexicon_file if line.strip())
+
+    return None
+
+
+# -----------------------------------------------------------------------------
+
+
+def calibrate_costs(
+    state_paths: typing.Iterable[Path],
+    costs: typing.Optional[typing.Mapping[str, StageCost]] = None,
+) -> typing.Tuple[typing.Dict[str, StageCost], typing.Set[str]]:
+    """Fit per-unit rates of stages to timings recorded by ipa2kaldi run.
+
+    Returns updated costs and the names of calibrated stages.
+    """
+    costs = dict(costs or DEFAULT_COSTS)
+
+    # name -> observed rates
+    stage_rates: typing.Dict[str, typing.List[float]] = {}
+
+    for state_path in state_paths:
+        if not state_path.is_file():
+            continue
+
+        with open(state_path, "r") as state_file:
+            state = json.load(state_file)
+
+        for name, stage_state in state.items():
+            cost = costs.get(name)
+            if (cost is None) or ("seconds" not in stage_state):
+                continue
+
+            if cost.scale is None:
+                stage_rates.setdefault(name, []).append(stage_state["seconds"])
+                continue
+
+            units = stage_state.get("stats", {}).get(cost.scale)
+            if not units:
+                continue
+
+            cpu_seconds = max(0.0, stage_state["seconds"] - cost.fixed_sec) * (
+                stage_state.get("cpus") or 1
+            )
+            stage_rates.setdefault(name, []).append(cpu_seconds / units)
+
+    for name, rates in stage_rates.items():
+        cost = costs[name]
+        if cost.scale is None:
+            costs[name] = StageCost(fixed_sec=statistics.median(rates))
+        else:
+            costs[name] = StageCost(
+                cost.scale, statistics.median(rates), cost.fixed_sec
+            )
+
+    _LOGGER.debug("Calibrated %s stage(s) from previous runs", len(stage_rates))
+
+    return costs, set(stage_rates)
+
+
+def make_plan(
+    stats: CorpusStats,
+    num_jobs: int,
+    max_cpus: int,
+    costs: typing.Optional[typing.Mapping[str, StageCost]] = None,
+    calibrated: typing.Optional[typing.Set[str]] = None,
+    stages: typing.Iterable[Stage] = RECIPE_STAGES,
+    speed_perturb: bool = False,
+) -> Plan:
+    """Project disk/memory use and stage runtimes for a corpus"""
+    costs = costs or DEFAULT_COSTS
+    calibrated = calibrated or set()
+    plan = Plan(stats=stats, num_jobs=num_jobs, max_cpus=max_cpus)
+
+    train_frames = stats.train_hours * _FRAMES_PER_HOUR
+    test_frames = stats.test_hours * _FRAMES_PER_HOUR
+    sp_frames = train_frames * _NUM_SPEEDS
+
+    # Disk
+    plan.disk["mfcc"] = (train_frames + test_frames + sp_frames) * _MFCC_BYTES
+    plan.disk["mfcc_hires"] = (sp_frames + test_frames) * _MFCC_HIRES_BYTES
+    plan.disk["ivectors"] = (sp_frames + test_frames) * _IVECTOR_BYTES
+    plan.disk["alignments"] = (train_frames * 3 + sp_frames) * _ALIGNMENT_BYTES
+    plan.disk["lattices"] = sp_frames * _LATTICE_BYTES
+    plan.disk["egs"] = sp_frames * _EGS_BYTES
+    if speed_perturb:
+        plan.disk["speed_perturbed_audio"] = (
+            stats.train_hours * _NUM_SPEEDS * _AUDIO_BYTES_PER_HOUR
+        )
+
+    # Memory
+    if stats.lexicon_entries is not None:
+        plan.memory["lang"] = stats.lexicon_entries * _LEXICON_BYTES_PER_ENTRY
+
+    if stats.lm_ngrams is not None:
+        plan.memory["graph"] = _GRAPH_BASE_BYTES + (
+            stats.lm_ngrams * _GRAPH_BYTES_PER_NGRAM
+        )
+
+    plan.memory["ivector"] = num_jobs * _IVECTOR_JOB_BYTES
+
+    # Stage runtimes
+    stages = list(stages)
+    stage_cpus: typing.Dict[str, int] = {}
+    for stage in stages:
+        cost = costs.get(stage.name, StageCost())
+        cpus = min(num_jobs if stage.parallel else 1, max_cpus)
+        stage_cpus[stage.name] = cpus
+        seconds = cost.fixed_sec + (cost.rate * stats.get(cost.scale)) / cpus
+        plan.stage_seconds[stage.name] = (seconds, stage.name in calibrated)
+
+    plan.total_seconds = _simulate(stages, plan.stage_seconds, stage_cpus, max_cpus)
+
+    return plan
+
+
+def _simulate(
+    stages: typing.List[Stage],
+    stage_seconds: typing.Mapping[str, typing.Tuple[float, bool]],
+    stage_cpus: typing.Mapping[str, int],
+    max_cpus: int,
+) -> float:
+    """Get total wall time when stages are scheduled like ipa2kaldi run"""
+    todo = list(stages)
+    done: typing.Set[str] = set()
+
+    # (end time, name)
+    running: typing.List[typing.Tuple[float, str]] = []
+    now = 0.0
+    used_cpus = 0
+
+    while todo or running:
+        for stage in list(todo):
+            if any(d not in done for d in stage.after):
+                continue
+
+            cpus = stage_cpus[stage.name]
+            if running and ((used_cpus + cpus) > max_cpus):
+                continue
+
+            todo.remove(stage)
+            running.append((now + stage_seconds[stage.name][0], stage.name))
+            used_cpus += cpus
+
+        if not running:
+            break
+
+        running.sort()
+        now, name = running.pop(0)
+        used_cpus -= stage_cpus[name]
+        done.add(name)
+
+    return now
+
+
+# -----------------------------------------------------------------------------
+
+
+def write_report(plan: Plan, report_file: typing.TextIO):
+    """Write plan as plain text"""
+    stats = plan.stats
+    print("Corpus", file=report_file)
+    print(f"  items: {stats.num_items}", file=report_file)
+    print(f"  speakers: {stats.num_speakers}", file=report_file)
+
+    hours_error = ""
+    if stats.hours_stderr > 0:
+        hours_error = f" (+/- {1.96 * stats.hours_stderr:.1f})"
+
+    print(
+        f"  audio: {stats.train_hours:.1f} train + {stats.test_hours:.1f} test hour(s){hours_error}",
+        file=report_file,
+    )
+
+    if stats.lm_ngrams is not None:
+        print(f"  LM n-grams: {stats.lm_ngrams}", file=report_file)
+
+    if stats.lexicon_entries is not None:
+        print(f"  lexicon entries: {stats.lexicon_entries}", file=report_file)
+
+    print("", file=report_file)
+    print("Disk", file=report_file)
+    for name, num_bytes in plan.disk.items():
+        print(f"  {name}: {num_bytes / _GB:.1f} GB", file=report_file)
+
+    print(f"  total: {sum(plan.disk.values()) / _GB:.1f} GB", file=report_file)
+
+    print("", file=report_file)
+    print("Peak memory", file=report_file)
+    for name, num_bytes in plan.memory.items():
+        print(f"  {name}: {num_bytes / _GB:.1f} GB", file=report_file)
+
+    print("", file=report_file)
+    print(f"Stages (nJobs={plan.num_jobs}, {plan.max_cpus} CPU(s))", file=report_file)
+    for name, (seconds, is_calibrated) in plan.stage_seconds.items():
+        source = "calibrated" if is_calibrated else "default"
+        print(f"  {name}: {_format_seconds(seconds)} ({source})", file=report_file)
+
+    print(f"  total: {_format_seconds(plan.total_seconds)}", file=report_file)
+
+
+def _format_seconds(seconds: float) -> str:
+    if seconds >= (60 * 60):
+        return f"{seconds / (60 * 60):.1f} hour(s)"
+
+    if seconds >= 60:
+        return f"{seconds / 60:.1f} minute(s)"
+
+    return f"{seconds:.0f} second(s)"
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi plan"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi plan")
+    parser.add_argument(
+        "--recipe-dir",
+        help="Kaldi recipe to read data dirs, lexicon, LM, and cmd.sh from (not modified)",
+    )
+    parser.add_argument(
+        "--dataset",
+        action="append",
+        nargs="+",
+        metavar=("path", "type"),
+        default=[],
+        help="Dataset to estimate corpus size from instead of recipe data dirs",
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=500,
+        help="Number of audio files to probe per estimate (default: 500)",
+    )
+    parser.add_argument(
+        "--test-percentage",
+        type=float,
+        default=5,
+        help="Percentage of items held out for testing (default: 5)",
+    )
+    parser.add_argument(
+        "--num-jobs", type=int, help="Number of parallel Kaldi jobs (default: cmd.sh)"
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        help="CPU budget for stages running at once (default: nJobs)",
+    )
+    parser.add_argument("--lm-ngrams", type=int, help="Number of n-grams in LM")
+    parser.add_argument(
+        "--history",
+        action="append",
+        default=[],
+        help="Recipe dir of a previous run to calibrate stage runtimes from",
+    )
+    parser.add_argument(
+        "--speed-perturb",
+        action="store_true",
+        help="Include pre-rendered speed-perturbed audio in disk usage",
+    )
+    parser.add_argument("--audio-cache", help="Path to cache of probed audio details")
+    parser.add_argument("--report", help="Path to write report (default: stdout)")
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    recipe_dir = Path(args.recipe_dir) if args.recipe_dir else None
+
+    # Read-only cache
+    audio_cache_path = args.audio_cache
+    if (audio_cache_path is None) and (recipe_dir is not None):
+        audio_cache_path = recipe_dir / "data" / "local" / "audio_cache.txt"
+
+    audio_cache = AudioCache(audio_cache_path)
+    audio_cache.load()
+
+    stats: typing.Optional[CorpusStats] = None
+    if args.dataset:
+        stats = stats_from_datasets(
+            [
+                (Path(parts[0]), parts[1] if len(parts) > 1 else "default")
+                for parts in args.dataset
+            ],
+            sample_size=args.sample_size,
+            test_percentage=args.test_percentage,
+            audio_cache=audio_cache,
+        )
+
+        if recipe_dir is not None:
+            stats.lexicon_entries = count_lexicon_entries(recipe_dir)
+            lm_ngrams = get_recipe_stats(recipe_dir).get("lm_ngrams")
+            if lm_ngrams is not None:
+                stats.lm_ngrams = int(lm_ngrams)
+    elif recipe_dir is not None:
+        stats = stats_from_recipe(recipe_dir)
+
+    if stats is None:
+        _LOGGER.critical("Need --dataset or a --recipe-dir with data/train/utt2dur")
+        sys.exit(1)
+
+    if args.lm_ngrams is not None:
+        stats.lm_ngrams = args.lm_ngrams
+
+    num_jobs = args.num_jobs
+    if num_jobs is None:
+        num_jobs = read_num_jobs(recipe_dir / "cmd.sh") if recipe_dir else 1
+
+    history_dirs = [Path(d) for d in args.history]
+    if recipe_dir is not None:
+        history_dirs.append(recipe_dir)
+
+    costs, calibrated = calibrate_costs(
+        d / "data" / "local" / "stages" / "state.json" for d in history_dirs
+    )
+
+    plan = make_plan(
+        stats,
+        num_jobs=num_jobs,
+        max_cpus=args.cpus or num_jobs,
+        costs=costs,
+        calibrated=calibrated,
+        speed_perturb=args.speed_perturb,
+    )
+
+    if args.report:
+        with open(args.report, "w") as report_file:
+            write_report(plan, report_file)
+    else:
+        write_report(plan, sys.stdout)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""Relative entropy (Stolcke) pruning of ARPA language models.
+
+The highest order is streamed from the ARPA file (three times), while lower
+orders are kept in memory for backoff lookups. Each n-gram gets a score
+that approximates how much the model's relative entropy would change if it
+were pruned. N-grams can only be pruned if no kept higher order n-gram has
+them as a prefix or suffix.
+"""
+import argparse
+import logging
+import math
+import typing
+from array import array
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from .arpa import ArpaReader, ArpaWriter, BackoffModel
+from .utils import maybe_gzip_open
+
+_LOGGER = logging.getLogger("ipa2kaldi.prune")
+
+# Smallest probability mass used in logarithms
+_MIN_MASS = 1e-12
+
+# -----------------------------------------------------------------------------
+
+
+def prune_score(
+    context_prob: float,
+    prob: float,
+    lower_prob: float,
+    numerator: float,
+    denominator: float,
+) -> float:
+    """Relative entropy change from pruning p(w|h).
+
+    numerator is 1 - sum p(v|h) and denominator is 1 - sum p(v|h') over the
+    words v seen after h, so bow(h) = numerator / denominator.
+    """
+    numerator = max(numerator, _MIN_MASS)
+    denominator = max(denominator, _MIN_MASS)
+    old_bow = numerator / denominator
+    new_bow = (numerator + prob) / (denominator + lower_prob)
+
+    return -context_prob * (
+        (prob * (math.log(max(lower_prob * new_bow, _MIN_MASS)) - math.log(prob)))
+        + (numerator * (math.log(new_bow) - math.log(old_bow)))
+    )
+
+
+def prune_arpa(
+    src_path: typing.Union[str, Path],
+    dest_path: typing.Union[str, Path],
+    threshold: typing.Optional[float] = None,
+    max_ngrams: typing.Optional[int] = None,
+    max_bytes: typing.Optional[int] = None,
+    temp_dir: typing.Optional[typing.Union[str, Path]] = None,
+) -> typing.List[int]:
+    """Prune n-grams (order 2+) from an ARPA language model.
+
+    N-grams whose score is below threshold are pruned. With max_ngrams or
+    max_bytes (uncompressed ARPA size), the threshold is raised until the
+    pruned model fits.
+
+    Returns the number of n-grams kept for each order.
+    """
+    model = BackoffModel()
+
+    # context -> [1 - sum p(w|h), 1 - sum p(w|h')] over seen words
+    context_sums: typing.Dict[str, typing.List[float]] = {}
+
+    # -------------------------------------------------------------------------
+    # 1. Load lower orders and sum probabilities of highest order contexts
+    # -------------------------------------------------------------------------
+
+    with maybe_gzip_open(src_path, "r") as src_file:
+        reader = ArpaReader(src_file)
+        max_order = reader.max_order
+
+        for order, log_prob, ngram, bow in reader.ngrams():
+            if (order < max_order) or (order == 1):
+                model.add(order, log_prob, ngram, bow or 0.0)
+            else:
+                _add_context_sums(context_sums, model, log_prob, ngram)
+
+    for order in range(2, max_order):
+        for ngram, (log_prob, _) in model.orders[order - 1].items():
+            _add_context_sums(context_sums, model, log_prob, ngram)
+
+    # -------------------------------------------------------------------------
+    # 2. Score n-grams, highest order first
+    # -------------------------------------------------------------------------
+
+    context_probs: typing.Dict[str, float] = {}
+
+    def score(log_prob: float, ngram: str) -> float:
+        words = ngram.split(" ")
+        context = " ".join(words[:-1])
+        context_prob = context_probs.get(context)
+        if context_prob is None:
+            context_prob = model.context_prob(words[:-1])
+            context_probs[context] = context_prob
+
+        numerator, denominator = context_sums[context]
+
+        return prune_score(
+            context_prob,
+            10 ** log_prob,
+            10 ** model.log_prob(words[1:]),
+            numerator,
+            denominator,
+        )
+
+    # Highest score of higher order n-grams that depend on an n-gram
+    dependent_scores: typing.Dict[str, float] = {}
+
+    def add_dependents(ngram: str, ngram_score: float):
+        words = ngram.split(" ")
+        for dependent in (" ".join(words[:-1]), " ".join(words[1:])):
+            if dependent_scores.get(dependent, -math.inf) < ngram_score:
+                dependent_scores[dependent] = ngram_score
+
+    # Scores and ARPA line sizes of prunable n-grams
+    top_scores: "array[float]" = array("d")
+    lower_scores: typing.List[typing.Dict[str, float]] = [{} for _ in range(max_order)]
+    all_sizes = array("d")
+    num_unigrams = 0
+    unigram_bytes = 0
+
+    if max_order > 1:
+        with maybe_gzip_open(src_path, "r") as src_file:
+            reader = ArpaReader(src_file)
+            for order, log_prob, ngram, bow in reader.ngrams():
+                if order < max_order:
+                    continue
+
+                ngram_score = score(log_prob, ngram)
+                top_scores.append(ngram_score)
+                all_sizes.append(_line_bytes(ngram, False))
+                add_dependents(ngram, ngram_score)
+
+    for order in range(len(model.orders), 0, -1):
+        for ngram, (log_prob, bow) in model.orders[order - 1].items():
+            if order == 1:
+                num_unigrams += 1
+                unigram_bytes += _line_bytes(ngram, bow != 0)
+                continue
+
+            # Can't prune an n-gram that a kept n-gram depends on
+            ngram_score = max(
+                score(log_prob, ngram), dependent_scores.get(ngram, -math.inf)
+            )
+            lower_scores[order - 1][ngram] = ngram_score
+            all_sizes.append(_line_bytes(ngram, bow != 0))
+            add_dependents(ngram, ngram_score)
+
+    # -------------------------------------------------------------------------
+    # 3. Choose threshold
+    # -------------------------------------------------------------------------
+
+    all_scores: np.ndarray = np.concatenate(
+        [
+            np.frombuffer(top_scores, dtype=np.float64),
+            np.array(
+                [s for scores in reversed(lower_scores) for s in scores.values()],
+                dtype=np.float64,
+            ),
+        ]
+    )
+
+    threshold = threshold if (threshold is not None) else -math.inf
+    if (max_ngrams is not None) or (max_bytes is not None):
+        sorted_indexes = np.argsort(-all_scores, kind="stable")
+        num_keep = len(sorted_indexes)
+
+        if max_ngrams is not None:
+            num_keep = min(num_keep, max(0, max_ngrams - num_unigrams))
+
+        if max_bytes is not None:
+            sizes = np.frombuffer(all_sizes, dtype=np.float64)[sorted_indexes]
+            num_keep = min(
+                num_keep,
+                int(
+                    np.searchsorted(
+                        np.cumsum(sizes), max_bytes - unigram_bytes, "right"
+                    )
+                ),
+            )
+
+        if num_keep < len(sorted_indexes):
+            # Keep only n-grams scoring above the first one that doesn't fit
+            threshold = max(
+                threshold,
+                float(np.nextafter(all_scores[sorted_indexes[num_keep]], np.inf)),
+            )
+
+    _LOGGER.debug("Pruning threshold: %s", threshold)
+
+    # -------------------------------------------------------------------------
+    # 4. Write kept n-grams with re-normalized backoff weights
+    # -------------------------------------------------------------------------
+
+    # context -> [sum p(w|h), sum p(w|h')] over pruned words
+    pruned_sums: typing.Dict[str, typing.List[float]] = defaultdict(lambda: [0.0, 0.0])
+
+    def add_pruned(log_prob: float, ngram: str):
+        words = ngram.split(" ")
+        sums = pruned_sums[" ".join(words[:-1])]
+        sums[0] += 10 ** log_prob
+        sums[1] += 10 ** model.log_prob(words[1:])
+
+    with ArpaWriter(dest_path, temp_dir=temp_dir) as writer:
+        if max_order > 1:
+            with maybe_gzip_open(src_path, "r") as src_file:
+                reader = ArpaReader(src_file)
+                top_index = 0
+                for order, log_prob, ngram, bow in reader.ngrams():
+                    if order < max_order:
+                        continue
+
+                    if top_scores[top_index] >= threshold:
+                        writer.write(order, log_prob, ngram)
+                    else:
+                        add_pruned(log_prob, ngram)
+
+                    top_index += 1
+
+        for order in range(max_order - 1, 1, -1):
+            for ngram, (log_prob, _) in model.orders[order - 1].items():
+                if lower_scores[order - 1][ngram] < threshold:
+                    add_pruned(log_prob, ngram)
+
+        for order, ngrams in enumerate(model.orders, start=1):
+            for ngram, (log_prob, bow) in ngrams.items():
+                if (order > 1) and (lower_scores[order - 1][ngram] < threshold):
+                    continue
+
+                pruned = pruned_sums.get(ngram)
+                if pruned is not None:
+                    # Move pruned probability mass into backoff
+                    numerator, denominator = context_sums[ngram]
+                    bow = math.log10(
+                        max(numerator + pruned[0], _MIN_MASS)
+                        / max(denominator + pruned[1], _MIN_MASS)
+                    )
+
+                writer.write(order, log_prob, ngram, bow if bow != 0 else None)
+
+    _LOGGER.debug("Pruned %s: kept %s n-gram(s)", src_path, writer.counts)
+
+    return writer.counts
+
+
+def _add_context_sums(
+    context_sums: typing.Dict[str, typing.List[float]],
+    model: BackoffModel,
+    log_prob: float,
+    ngram: str,
+):
+    words = ngram.split(" ")
+    context = " ".join(words[:-1])
+    sums = context_sums.get(context)
+    if sums is None:
+        sums = [1.0, 1.0]
+        context_sums[context] = sums
+
+    sums[0] -= 10 ** log_prob
+    sums[1] -= 10 ** model.log_prob(words[1:])
+
+
+def _line_bytes(ngram: str, has_bow: bool) -> int:
+    """Approximate size of an n-gram's line in an ARPA file"""
+    return len(ngram.encode()) + 11 + (11 if has_bow else 0)
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi arpa-prune"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi arpa-prune")
+    parser.add_argument("input", help="ARPA language model to prune (may be .gz)")
+    parser.add_argument("output", help="Path to write pruned ARPA language model")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="Prune n-grams that change relative entropy less than this (e.g., 1e-8)",
+    )
+    parser.add_argument(
+        "--max-ngrams", type=int, help="Prune until there are at most this many n-grams"
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        help="Prune until the uncompressed ARPA file is at most this size",
+    )
+    parser.add_argument("--temp-dir", help="Directory for temporary files")
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if (
+        (args.threshold is None)
+        and (args.max_ngrams is None)
+        and (args.max_bytes is None)
+    ):
+        parser.error("--threshold, --max-ngrams, or --max-bytes is required")
+
+    counts = prune_arpa(
+        args.input,
+        args.output,
+        threshold=args.threshold,
+        max_ngrams=args.max_ngrams,
+        max_bytes=args.max_bytes,
+        temp_dir=args.temp_dir,
+    )
+    _LOGGER.info("Wrote %s n-gram(s) to %s", sum(counts), args.output)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
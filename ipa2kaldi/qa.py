@@ -0,0 +1,556 @@
+"""Quality checks for audio before it goes into wav.scp"""
+import argparse
+import dataclasses
+import logging
+import math
+import os
+import sys
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from .audio import AudioCache, AudioInfo, read_pcm
+
+_LOGGER = logging.getLogger("ipa2kaldi.qa")
+
+# Sample rate of decoded audio (see read_pcm)
+_SAMPLE_RATE = 16000
+
+# Length of frames used to find leading/trailing silence
+_FRAME_SAMPLES = _SAMPLE_RATE // 100
+
+# Samples this close to full scale count as clipped
+_CLIP_LEVEL = 32767 - 64
+
+# Stand-in for log(0)
+_MIN_DB = -120.0
+
+# (path, start_ms, end_ms)
+QAKey = typing.Tuple[Path, typing.Optional[int], typing.Optional[int]]
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class AudioStats:
+    """Signal statistics of decoded audio"""
+
+    duration_sec: float
+    rms_db: float
+    peak_db: float
+    clipped_ratio: float
+    leading_silence_sec: float
+    trailing_silence_sec: float
+    dc_offset: float
+
+
+@dataclass
+class QAThresholds:
+    """Limits for rejecting or flagging audio"""
+
+    # Rejected below/above these
+    min_duration_sec: float = 0.2
+    min_rms_db: float = -55.0
+    max_clipped_ratio: float = 0.01
+
+    # Audio is resampled to 16Khz, so only reject rates below telephone
+    # bandwidth (raise to 16000 to drop 8Khz corpora too)
+    min_sample_rate: int = 8000
+
+    # Rejected if decoded audio is shorter than expected by this much
+    # (truncated MP3s, etc.)
+    max_missing_sec: float = 0.5
+
+    # Flagged above these
+    max_silence_sec: float = 3.0
+    max_dc_offset: float = 0.05
+    flag_clipped_ratio: float = 0.001
+
+    # Frames quieter than this are silence
+    silence_db: float = -50.0
+
+
+@dataclass
+class QAResult:
+    """Outcome of checking a single (possibly trimmed) audio file"""
+
+    path: Path
+    start_ms: typing.Optional[int] = None
+    end_ms: typing.Optional[int] = None
+    stats: typing.Optional[AudioStats] = None
+    error: typing.Optional[str] = None
+    rejected: typing.List[str] = field(default_factory=list)
+    flagged: typing.List[str] = field(default_factory=list)
+
+    @property
+    def status(self) -> str:
+        """ok, flagged, or rejected"""
+        if self.rejected:
+            return "rejected"
+
+        if self.flagged:
+            return "flagged"
+
+        return "ok"
+
+
+# -----------------------------------------------------------------------------
+
+
+def to_db(value: float) -> float:
+    """Convert amplitude relative to full scale to dBFS"""
+    if value <= 0:
+        return _MIN_DB
+
+    return max(_MIN_DB, 20 * math.log10(value))
+
+
+def get_stats(samples: np.ndarray, silence_db: float = -50.0) -> AudioStats:
+    """Compute statistics of 16-bit 16Khz mono samples"""
+    num_samples = len(samples)
+    duration_sec = num_samples / _SAMPLE_RATE
+    if num_samples == 0:
+        return AudioStats(
+            duration_sec=0.0,
+            rms_db=_MIN_DB,
+            peak_db=_MIN_DB,
+            clipped_ratio=0.0,
+            leading_silence_sec=0.0,
+            trailing_silence_sec=0.0,
+            dc_offset=0.0,
+        )
+
+    audio = samples.astype(np.float32) / 32768
+    dc_offset = float(audio.mean())
+
+    # DC offset doesn't count towards loudness
+    audio -= dc_offset
+
+    abs_samples = np.abs(samples.astype(np.int32))
+    clipped_ratio = float(np.count_nonzero(abs_samples >= _CLIP_LEVEL)) / num_samples
+
+    # Mean power of each 10ms frame
+    num_frames = max(1, num_samples // _FRAME_SAMPLES)
+    frame_audio = audio[: num_frames * _FRAME_SAMPLES]
+    if len(frame_audio) < _FRAME_SAMPLES:
+        frame_power = np.array([np.mean(np.square(audio))])
+    else:
+        frame_power = np.mean(
+            np.square(frame_audio.reshape(num_frames, _FRAME_SAMPLES)), axis=1
+        )
+
+    silence_power = 10 ** (silence_db / 10)
+    loud_frames = np.flatnonzero(frame_power > silence_power)
+    if len(loud_frames) > 0:
+        leading_silence_sec = int(loud_frames[0] * _FRAME_SAMPLES) / _SAMPLE_RATE
+        trailing_silence_sec = max(
+            0.0,
+            duration_sec - int((loud_frames[-1] + 1) * _FRAME_SAMPLES) / _SAMPLE_RATE,
+        )
+    else:
+        leading_silence_sec = duration_sec
+        trailing_silence_sec = duration_sec
+
+    return AudioStats(
+        duration_sec=duration_sec,
+        rms_db=to_db(math.sqrt(float(np.mean(np.square(audio))))),
+        peak_db=to_db(float(abs_samples.max()) / 32768),
+        clipped_ratio=clipped_ratio,
+        leading_silence_sec=leading_silence_sec,
+        trailing_silence_sec=trailing_silence_sec,
+        dc_offset=dc_offset,
+    )
+
+
+def check_result(
+    result: QAResult,
+    thresholds: QAThresholds,
+    audio_info: typing.Optional[AudioInfo] = None,
+):
+    """Fill in rejected/flagged reasons of result"""
+    result.rejected.clear()
+    result.flagged.clear()
+
+    if (audio_info is not None) and (
+        0 < audio_info.sample_rate < thresholds.min_sample_rate
+    ):
+        result.rejected.append("sample_rate")
+
+    if result.error is not None:
+        result.rejected.append("decode_error")
+        return
+
+    stats = result.stats
+    assert stats is not None
+
+    if stats.duration_sec < thresholds.min_duration_sec:
+        result.rejected.append("too_short")
+
+    if stats.rms_db < thresholds.min_rms_db:
+        result.rejected.append("silent")
+
+    if stats.clipped_ratio > thresholds.max_clipped_ratio:
+        result.rejected.append("clipped")
+    elif stats.clipped_ratio > thresholds.flag_clipped_ratio:
+        result.flagged.append("clipped")
+
+    if (audio_info is not None) and (audio_info.duration_sec > 0):
+        # Expected duration of trimmed audio
+        expected_sec = audio_info.duration_sec
+        if result.end_ms is not None:
+            expected_sec = min(expected_sec, result.end_ms / 1000)
+
+        if result.start_ms is not None:
+            expected_sec -= result.start_ms / 1000
+
+        if (expected_sec - stats.duration_sec) > thresholds.max_missing_sec:
+            result.rejected.append("truncated")
+
+    if (stats.leading_silence_sec > thresholds.max_silence_sec) or (
+        stats.trailing_silence_sec > thresholds.max_silence_sec
+    ):
+        result.flagged.append("silence")
+
+    if abs(stats.dc_offset) > thresholds.max_dc_offset:
+        result.flagged.append("dc_offset")
+
+
+# -----------------------------------------------------------------------------
+
+
+class QACache:
+    """Audio statistics for files, recomputed when a file's size or
+    modification time changes.
+
+    Stored as text with one (possibly trimmed) file per line:
+    path|start_ms|end_ms|size|mtime_ns|<AudioStats fields>
+    """
+
+    def __init__(self, cache_path: typing.Optional[typing.Union[str, Path]] = None):
+        self.cache_path = Path(cache_path) if cache_path else None
+
+        # (path, start_ms, end_ms) -> (size, mtime_ns, stats)
+        self.entries: typing.Dict[
+            typing.Tuple[str, typing.Optional[int], typing.Optional[int]],
+            typing.Tuple[int, int, AudioStats],
+        ] = {}
+        self.is_dirty = False
+
+    def load(self):
+        """Load cache file if it exists"""
+        if (self.cache_path is None) or (not self.cache_path.is_file()):
+            return
+
+        num_stats = len(dataclasses.fields(AudioStats))
+        with open(self.cache_path, "r") as cache_file:
+            for line in cache_file:
+                line = line.rstrip("\n")
+                if not line:
+                    continue
+
+                try:
+                    (
+                        path_str,
+                        start_str,
+                        end_str,
+                        size_str,
+                        mtime_str,
+                        *stat_strs,
+                    ) = line.rsplit("|", maxsplit=4 + num_stats)
+                    if len(stat_strs) != num_stats:
+                        raise ValueError(line)
+
+                    key = (
+                        path_str,
+                        int(start_str) if start_str else None,
+                        int(end_str) if end_str else None,
+                    )
+                    self.entries[key] = (
+                        int(size_str),
+                        int(mtime_str),
+                        AudioStats(*(float(s) for s in stat_strs)),
+                    )
+                except ValueError:
+                    _LOGGER.warning("Bad line in %s: %s", self.cache_path, line)
+
+        _LOGGER.debug("Loaded %s cached audio statistic(s)", len(self.entries))
+
+    def save(self):
+        """Write cache file if anything has changed"""
+        if (self.cache_path is None) or (not self.is_dirty):
+            return
+
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_tmp_path = self.cache_path.with_suffix(".tmp")
+
+        with open(cache_tmp_path, "w") as cache_file:
+            for (path_str, start_ms, end_ms), (size, mtime_ns, stats) in sorted(
+                self.entries.items(), key=lambda kv: (kv[0][0], kv[0][1] or 0)
+            ):
+                print(
+                    path_str,
+                    "" if start_ms is None else start_ms,
+                    "" if end_ms is None else end_ms,
+                    size,
+                    mtime_ns,
+                    *dataclasses.astuple(stats),
+                    sep="|",
+                    file=cache_file,
+                )
+
+        os.replace(cache_tmp_path, self.cache_path)
+        self.is_dirty = False
+
+    def get(self, key: QAKey) -> typing.Optional[AudioStats]:
+        """Get cached statistics if the file hasn't changed since"""
+        audio_path, start_ms, end_ms = key
+        path_str = str(Path(audio_path).absolute())
+        entry = self.entries.get((path_str, start_ms, end_ms))
+        if entry is None:
+            return None
+
+        size, mtime_ns, stats = entry
+        try:
+            stat = os.stat(path_str)
+        except OSError:
+            # Deleted since it was cached (rejected as decode_error)
+            return None
+
+        if (stat.st_size != size) or (stat.st_mtime_ns != mtime_ns):
+            return None
+
+        return stats
+
+    def put(self, key: QAKey, stats: AudioStats):
+        """Store statistics for a file"""
+        audio_path, start_ms, end_ms = key
+        path_str = str(Path(audio_path).absolute())
+        try:
+            stat = os.stat(path_str)
+        except OSError:
+            # Deleted after it was decoded
+            return
+
+        self.entries[(path_str, start_ms, end_ms)] = (
+            stat.st_size,
+            stat.st_mtime_ns,
+            stats,
+        )
+        self.is_dirty = True
+
+
+# -----------------------------------------------------------------------------
+
+
+def scan_audio(
+    keys: typing.Iterable[QAKey],
+    audio_infos: typing.Optional[typing.Mapping[Path, AudioInfo]] = None,
+    thresholds: typing.Optional[QAThresholds] = None,
+    cache: typing.Optional[QACache] = None,
+    max_workers: typing.Optional[int] = None,
+) -> typing.Dict[QAKey, QAResult]:
+    """Decode and check audio in parallel.
+
+    Each file is decoded once, and statistics are taken from cache when
+    possible. Thresholds can be changed without decoding again.
+    """
+    # Non-Optional for get_key_stats
+    qa_thresholds = thresholds or QAThresholds()
+    path_infos = audio_infos or {}
+
+    results: typing.Dict[QAKey, QAResult] = {}
+    todo_keys: typing.List[QAKey] = []
+
+    for key in keys:
+        if key in results:
+            continue
+
+        audio_path, start_ms, end_ms = key
+        result = QAResult(path=audio_path, start_ms=start_ms, end_ms=end_ms)
+        results[key] = result
+
+        if cache is not None:
+            result.stats = cache.get(key)
+
+        if result.stats is None:
+            todo_keys.append(key)
+
+    if todo_keys:
+        _LOGGER.debug(
+            "Checking %s audio file(s) (%s cached)",
+            len(todo_keys),
+            len(results) - len(todo_keys),
+        )
+
+        def get_key_stats(key: QAKey) -> typing.Union[AudioStats, str]:
+            audio_path, start_ms, end_ms = key
+            try:
+                samples = read_pcm(
+                    audio_path, path_infos.get(audio_path), start_ms, end_ms
+                )
+                return get_stats(samples, silence_db=qa_thresholds.silence_db)
+            except Exception as e:
+                _LOGGER.debug("Failed to decode %s: %s", audio_path, e)
+                return str(e) or e.__class__.__name__
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for key, stats_or_error in zip(
+                todo_keys, executor.map(get_key_stats, todo_keys)
+            ):
+                result = results[key]
+                if isinstance(stats_or_error, AudioStats):
+                    result.stats = stats_or_error
+                    if cache is not None:
+                        cache.put(key, result.stats)
+                else:
+                    result.error = stats_or_error
+
+    for (audio_path, _, _), result in results.items():
+        check_result(result, qa_thresholds, path_infos.get(audio_path))
+
+    return results
+
+
+def write_report(
+    report_file: typing.TextIO, results: typing.Iterable[QAResult]
+) -> typing.Dict[str, int]:
+    """Write tab-separated report of results. Returns number of each status."""
+    stat_names = [f.name for f in dataclasses.fields(AudioStats)]
+    print(
+        "path",
+        "start_ms",
+        "end_ms",
+        "status",
+        "reasons",
+        *stat_names,
+        sep="\t",
+        file=report_file,
+    )
+
+    status_counts: typing.Dict[str, int] = {"ok": 0, "flagged": 0, "rejected": 0}
+    for result in results:
+        status_counts[result.status] += 1
+
+        stat_strs = [""] * len(stat_names)
+        if result.stats is not None:
+            stat_strs = [f"{s:.4f}" for s in dataclasses.astuple(result.stats)]
+
+        print(
+            result.path,
+            "" if result.start_ms is None else result.start_ms,
+            "" if result.end_ms is None else result.end_ms,
+            result.status,
+            ",".join(result.rejected + result.flagged),
+            *stat_strs,
+            sep="\t",
+            file=report_file,
+        )
+
+    return status_counts
+
+
+def parse_thresholds(settings: typing.Iterable[str]) -> QAThresholds:
+    """Create thresholds from name=value strings (e.g., min_rms_db=-50)"""
+    thresholds = QAThresholds()
+    field_types = {f.name: f.type for f in dataclasses.fields(QAThresholds)}
+
+    for setting in settings:
+        name, value_str = setting.split("=", maxsplit=1)
+        name = name.strip().replace("-", "_")
+        if name not in field_types:
+            raise ValueError(
+                f"Unknown QA threshold: {name} (expected one of {list(field_types)})"
+            )
+
+        value_type = int if field_types[name] in (int, "int") else float
+        setattr(thresholds, name, value_type(value_str))
+
+    return thresholds
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi audio-qa"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi audio-qa")
+    parser.add_argument(
+        "audio", nargs="+", help="Audio files or directories with audio files"
+    )
+    parser.add_argument(
+        "--extension",
+        action="append",
+        help="Extension of audio files in directories (default: .wav, .mp3, .flac)",
+    )
+    parser.add_argument(
+        "--threshold",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Override QA threshold (e.g., min_rms_db=-50)",
+    )
+    parser.add_argument("--report", help="Path to write report (default: stdout)")
+    parser.add_argument("--audio-cache", help="Path to cache of probed audio details")
+    parser.add_argument("--qa-cache", help="Path to cache of audio statistics")
+    parser.add_argument("--jobs", type=int, help="Number of files to check at once")
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    thresholds = parse_thresholds(args.threshold)
+    extensions = set(args.extension or [".wav", ".mp3", ".flac"])
+
+    audio_paths: typing.List[Path] = []
+    for audio_path_str in args.audio:
+        audio_path = Path(audio_path_str)
+        if audio_path.is_dir():
+            audio_paths.extend(
+                sorted(p for p in audio_path.rglob("*") if p.suffix in extensions)
+            )
+        else:
+            audio_paths.append(audio_path)
+
+    audio_cache = AudioCache(args.audio_cache)
+    audio_cache.load()
+    audio_infos = audio_cache.probe(audio_paths, max_workers=args.jobs)
+    audio_cache.save()
+
+    qa_cache = QACache(args.qa_cache)
+    qa_cache.load()
+    results = scan_audio(
+        ((p, None, None) for p in audio_paths),
+        audio_infos,
+        thresholds=thresholds,
+        cache=qa_cache,
+        max_workers=args.jobs,
+    )
+    qa_cache.save()
+
+    if args.report:
+        with open(args.report, "w") as report_file:
+            status_counts = write_report(report_file, results.values())
+    else:
+        status_counts = write_report(sys.stdout, results.values())
+
+    _LOGGER.info(
+        "Checked %s file(s): %s ok, %s flagged, %s rejected",
+        len(results),
+        status_counts["ok"],
+        status_counts["flagged"],
+        status_counts["rejected"],
+    )
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -17,3 +17,16 @@ export cuda_cmd="utils/run.pl -l gpu=1"
 
 export nJobs=12
 export nDecodeJobs=12
+export nDecodeThreads=1
+
+# nnet3 chain training (ipa2kaldi sets a CPU profile when there is no GPU)
+export nnetUseGpu=wait
+export nnetJobsInitial=1
+export nnetJobsFinal=1
+export nnetMinibatchSize=512
+export nnetFramesPerIter=1500000
+
+# Directory of nnet3 egs kept between trainings (empty to disable)
+export egsCacheDir=
+export egsCacheMaxGb=100
+export egsCacheCmd="python3 -m ipa2kaldi egs-cache"
@@ -1,4 +1,6 @@
 #!/usr/bin/env bash
+#
+# See also: python3 -m ipa2kaldi export (parallel, incremental, with checksums)
 set -e
 
 if [[ -z "$1" ]]; then
@@ -25,9 +27,11 @@ echo "Exporting to ${dest_dir}"
 echo 'Copying lexicon...'
 gzip -9 "${dict_dir}/lexicon.txt" --no-name --to-stdout > "${dest_dir}/base_dictionary.txt.gz"
 
-# ARPA language model
+# ARPA language model (the pruned one if the graph was made from it)
 echo 'Copying language model...'
-if [[ -f "${lm_dir}/lm.arpa.gz" ]]; then
+if [[ -f "${lm_dir}/lm.pruned.arpa.gz" && ! "${lm_dir}/lm.pruned.arpa.gz" -ot "${lm_dir}/lm.arpa.gz" ]]; then
+    zcat "${lm_dir}/lm.pruned.arpa.gz" | gzip -9 '-' --no-name --to-stdout > "${dest_dir}/base_language_model.txt.gz"
+elif [[ -f "${lm_dir}/lm.arpa.gz" ]]; then
     zcat "${lm_dir}/lm.arpa.gz" | gzip -9 '-' --no-name --to-stdout > "${dest_dir}/base_language_model.txt.gz"
 else
     gzip -9 "${lm_dir}/lm.arpa" --no-name --to-stdout > "${dest_dir}/base_language_model.txt.gz"
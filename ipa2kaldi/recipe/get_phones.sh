@@ -12,6 +12,9 @@ stage=0
 use_segments=true # if we have a segments file, use it to convert
                   # the segments to be relative to the original files.
 print_silence=false # if true, will print <eps> (optional-silence) arcs.
+concatenate=true # if false, keep phones.JOB.gz and phone_ctm.JOB.gz instead of concatenating
+                 # them into single phones and phone_ctm files (read them with:
+                 # ipa2kaldi alignments <output-dir>)
 
 #end configuration section.
 
@@ -32,6 +35,8 @@ if [ $# -ne 3 ] && [ $# -ne 4 ]; then
   echo "                                    # for NIST scoring)."
   echo "    --frame-shift (default=0.01)    # specify this if your alignments have a frame-shift"
   echo "                                    # not equal to 0.01 seconds"
+  echo "    --concatenate (true|false)      # concatenate phones.JOB.gz and phone_ctm.JOB.gz into"
+  echo "                                    # phones and phone_ctm files (default: true)"
   echo "e.g.:"
   echo "$0 data/train data/lang exp/tri3a_ali"
   echo "Produces ctm in: exp/tri3a_ali/ctm"
@@ -71,9 +76,17 @@ if [ $stage -le 0 ]; then
          utils/int2sym.pl -f 4 $lang/words.txt \| \
          utils/int2sym.pl -f 5- $lang/phones.txt \| \
          gzip -c '>' $dir/phones.JOB.gz || exit 1
+
+    # Real phone durations (phones.JOB.gz only has word boundaries)
+    $cmd JOB=1:$nj $dir/log/get_phone_ctm.JOB.log \
+         set -o pipefail '&&' ali-to-phones --frame-shift=$frame_shift --ctm-output $model \
+         "ark:gunzip -c $ali_dir/ali.JOB.gz|" - \| \
+         utils/int2sym.pl -f 5 $lang/phones.txt \| \
+         gzip -c '>' $dir/phone_ctm.JOB.gz || exit 1
 fi
 
-if [ $stage -le 1 ]; then
+if [ $stage -le 1 ] && $concatenate; then
   for n in `seq $nj`; do gunzip -c $dir/phones.$n.gz; done > $dir/phones || exit 1;
-  rm $dir/phones.*.gz
+  for n in `seq $nj`; do gunzip -c $dir/phone_ctm.$n.gz; done > $dir/phone_ctm || exit 1;
+  rm $dir/phones.*.gz $dir/phone_ctm.*.gz
 fi
@@ -0,0 +1,64 @@
+#!/usr/bin/env bash
+# Runs utils/fix_data_dir.sh only if a data directory needs fixing.
+#
+# fix_data_dir.sh re-sorts and cross-filters every file, even when nothing
+# changes. It is skipped when:
+# * ipa2kaldi validated the directory (<data-dir>/.validated is newer than
+#   every file in it), or
+# * utt2spk has unique keys in sorted order, spk2utt matches it, and each of
+#   feats.scp, text, utt2dur, etc. (cmvn.scp) has exactly the same
+#   utterances (speakers) in the same order
+#
+# These checks only read each file once, without sorting.
+
+if [ $# -ne 1 ]; then
+    echo "Usage: $0 <data-dir>"
+    exit 1
+fi
+
+data=$1
+
+export LC_ALL=C
+
+same_keys() {
+    cmp -s <(cut -d' ' -f1 $1) <(cut -d' ' -f1 $2)
+}
+
+is_fixed() {
+    [ -f $data/utt2spk ] && [ -f $data/spk2utt ] || return 1
+
+    if [ -f $data/.validated ] && \
+           [ -z "$(find $data -maxdepth 1 -type f -newer $data/.validated)" ]; then
+        return 0
+    fi
+
+    cut -d' ' -f1 $data/utt2spk | sort -C -u || return 1
+    utils/utt2spk_to_spk2utt.pl $data/utt2spk | cmp -s - $data/spk2utt || return 1
+
+    utt_files="text feats.scp utt2dur utt2num_frames utt2uniq"
+    if [ -f $data/segments ]; then
+        utt_files="$utt_files segments"
+    else
+        utt_files="$utt_files wav.scp reco2dur"
+    fi
+
+    for f in $utt_files; do
+        if [ -f $data/$f ]; then
+            same_keys $data/$f $data/utt2spk || return 1
+        fi
+    done
+
+    for f in cmvn.scp spk2gender; do
+        if [ -f $data/$f ]; then
+            same_keys $data/$f $data/spk2utt || return 1
+        fi
+    done
+
+    return 0
+}
+
+if is_fixed; then
+    echo "$0: $data is already sorted and consistent"
+else
+    utils/fix_data_dir.sh $data || exit 1
+fi
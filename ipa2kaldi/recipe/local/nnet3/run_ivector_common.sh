@@ -28,6 +28,64 @@ nnet3_affix=_cleaned     # affix for exp/nnet3 directory to put iVector stuff in
 gmm_dir=exp/${gmm}
 ali_dir=exp/${gmm}_ali_${train_set}_sp_comb
 
+# Speed-perturbed copy of the training data with audio already rendered by
+# ipa2kaldi (ipa2kaldi speed-perturb). Used instead of sox pipes from
+# perturb_data_dir_speed_3way.sh if it has every training utterance.
+prerendered_sp=data/${train_set}_sp_prerendered
+
+# Checks by content rather than modification time, since fix_data_dir.sh
+# rewrites the training data without changing it.
+check_prerendered_sp() {
+  local f
+  for f in wav.scp utt2uniq text; do
+    if [ ! -f $prerendered_sp/$f ]; then
+      echo "missing $prerendered_sp/$f"
+      return 1
+    fi
+  done
+
+  # Every training utterance must have been rendered (extra utterances that
+  # were dropped from the training data are left out below).
+  local num_missing=$(awk 'NR == FNR { rendered[$2] = 1; next } !($1 in rendered)' \
+    $prerendered_sp/utt2uniq data/${train_set}/utt2spk | wc -l)
+  if [ $num_missing -gt 0 ]; then
+    echo "$num_missing utterance(s) of data/${train_set} were not rendered"
+    return 1
+  fi
+
+  # Transcripts of the unperturbed copies must be the same
+  if ! utils/filter_scp.pl data/${train_set}/utt2spk $prerendered_sp/text | \
+      cmp -s - <(LC_ALL=C sort data/${train_set}/text); then
+    echo "transcripts in data/${train_set} have changed"
+    return 1
+  fi
+
+  return 0
+}
+
+perturb_speed() {
+  local reason
+  if [ -d $prerendered_sp ] && reason=$(check_prerendered_sp); then
+    echo "$0: using pre-rendered speed-perturbed audio from $prerendered_sp"
+    rm -rf data/${train_set}_sp
+
+    # only utterances that are still in the (fixed) training data
+    mkdir -p data/local
+    utils/filter_scp.pl -f 2 data/${train_set}/utt2spk $prerendered_sp/utt2uniq | \
+      awk '{print $1}' > data/local/${train_set}_sp_utts
+    utils/data/subset_data_dir.sh --utt-list data/local/${train_set}_sp_utts \
+      $prerendered_sp data/${train_set}_sp
+    utils/validate_data_dir.sh --no-feats data/${train_set}_sp
+  else
+    if [ -d $prerendered_sp ]; then
+      echo "$0: WARNING: not using $prerendered_sp ($reason)"
+      echo "$0: WARNING: rendering speed-perturbed audio with sox pipes instead (re-run ipa2kaldi with --speed-perturb to fix)"
+    fi
+
+    utils/data/perturb_data_dir_speed_3way.sh data/${train_set} data/${train_set}_sp
+  fi
+}
+
 for f in data/${train_set}/feats.scp ${gmm_dir}/final.mdl; do
   if [ ! -f $f ]; then
     echo "$0: expected file $f to exist"
@@ -46,7 +104,7 @@ fi
 
 if [ $stage -le 1 ]; then
   echo "$0: preparing directory for speed-perturbed data"
-  utils/data/perturb_data_dir_speed_3way.sh data/${train_set} data/${train_set}_sp
+  perturb_speed
 fi
 
 if [ $stage -le 2 ]; then
@@ -73,7 +131,7 @@ if [ $stage -le 2 ]; then
     steps/make_mfcc.sh --nj $nj --mfcc-config conf/mfcc_hires.conf \
       --cmd "$train_cmd" data/${datadir}_hires
     steps/compute_cmvn_stats.sh data/${datadir}_hires
-    utils/fix_data_dir.sh data/${datadir}_hires
+    local/fix_data_dir_fast.sh data/${datadir}_hires
   done
 fi
 
@@ -86,7 +144,7 @@ if [ $stage -le 3 ]; then
 
   # just copy over the CMVN to avoid having to recompute it.
   cp data/${train_set}_sp_hires/cmvn.scp data/${train_set}_sp_hires_comb/
-  utils/fix_data_dir.sh data/${train_set}_sp_hires_comb/
+  local/fix_data_dir_fast.sh data/${train_set}_sp_hires_comb
 fi
 
 if [ $stage -le 4 ]; then
@@ -199,8 +257,7 @@ fi
 
 if [ $stage -le 8 ]; then
   echo "$0: preparing directory for low-resolution speed-perturbed data (for alignment)"
-  utils/data/perturb_data_dir_speed_3way.sh \
-    data/${train_set} data/${train_set}_sp
+  perturb_speed
 fi
 
 if [ $stage -le 9 ]; then
@@ -210,7 +267,7 @@ if [ $stage -le 9 ]; then
   steps/compute_cmvn_stats.sh data/${train_set}_sp
   echo "$0: fixing input data-dir to remove nonexistent features, in case some "
   echo ".. speed-perturbed segments were too short."
-  utils/fix_data_dir.sh data/${train_set}_sp
+  local/fix_data_dir_fast.sh data/${train_set}_sp
 fi
 
 if [ $stage -le 10 ]; then
@@ -221,7 +278,10 @@ if [ $stage -le 10 ]; then
   # re-use the CMVN stats from the source directory, since it seems to be slow to
   # re-compute them after concatenating short segments.
   cp $src/cmvn.scp $dest/
-  utils/fix_data_dir.sh $dest
+  local/fix_data_dir_fast.sh $dest
+
+  # split jobs by audio duration instead of speaker count
+  local/split_data_balanced.sh $dest $nj
 fi
 
 if [ $stage -le 11 ]; then
@@ -0,0 +1,111 @@
+#!/usr/bin/env bash
+# Splits a data directory into <num-jobs> parts like utils/split_data.sh, but
+# balances the total audio duration of each part instead of speaker counts.
+#
+# Speaker assignments are kept in <data-dir>/split<num-jobs>/spk2job:
+# * ipa2kaldi pre-builds them for data/train and data/test
+# * otherwise speakers are bin-packed by duration from utt2dur
+# * without utt2dur, this falls back to utils/split_data.sh
+#
+# Run this after any step that changes the data directory (make_mfcc.sh,
+# fix_data_dir.sh, etc.). Kaldi scripts will then find an up-to-date split
+# and won't re-split it.
+
+if [ $# -ne 2 ]; then
+    echo "Usage: $0 <data-dir> <num-jobs>"
+    exit 1
+fi
+
+data=$1
+nj=$2
+sdata=$data/split$nj
+spk2job=$sdata/spk2job
+
+export LC_ALL=C
+
+for f in $data/utt2spk; do
+    [ ! -f $f ] && echo "$0: expected file $f to exist" && exit 1
+done
+
+if [ -f $spk2job ]; then
+    # Check that every speaker still has a job
+    if awk 'NR == FNR { job[$1] = $2; next }
+            !($2 in job) { missing = 1; exit }
+            END { exit !missing }' $spk2job $data/utt2spk; then
+        echo "$0: $data has speakers that are missing from $spk2job; re-balancing"
+        rm -f $spk2job
+    fi
+fi
+
+if [ ! -f $spk2job ]; then
+    if [ ! -f $data/utt2dur ]; then
+        utils/split_data.sh $data $nj
+        exit $?
+    fi
+
+    mkdir -p $sdata
+
+    # Longest speakers first, each onto the job with the least audio so far
+    awk 'NR == FNR { dur[$1] = $2; next }
+         { spk_dur[$2] += (($1 in dur) ? dur[$1] : 0) }
+         END { for (spk in spk_dur) print spk, spk_dur[spk] }' \
+        $data/utt2dur $data/utt2spk | \
+        sort -k2,2gr -k1,1 | \
+        awk -v nj=$nj '{
+            best = 1
+            for (j = 2; j <= nj; j++) if (load[j] < load[best]) best = j
+            load[best] += $2
+            print $1, best
+        }' | \
+        sort > $spk2job || exit 1
+fi
+
+tmpdir=$(mktemp -d)
+trap "rm -rf $tmpdir" EXIT
+
+for n in $(seq $nj); do
+    mkdir -p $sdata/$n
+    awk -v n=$n '$2 == n { print $1 }' $spk2job > $tmpdir/spks.$n
+
+    utils/filter_scp.pl -f 2 $tmpdir/spks.$n $data/utt2spk > $sdata/$n/utt2spk
+    if [ ! -s $sdata/$n/utt2spk ]; then
+        echo "$0: job $n of $data has no utterances (too few speakers?)"
+        exit 1
+    fi
+
+    utils/utt2spk_to_spk2utt.pl $sdata/$n/utt2spk > $sdata/$n/spk2utt
+
+    # Utterance-level files
+    for f in feats.scp text utt2dur utt2num_frames utt2uniq utt2lang vad.scp segments; do
+        if [ -f $data/$f ]; then
+            utils/filter_scp.pl $sdata/$n/utt2spk $data/$f > $sdata/$n/$f
+        else
+            rm -f $sdata/$n/$f
+        fi
+    done
+
+    # Recording-level files
+    if [ -f $data/segments ]; then
+        awk '{ print $2 }' $sdata/$n/segments | sort -u > $tmpdir/recos.$n
+        for f in wav.scp reco2file_and_channel reco2dur; do
+            if [ -f $data/$f ]; then
+                utils/filter_scp.pl $tmpdir/recos.$n $data/$f > $sdata/$n/$f
+            else
+                rm -f $sdata/$n/$f
+            fi
+        done
+    elif [ -f $data/wav.scp ]; then
+        utils/filter_scp.pl $sdata/$n/utt2spk $data/wav.scp > $sdata/$n/wav.scp
+    fi
+
+    # Speaker-level files
+    for f in cmvn.scp spk2gender spk2warp; do
+        if [ -f $data/$f ]; then
+            utils/filter_scp.pl $sdata/$n/spk2utt $data/$f > $sdata/$n/$f
+        else
+            rm -f $sdata/$n/$f
+        fi
+    done
+done
+
+exit 0
@@ -0,0 +1,32 @@
+#!/usr/bin/env bash
+# Copies features and CMVN stats into a subset of a data directory.
+#
+# ipa2kaldi writes subsets of data/train (e.g., data/train_mono) before
+# features exist. Once data/train has MFCCs, this picks out the subset's
+# entries from feats.scp and cmvn.scp, and drops subset utterances that
+# failed to get features.
+
+if [ $# -ne 2 ]; then
+    echo "Usage: $0 <data-dir> <subset-dir>"
+    exit 1
+fi
+
+data=$1
+subset=$2
+
+export LC_ALL=C
+
+for f in $data/feats.scp $data/cmvn.scp $subset/utt2spk $subset/spk2utt; do
+    [ ! -f $f ] && echo "$0: expected file $f to exist" && exit 1
+done
+
+utils/filter_scp.pl $subset/utt2spk $data/feats.scp > $subset/feats.scp
+utils/filter_scp.pl $subset/spk2utt $data/cmvn.scp > $subset/cmvn.scp
+
+for f in frame_shift; do
+    [ -f $data/$f ] && cp $data/$f $subset/
+done
+
+[ -d $data/conf ] && cp -r $data/conf $subset/
+
+local/fix_data_dir_fast.sh $subset || exit 1
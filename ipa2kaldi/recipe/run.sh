@@ -22,6 +22,7 @@
 mfccdir=mfcc_chain
 
 stage=0
+stop_stage=100
 min_seg_len=1.55
 train_set=train
 gmm=tri2b_chain # the gmm for the target data
@@ -35,6 +36,17 @@ common_egs_dir=  # you can set this to use previously dumped egs.
 dropout_schedule='0,0@0.20,0.5@0.50,0'
 frames_per_eg=150,110,100
 
+# Options that change the dumped egs (also part of the egs cache fingerprint)
+chunk_width=150
+egs_opts="--frames-overlap-per-eg 0"
+cmvn_opts="--norm-means=false --norm-vars=false"
+chain_lm_opts="--num-extra-lm-states=2000"
+
+# used by the ipa2kaldi stage runner to run steps separately
+mfcc_datadirs="train test"
+clean_exp=true  # remove exp/ before making MFCCs
+mkgraph=true    # make decoding graphs after training
+
 # pre-flight checks
 
 if [ -f cmd.sh ]; then
@@ -49,24 +61,36 @@ if [ -f path.sh ]; then
 
 fi
 
-# At this script level we don't support not running on GPU, as it would be painfully slow.
-# If you want to run without GPU you'd have to call train_tdnn.sh with --gpu false,
-# --num-threads 16 and --minibatch-size 128.
-
-if ! cuda-compiled; then
+# Training profile from cmd.sh (defaults are for GPU training).
+# Without a GPU, ipa2kaldi sets nnetUseGpu=false with one training job per
+# CPU core and smaller minibatches (see --training-device).
+nnetUseGpu=${nnetUseGpu:-wait}
+nnetJobsInitial=${nnetJobsInitial:-1}
+nnetJobsFinal=${nnetJobsFinal:-1}
+nnetMinibatchSize=${nnetMinibatchSize:-512}
+nnetFramesPerIter=${nnetFramesPerIter:-1500000}
+nDecodeThreads=${nDecodeThreads:-1}
+
+# Reuse egs dumped from the same inputs (see python3 -m ipa2kaldi egs-cache)
+egsCacheDir=${egsCacheDir:-}
+egsCacheMaxGb=${egsCacheMaxGb:-100}
+egsCacheCmd=${egsCacheCmd:-python3 -m ipa2kaldi egs-cache}
+
+if [ "$nnetUseGpu" != "false" ] && ! cuda-compiled; then
   cat <<EOF && exit 1
-This script is intended to be used with GPUs but you have not compiled Kaldi with CUDA
+This script is set up to train with GPUs but you have not compiled Kaldi with CUDA
 If you want to use GPUs (and have them), go to src/, and configure and make on a machine
-where "nvcc" is installed.
+where "nvcc" is installed. Otherwise, re-run ipa2kaldi with --training-device cpu
+or set nnetUseGpu=false in cmd.sh.
 EOF
 fi
 
 . utils/parse_options.sh
 
-echo "Runtime configuration is: nJobs $nJobs, nDecodeJobs $nDecodeJobs. If this is not what you want, edit cmd.sh"
+echo "Runtime configuration is: nJobs $nJobs, nDecodeJobs $nDecodeJobs, nnetUseGpu $nnetUseGpu, nnetJobsFinal $nnetJobsFinal. If this is not what you want, edit cmd.sh"
 echo "Starting at stage $stage, train_stage $train_stage"
 
-if [ $stage -le 0 ]; then
+if [ $stage -le 0 ] && [ $stop_stage -ge 0 ]; then
 
     # remove old lang dir if it exists
     rm -rf data/lang
@@ -77,7 +101,7 @@ if [ $stage -le 0 ]; then
 fi
 
 
-if [ $stage -le 1 ]; then
+if [ $stage -le 1 ] && [ $stop_stage -ge 1 ]; then
 
     echo
     echo Prepare phoneme data for Kaldi
@@ -95,7 +119,7 @@ fi
 # adapt our LM for kaldi
 #
 
-if [ $stage -le 2 ]; then
+if [ $stage -le 2 ] && [ $stop_stage -ge 2 ]; then
 
     echo
     echo "adapt our LM for kaldi..."
@@ -108,29 +132,53 @@ if [ $stage -le 2 ]; then
     echo "creating G.fst..."
 
     mkdir -p data/local/lm/
-    zcat lm/lm.arpa.gz | utils/find_arpa_oovs.pl data/lang_test/words.txt  > data/local/lm/oovs_lm.txt
-
-    zcat lm/lm.arpa.gz | \
-        grep -v '<s> <s>' | \
-        grep -v '</s> <s>' | \
-        grep -v '</s> </s>' | \
-        arpa2fst - | fstprint | \
-        utils/remove_oovs.pl data/local/lm/oovs_lm.txt | \
-        utils/eps2disambig.pl | utils/s2eps.pl | fstcompile --isymbols=data/lang_test/words.txt \
-          --osymbols=data/lang_test/words.txt  --keep_isymbols=false --keep_osymbols=false | \
-         fstrmepsilon > data/lang_test/G.fst
+    lm_filtered=data/local/lm/lm_filtered.arpa.gz
+    lm_filtered_vocab=data/local/lm/lm_filtered.vocab
+
+    # Decoding LM (pruned by ipa2kaldi with --prune-lm-ngrams/threshold)
+    lm_decode=lm/lm.arpa.gz
+    if [ -f lm/lm.pruned.arpa.gz ] && [ ! lm/lm.pruned.arpa.gz -ot lm/lm.arpa.gz ]; then
+        lm_decode=lm/lm.pruned.arpa.gz
+    fi
+
+    # The filtered LM is only used if it was made from the current LM and
+    # exactly the words in the lexicon (lang_test/words.txt without <eps>/#0)
+    if [ -f $lm_filtered ] && [ -f $lm_filtered_vocab ] && \
+           [ ! $lm_filtered -ot $lm_decode ] && \
+           cmp -s $lm_filtered_vocab \
+               <(awk '$1 != "<eps>" && $1 != "#0" { print $1 }' data/lang_test/words.txt | LC_ALL=C sort); then
+        # ipa2kaldi already removed OOVs and degenerate n-grams
+        arpa2fst --disambig-symbol=#0 --read-symbol-table=data/lang_test/words.txt \
+            "gunzip -c $lm_filtered |" data/lang_test/G.fst || exit 1;
+    else
+        echo "$0: $lm_filtered is missing or out of date, filtering $lm_decode instead"
+        zcat $lm_decode | utils/find_arpa_oovs.pl data/lang_test/words.txt  > data/local/lm/oovs_lm.txt
+
+        zcat $lm_decode | \
+            grep -v '<s> <s>' | \
+            grep -v '</s> <s>' | \
+            grep -v '</s> </s>' | \
+            arpa2fst - | fstprint | \
+            utils/remove_oovs.pl data/local/lm/oovs_lm.txt | \
+            utils/eps2disambig.pl | utils/s2eps.pl | fstcompile --isymbols=data/lang_test/words.txt \
+              --osymbols=data/lang_test/words.txt  --keep_isymbols=false --keep_osymbols=false | \
+             fstrmepsilon > data/lang_test/G.fst
+    fi
 
 fi
 
-if [ $stage -le 3 ]; then
+if [ $stage -le 3 ] && [ $stop_stage -ge 3 ]; then
     echo
     echo make mfcc
     echo
 
-    rm -rf exp/
+    if $clean_exp; then
+        rm -rf exp/
+    fi
 
-    for datadir in train test; do
-        utils/fix_data_dir.sh data/$datadir
+    for datadir in $mfcc_datadirs; do
+        # No-op for data dirs from ipa2kaldi, which are already fixed
+        local/fix_data_dir_fast.sh data/$datadir || exit 1;
 
         mkdir -p data/$datadir/wav.scp exp/make_mfcc_chain/$datadir
 
@@ -139,34 +187,65 @@ if [ $stage -le 3 ]; then
         done
 
         steps/make_mfcc.sh --cmd "$train_cmd" --nj $nJobs data/$datadir exp/make_mfcc_chain/$datadir $mfccdir || exit 1;
-        utils/fix_data_dir.sh data/${datadir} # some files fail to get mfcc for many reasons
+        local/fix_data_dir_fast.sh data/${datadir} || exit 1; # some files fail to get mfcc for many reasons
         steps/compute_cmvn_stats.sh data/${datadir} exp/make_mfcc_chain/$datadir $mfccdir || exit 1;
-        utils/fix_data_dir.sh data/${datadir} # some files fail to get mfcc for many reasons
+        local/fix_data_dir_fast.sh data/${datadir} || exit 1;
+
+        # split jobs by audio duration instead of speaker count
+        local/split_data_balanced.sh data/${datadir} $nJobs || exit 1;
     done
 fi
 
-if [ $stage -le 4 ]; then
+# Subsets of data/train from ipa2kaldi for the first GMMs (shortest
+# utterances for mono, a few hours from every speaker for tri1)
+mono_data=data/train_mono
+[ -f $mono_data/utt2spk ] || mono_data=data/train
+
+tri1_data=data/train_tri1
+[ -f $tri1_data/utt2spk ] || tri1_data=data/train
+
+# Number of jobs for a data dir (at most one per speaker)
+data_nj() {
+    local num_spks=$(wc -l < $1/spk2utt)
+    echo $(( num_spks < nJobs ? num_spks : nJobs ))
+}
+
+# Adds features to a subset of data/train and splits it for <num-jobs>
+prepare_subset() {
+    if [ $1 != data/train ]; then
+        local/subset_features.sh data/train $1 || return 1;
+        local/split_data_balanced.sh $1 $2 || return 1;
+    fi
+}
+
+if [ $stage -le 4 ] && [ $stop_stage -ge 4 ]; then
     echo
     echo mono0a_chain
     echo
 
-    steps/train_mono.sh --nj $nJobs --cmd "$train_cmd" \
-      data/train data/lang exp/mono0a_chain || exit 1;
+    mono_nj=$(data_nj $mono_data)
+    prepare_subset $mono_data $mono_nj || exit 1;
+
+    steps/train_mono.sh --nj $mono_nj --cmd "$train_cmd" \
+      $mono_data data/lang exp/mono0a_chain || exit 1;
 fi
 
-if [ $stage -le 5 ]; then
+if [ $stage -le 5 ] && [ $stop_stage -ge 5 ]; then
     echo
     echo tri1_chain
     echo
 
-    steps/align_si.sh --nj $nJobs --cmd "$train_cmd" \
-      data/train data/lang exp/mono0a_chain exp/mono0a_ali_chain || exit 1;
+    tri1_nj=$(data_nj $tri1_data)
+    prepare_subset $tri1_data $tri1_nj || exit 1;
+
+    steps/align_si.sh --nj $tri1_nj --cmd "$train_cmd" \
+      $tri1_data data/lang exp/mono0a_chain exp/mono0a_ali_chain || exit 1;
 
     steps/train_deltas.sh --cmd "$train_cmd" 2000 10000 \
-      data/train data/lang exp/mono0a_ali_chain exp/tri1_chain || exit 1;
+      $tri1_data data/lang exp/mono0a_ali_chain exp/tri1_chain || exit 1;
 fi
 
-if [ $stage -le 6 ]; then
+if [ $stage -le 6 ] && [ $stop_stage -ge 6 ]; then
     echo
     echo tri2b_chain
     echo
@@ -178,8 +257,10 @@ if [ $stage -le 6 ]; then
       --splice-opts "--left-context=3 --right-context=3" 2500 15000 \
       data/train data/lang exp/tri1_ali_chain exp/tri2b_chain || exit 1;
 
-    utils/mkgraph.sh data/lang_test \
-      exp/tri2b_chain exp/tri2b_chain/graph || exit 1;
+    if $mkgraph; then
+        utils/mkgraph.sh data/lang_test \
+          exp/tri2b_chain exp/tri2b_chain/graph || exit 1;
+    fi
 fi
 
 gmm_dir=exp/$gmm
@@ -192,7 +273,7 @@ train_data_dir=data/${train_set}_sp_hires_comb
 lores_train_data_dir=data/${train_set}_sp_comb
 train_ivector_dir=exp/nnet3${nnet3_affix}/ivectors_${train_set}_sp_hires_comb
 
-if [ $stage -le 7 ]; then
+if [ $stage -le 7 ] && [ $stop_stage -ge 7 ]; then
     echo
     echo run_ivector_common.sh
     echo
@@ -211,7 +292,7 @@ if [ $stage -le 7 ]; then
     done
 fi
 
-if [ $stage -le 8 ]; then
+if [ $stage -le 8 ] && [ $stop_stage -ge 8 ]; then
     echo
     echo creating lang directory with one state per phone.
     echo
@@ -234,17 +315,18 @@ if [ $stage -le 8 ]; then
     fi
 fi
 
-if [ $stage -le 9 ]; then
+if [ $stage -le 9 ] && [ $stop_stage -ge 9 ]; then
     echo
     echo 'Get the alignments as lattices (gives the chain training more freedom).'
     echo
 
+    local/split_data_balanced.sh ${lores_train_data_dir} $nJobs || exit 1;
     steps/align_fmllr_lats.sh --nj $nJobs --cmd "$train_cmd" ${lores_train_data_dir} \
         data/lang $gmm_dir $lat_dir
     rm $lat_dir/fsts.*.gz # save space
 fi
 
-if [ $stage -le 10 ]; then
+if [ $stage -le 10 ] && [ $stop_stage -ge 10 ]; then
     echo
     echo 'Build a tree using our new topology.  We know we have alignments for the'
     echo 'speed-perturbed data (local/nnet3/run_ivector_common.sh made them), so use'
@@ -265,7 +347,7 @@ fi
 # smaller model for embedded use
 #
 
-if [ $stage -le 11 ]; then
+if [ $stage -le 11 ] && [ $stop_stage -ge 11 ]; then
 
     mkdir -p $dir
 
@@ -313,6 +395,31 @@ output-layer name=output-xent dim=$num_targets learning-rate-factor=$learning_ra
 EOF
     steps/nnet3/xconfig_to_configs.py --xconfig-file $dir/configs/network.xconfig --config-dir $dir/configs/
 
+    # Egs only depend on these inputs and options, not other hyperparameters
+    egs_key=
+    remove_egs=true
+    if [ -z "$common_egs_dir" ] && [ -n "$egsCacheDir" ]; then
+        egs_key=$($egsCacheCmd fingerprint \
+            --input $train_data_dir --input $train_ivector_dir \
+            --input $lat_dir --input $tree_dir --input $dir/configs/vars \
+            --option "chunk-width=$chunk_width" \
+            --option "egs-opts=$egs_opts" \
+            --option "cmvn-opts=$cmvn_opts" \
+            --option "lm-opts=$chain_lm_opts" \
+            --option "frames-per-iter=$nnetFramesPerIter") || egs_key=
+
+        if [ -n "$egs_key" ]; then
+            common_egs_dir=$($egsCacheCmd lookup --cache-dir $egsCacheDir $egs_key)
+            if [ -z "$common_egs_dir" ]; then
+                # Keep dumped egs for the cache
+                remove_egs=false
+            fi
+        else
+            echo "$0: WARNING: failed to fingerprint egs inputs with '$egsCacheCmd'," \
+                "egs cache $egsCacheDir is disabled for this run" >&2
+        fi
+    fi
+
     echo
     echo train.py
     echo
@@ -320,44 +427,51 @@ EOF
     steps/nnet3/chain/train.py --stage $train_stage \
       --cmd "$decode_cmd" \
       --feat.online-ivector-dir $train_ivector_dir \
-      --feat.cmvn-opts "--norm-means=false --norm-vars=false" \
+      --feat.cmvn-opts "$cmvn_opts" \
       --chain.xent-regularize 0.1 \
       --chain.leaky-hmm-coefficient 0.1 \
       --chain.l2-regularize 0.00005 \
       --chain.apply-deriv-weights false \
-      --chain.lm-opts="--num-extra-lm-states=2000" \
+      --chain.lm-opts="$chain_lm_opts" \
       --egs.dir "$common_egs_dir" \
-      --egs.opts "--frames-overlap-per-eg 0" \
-      --egs.chunk-width 150 \
-      --trainer.num-chunk-per-minibatch 512 \
-      --trainer.frames-per-iter 1500000 \
+      --egs.opts "$egs_opts" \
+      --egs.chunk-width $chunk_width \
+      --trainer.num-chunk-per-minibatch $nnetMinibatchSize \
+      --trainer.frames-per-iter $nnetFramesPerIter \
       --trainer.num-epochs 4 \
       --trainer.optimization.proportional-shrink 20 \
-      --trainer.optimization.num-jobs-initial 1 \
-      --trainer.optimization.num-jobs-final 1 \
+      --trainer.optimization.num-jobs-initial $nnetJobsInitial \
+      --trainer.optimization.num-jobs-final $nnetJobsFinal \
       --trainer.optimization.initial-effective-lrate 0.001 \
       --trainer.optimization.final-effective-lrate 0.0001 \
       --trainer.max-param-change 2.0 \
-      --use-gpu wait \
-      --cleanup.remove-egs true \
+      --use-gpu $nnetUseGpu \
+      --cleanup.remove-egs $remove_egs \
       --feat-dir $train_data_dir \
       --tree-dir $tree_dir \
       --lat-dir $lat_dir \
       --dir $dir
 
-    echo
-    echo mkgraph
-    echo
+    if [ -n "$egs_key" ] && [ -z "$common_egs_dir" ] && [ -f $dir/final.mdl ]; then
+        $egsCacheCmd store --cache-dir $egsCacheDir --max-size-gb $egsCacheMaxGb \
+            --source "$PWD/$dir" $egs_key $dir/egs
+    fi
 
-    utils/mkgraph.sh --self-loop-scale 1.0 data/lang_test $dir $dir/graph
+    if $mkgraph; then
+        echo
+        echo mkgraph
+        echo
+
+        utils/mkgraph.sh --self-loop-scale 1.0 data/lang_test $dir $dir/graph
+    fi
 fi
 
-if [ $stage -le 12 ]; then
+if [ $stage -le 12 ] && [ $stop_stage -ge 12 ]; then
     echo
     echo decode
     echo
 
-    steps/nnet3/decode.sh --num-threads 1 --nj $nDecodeJobs --cmd "$decode_cmd" \
+    steps/nnet3/decode.sh --num-threads $nDecodeThreads --nj $nDecodeJobs --cmd "$decode_cmd" \
                           --acwt 1.0 --post-decode-acwt 10.0 \
                           --online-ivector-dir exp/nnet3${nnet3_affix}/ivectors_test_hires \
                           --scoring-opts "--min-lmwt 5 " \
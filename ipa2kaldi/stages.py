@@ -0,0 +1,892 @@
+"""Runs the steps of the Kaldi recipe (run.sh) as a graph of stages.
+
+Each stage has input files and the stages it depends on. A stage's
+fingerprint is a hash of its command, the contents of its inputs, and when
+its dependencies last finished. Stages whose fingerprint hasn't changed
+since their last successful run (and whose outputs still exist) are
+skipped, so changing only the language model re-runs only the stages that
+use it.
+
+Independent stages run at the same time, as long as their CPUs (nJobs for
+parallel Kaldi steps) fit within a budget. Fingerprints and timings are
+recorded in data/local/stages/state.json, with a log for each stage.
+
+Disk use of the recipe directory is sampled while stages run, and the peak
+is recorded for each stage. With --reclaim (or --disk-budget), intermediate
+files like speed-perturbed features, GMM alignments, and lattices are
+deleted once every stage that reads them has finished. GMM model dirs are
+packed into .tar.gz files instead. Re-running a stage that reads reclaimed
+files also re-runs the stage that made them. The inputs of dumped egs
+(lattices, hires features, i-vectors) are kept when cmd.sh has an egs cache
+(egsCacheDir), since re-making them would change the egs fingerprint.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+import typing
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .arpa import ArpaReader
+from .datadir import read_total_duration
+from .export import hash_file
+from .utils import maybe_gzip_open
+
+_LOGGER = logging.getLogger("ipa2kaldi.stages")
+
+_STATE_DIR = Path("data") / "local" / "stages"
+
+_GB = 1024 ** 3
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class Stage:
+    """A step of the recipe"""
+
+    name: str
+
+    # Shell command, run from the recipe directory
+    command: str
+
+    # Files/directories (or globs) whose contents are part of the fingerprint
+    inputs: typing.List[str] = field(default_factory=list)
+
+    # Files/directories removed before the stage is re-run
+    outputs: typing.List[str] = field(default_factory=list)
+
+    # Names of stages that must finish first
+    after: typing.List[str] = field(default_factory=list)
+
+    # True if stage uses nJobs CPUs (otherwise 1)
+    parallel: bool = False
+
+
+@dataclass
+class Intermediate:
+    """Files only needed until the stages that read them have finished"""
+
+    name: str
+
+    # Files/directories (or globs) to reclaim
+    paths: typing.List[str]
+
+    # Name of stage that writes the files
+    producer: str
+
+    # Names of stages that read the files
+    consumers: typing.List[str]
+
+    # Pack directories into .tar.gz instead of deleting them
+    compress: bool = False
+
+    # Read when dumping nnet3 egs (kept if there is an egs cache)
+    egs_input: bool = False
+
+
+def _run_sh(stage: int, *args: str, stop_stage: typing.Optional[int] = None) -> str:
+    stop_stage = stage if stop_stage is None else stop_stage
+    return " ".join(
+        ["./run.sh", "--stage", str(stage), "--stop-stage", str(stop_stage)]
+        + list(args)
+    )
+
+
+def _mkgraph(*args: str) -> str:
+    return " ".join([". ./path.sh", "&&", "utils/mkgraph.sh"] + list(args))
+
+
+_NNET3_DIR = "exp/nnet3_chain"
+_TDNN_DIR = f"{_NNET3_DIR}/tdnn_250"
+
+RECIPE_STAGES = [
+    Stage(
+        "lang",
+        _run_sh(0, stop_stage=1),
+        inputs=["data/local/dict"],
+        outputs=["data/lang", "data/local/lang"],
+    ),
+    Stage(
+        "lm",
+        _run_sh(2),
+        inputs=[
+            "lm/lm.arpa.gz",
+            "data/local/lm/lm_filtered.arpa.gz",
+            "data/local/lm/lm_filtered.vocab",
+        ],
+        outputs=["data/lang_test"],
+        after=["lang"],
+    ),
+    *[
+        Stage(
+            f"mfcc_{datadir}",
+            _run_sh(3, "--mfcc-datadirs", datadir, "--clean-exp", "false"),
+            inputs=[
+                f"data/{datadir}/{f}"
+                for f in ["wav.scp", "text", "utt2spk", "spk2utt", "utt2dur"]
+            ]
+            + ["conf/mfcc.conf"],
+            outputs=[f"exp/make_mfcc_chain/{datadir}"],
+            parallel=True,
+        )
+        for datadir in ["train", "test"]
+    ],
+    Stage(
+        "mono",
+        _run_sh(4),
+        inputs=["data/train_mono/utt2spk"],
+        outputs=["exp/mono0a_chain"],
+        after=["lang", "mfcc_train"],
+        parallel=True,
+    ),
+    Stage(
+        "tri1",
+        _run_sh(5),
+        inputs=["data/train_tri1/utt2spk"],
+        outputs=["exp/mono0a_ali_chain", "exp/tri1_chain"],
+        after=["mono"],
+        parallel=True,
+    ),
+    Stage(
+        "tri2b",
+        _run_sh(6, "--mkgraph", "false"),
+        outputs=["exp/tri1_ali_chain", "exp/tri2b_chain"],
+        after=["tri1"],
+        parallel=True,
+    ),
+    Stage(
+        "tri2b_graph",
+        _mkgraph("data/lang_test", "exp/tri2b_chain", "exp/tri2b_chain/graph"),
+        outputs=["exp/tri2b_chain/graph"],
+        after=["tri2b", "lm"],
+    ),
+    Stage(
+        "ivector",
+        _run_sh(7),
+        inputs=[
+            "conf/mfcc_hires.conf",
+            "data/train_sp_prerendered/wav.scp",
+            "data/train_sp_prerendered/utt2dur",
+        ],
+        outputs=[
+            "data/train_sp",
+            "data/train_sp_comb",
+            "data/train_sp_hires",
+            "data/train_sp_hires_comb",
+            "data/test_hires",
+            "exp/tri2b_chain_ali_train_sp_comb",
+            f"{_NNET3_DIR}/tri5",
+            f"{_NNET3_DIR}/diag_ubm",
+            f"{_NNET3_DIR}/extractor",
+            f"{_NNET3_DIR}/ivectors_train_sp_hires_comb",
+            f"{_NNET3_DIR}/ivectors_test_hires",
+        ],
+        after=["tri2b", "mfcc_train", "mfcc_test"],
+        parallel=True,
+    ),
+    Stage("lang_chain", _run_sh(8), outputs=["data/lang_chain"], after=["lang"]),
+    Stage(
+        "lats",
+        _run_sh(9),
+        outputs=[f"{_NNET3_DIR}/tri2b_chain_train_sp_comb_lats"],
+        after=["ivector", "lang"],
+        parallel=True,
+    ),
+    Stage(
+        "tree",
+        _run_sh(10),
+        outputs=[f"{_NNET3_DIR}/tree_sp"],
+        after=["lats", "lang_chain"],
+        parallel=True,
+    ),
+    Stage(
+        "tdnn",
+        _run_sh(11, "--mkgraph", "false"),
+        outputs=[_TDNN_DIR],
+        after=["tree", "ivector"],
+        parallel=True,
+    ),
+    Stage(
+        "tdnn_graph",
+        _mkgraph(
+            "--self-loop-scale",
+            "1.0",
+            "data/lang_test",
+            _TDNN_DIR,
+            f"{_TDNN_DIR}/graph",
+        ),
+        outputs=[f"{_TDNN_DIR}/graph"],
+        after=["tdnn", "lm"],
+    ),
+    Stage(
+        "decode",
+        _run_sh(12),
+        outputs=[f"{_TDNN_DIR}/decode_test"],
+        after=["tdnn_graph", "ivector", "mfcc_test"],
+        parallel=True,
+    ),
+]
+
+# Features from make_mfcc.sh are already compressed, so they are deleted
+RECIPE_INTERMEDIATES = [
+    Intermediate(
+        "train_mfcc",
+        ["mfcc_chain/raw_mfcc_train.*"],
+        "mfcc_train",
+        ["mono", "tri1", "tri2b", "ivector"],
+    ),
+    Intermediate("mono_model", ["exp/mono0a_chain"], "mono", ["tri1"], compress=True),
+    Intermediate("mono_ali", ["exp/mono0a_ali_chain/ali.*.gz"], "tri1", ["tri1"]),
+    Intermediate("tri1_model", ["exp/tri1_chain"], "tri1", ["tri2b"], compress=True),
+    Intermediate("tri1_ali", ["exp/tri1_ali_chain/ali.*.gz"], "tri2b", ["tri2b"]),
+    Intermediate(
+        "ivector_gmm",
+        [f"{_NNET3_DIR}/tri5", f"{_NNET3_DIR}/diag_ubm"],
+        "ivector",
+        ["ivector"],
+    ),
+    # Features of train_sp_comb are read from train_sp by concat-feats
+    Intermediate("train_sp_mfcc", ["data/train_sp/data"], "ivector", ["lats", "tree"]),
+    Intermediate(
+        "train_sp_ali",
+        ["exp/tri2b_chain_ali_train_sp_comb/ali.*.gz"],
+        "ivector",
+        ["tree"],
+    ),
+    Intermediate(
+        "train_sp_lats",
+        [f"{_NNET3_DIR}/tri2b_chain_train_sp_comb_lats/lat.*.gz"],
+        "lats",
+        ["tdnn"],
+        egs_input=True,
+    ),
+    Intermediate(
+        "train_sp_hires_mfcc",
+        ["data/train_sp_hires/data"],
+        "ivector",
+        ["tdnn"],
+        egs_input=True,
+    ),
+    Intermediate(
+        "train_ivectors",
+        [f"{_NNET3_DIR}/ivectors_train_sp_hires_comb/ivector_online.*.ark"],
+        "ivector",
+        ["tdnn"],
+        egs_input=True,
+    ),
+]
+
+# -----------------------------------------------------------------------------
+
+
+class StageRunner:
+    """Runs stages of a recipe in dependency order, skipping unchanged ones"""
+
+    def __init__(
+        self,
+        recipe_dir: Path,
+        stages: typing.Iterable[Stage] = RECIPE_STAGES,
+        max_cpus: typing.Optional[int] = None,
+        num_jobs: typing.Optional[int] = None,
+        intermediates: typing.Optional[typing.Iterable[Intermediate]] = None,
+        reclaim: bool = False,
+        disk_budget: typing.Optional[int] = None,
+        disk_interval: float = 30.0,
+        egs_cache: typing.Optional[bool] = None,
+    ):
+        self.recipe_dir = recipe_dir
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_cpus = max_cpus or os.cpu_count() or 1
+        self.num_jobs = num_jobs or read_num_jobs(recipe_dir / "cmd.sh")
+
+        # Delete/compress intermediates (always done with a disk budget)
+        self.intermediates = list(
+            RECIPE_INTERMEDIATES if intermediates is None else intermediates
+        )
+        self.reclaim = reclaim or (disk_budget is not None)
+
+        # Keep egs inputs so retraining can reuse cached egs
+        if egs_cache is None:
+            egs_cache = bool(read_cmd_var(recipe_dir / "cmd.sh", "egsCacheDir"))
+
+        self.egs_cache = egs_cache
+        if self.reclaim and self.egs_cache:
+            _LOGGER.info(
+                "Not reclaiming %s (egs cache is enabled)",
+                ", ".join(i.name for i in self.intermediates if i.egs_input),
+            )
+
+        # Bytes of recipe dir; no new stages start while over budget
+        self.disk_budget = disk_budget
+
+        # Seconds between disk use samples (0 for only before/after stages)
+        self.disk_interval = disk_interval
+
+        self.state_dir = recipe_dir / _STATE_DIR
+        self.state_path = self.state_dir / "state.json"
+
+        # Corpus size when stages ran (for ipa2kaldi plan)
+        self.recipe_stats = get_recipe_stats(recipe_dir)
+
+        # name -> {fingerprint, finished, seconds, cpus, stats, disk_peak,
+        #          disk_after, reclaimed}
+        self.state: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        if self.state_path.is_file():
+            with open(self.state_path, "r") as state_file:
+                self.state = json.load(state_file)
+
+        for stage in self.stages.values():
+            for dep_name in stage.after:
+                assert (
+                    dep_name in self.stages
+                ), f"Unknown stage {dep_name} (in {stage.name})"
+
+        for intermediate in self.intermediates:
+            for stage_name in [intermediate.producer] + intermediate.consumers:
+                assert (
+                    stage_name in self.stages
+                ), f"Unknown stage {stage_name} (in {intermediate.name})"
+
+    def get_cpus(self, stage: Stage) -> int:
+        """Number of CPUs a stage uses (at most the budget)"""
+        return min(self.num_jobs if stage.parallel else 1, self.max_cpus)
+
+    def needed_stages(
+        self, targets: typing.Optional[typing.Iterable[str]] = None
+    ) -> typing.List[str]:
+        """Get targets and all of their dependencies in dependency order"""
+        ordered: typing.List[str] = []
+        visiting: typing.Set[str] = set()
+
+        def visit(name: str):
+            if name in ordered:
+                return
+
+            assert name in self.stages, f"Unknown stage: {name}"
+            assert name not in visiting, f"Dependency cycle at stage {name}"
+            visiting.add(name)
+            for dep_name in self.stages[name].after:
+                visit(dep_name)
+
+            visiting.remove(name)
+            ordered.append(name)
+
+        for name in targets or self.stages.keys():
+            visit(name)
+
+        return ordered
+
+    def fingerprint(self, stage: Stage) -> str:
+        """Hash of command, input contents, and when dependencies finished"""
+        hasher = hashlib.sha256()
+        hasher.update(stage.command.encode())
+
+        for input_str in stage.inputs:
+            for input_path in _expand_input(self.recipe_dir, input_str):
+                hasher.update(str(input_path.relative_to(self.recipe_dir)).encode())
+                hasher.update(hash_file(input_path)[1].encode())
+
+        for dep_name in stage.after:
+            hasher.update(dep_name.encode())
+            hasher.update(str(self.state.get(dep_name, {}).get("finished")).encode())
+
+        return hasher.hexdigest()
+
+    def is_up_to_date(self, stage: Stage, fingerprint: str) -> bool:
+        """True if stage last ran with the same fingerprint and outputs exist"""
+        stage_state = self.state.get(stage.name)
+        if (not stage_state) or (stage_state.get("fingerprint") != fingerprint):
+            return False
+
+        # Outputs may have been reclaimed after the stages that read them ran
+        reclaimed_paths = set(
+            path
+            for reclaimed in stage_state.get("reclaimed", {}).values()
+            for path in reclaimed["paths"]
+        )
+
+        return all(
+            (self.recipe_dir / p).exists() or (p in reclaimed_paths)
+            for p in stage.outputs
+        )
+
+    def stale_stages(
+        self, names: typing.Iterable[str], force: typing.Iterable[str] = ()
+    ) -> typing.Set[str]:
+        """Get stages that need to run.
+
+        A stage needs to run if it's forced, out of date, depends on a stage
+        that needs to run, or made reclaimed files that a stage which needs
+        to run reads.
+        """
+        names = list(names)
+        force = set(force)
+        fingerprints = {name: self.fingerprint(self.stages[name]) for name in names}
+        stale: typing.Set[str] = set()
+
+        changed = True
+        while changed:
+            changed = False
+            for name in names:
+                if name in stale:
+                    continue
+
+                stage = self.stages[name]
+                reclaimed = self.state.get(name, {}).get("reclaimed", {})
+                if (
+                    (name in force)
+                    or any(dep_name in stale for dep_name in stage.after)
+                    or (not self.is_up_to_date(stage, fingerprints[name]))
+                    or any(
+                        (intermediate.name in reclaimed)
+                        and any(c in stale for c in intermediate.consumers)
+                        for intermediate in self.intermediates
+                        if intermediate.producer == name
+                    )
+                ):
+                    stale.add(name)
+                    changed = True
+
+        return stale
+
+    def reclaim_intermediates(self, blocked: typing.Collection[str] = ()) -> int:
+        """Reclaim intermediates whose consumers have all finished.
+
+        Consumers in blocked (running, waiting, or failed) have not finished.
+        Returns the number of bytes freed.
+        """
+        freed_bytes = 0
+        for intermediate in self.intermediates:
+            producer_state = self.state.get(intermediate.producer)
+            if (
+                (not producer_state)
+                or (intermediate.name in producer_state.get("reclaimed", {}))
+                or (intermediate.egs_input and self.egs_cache)
+            ):
+                continue
+
+            if any(
+                (c in blocked)
+                or (
+                    self.state.get(c, {}).get("finished", 0)
+                    < producer_state["finished"]
+                )
+                for c in intermediate.consumers
+            ):
+                continue
+
+            paths: typing.List[str] = []
+            intermediate_bytes = 0
+            for path_str in intermediate.paths:
+                for path in sorted(self.recipe_dir.glob(path_str)):
+                    paths.append(str(path.relative_to(self.recipe_dir)))
+                    intermediate_bytes += _reclaim_path(path, intermediate.compress)
+
+            producer_state.setdefault("reclaimed", {})[intermediate.name] = {
+                "paths": paths,
+                "bytes": intermediate_bytes,
+            }
+            self._save_state()
+
+            _LOGGER.info(
+                "%s: %s %s (%0.2f GB)",
+                intermediate.producer,
+                "compressed" if intermediate.compress else "reclaimed",
+                intermediate.name,
+                intermediate_bytes / _GB,
+            )
+            freed_bytes += intermediate_bytes
+
+        return freed_bytes
+
+    def get_disk_usage(self) -> int:
+        """Bytes used by the recipe directory"""
+        return get_disk_usage(self.recipe_dir)
+
+    def run(
+        self,
+        targets: typing.Optional[typing.Iterable[str]] = None,
+        force: typing.Iterable[str] = (),
+        dry_run: bool = False,
+    ) -> bool:
+        """Run stages needed for targets (default: all). Returns True on success."""
+        todo = self.needed_stages(targets)
+        stale = self.stale_stages(todo, force)
+        done: typing.Set[str] = set()
+        failed: typing.Set[str] = set()
+        running: typing.Dict[Future, typing.Tuple[str, int]] = {}
+        used_cpus = 0
+
+        # Peak bytes of recipe dir while each stage was running
+        disk_peaks: typing.Dict[str, int] = {}
+        disk_usage = self.get_disk_usage()
+        over_budget = False
+
+        # Only look for stages to start when something has finished
+        check_todo = True
+
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=max(1, len(todo))) as executor:
+            while todo or running:
+                if check_todo and self.reclaim and (not dry_run):
+                    disk_usage -= self.reclaim_intermediates(
+                        blocked=set(todo)
+                        | set(name for name, _ in running.values())
+                        | failed
+                    )
+
+                # Start ready stages that fit in the CPU budget
+                for name in list(todo) if check_todo else []:
+                    stage = self.stages[name]
+                    if any(d in failed for d in stage.after):
+                        todo.remove(name)
+                        failed.add(name)
+                        continue
+
+                    if (failed and not dry_run) or any(
+                        d not in done for d in stage.after
+                    ):
+                        continue
+
+                    if name not in stale:
+                        _LOGGER.info("%s: up to date", name)
+                        todo.remove(name)
+                        done.add(name)
+                        continue
+
+                    cpus = self.get_cpus(stage)
+                    if running and ((used_cpus + cpus) > self.max_cpus):
+                        continue
+
+                    if (
+                        running
+                        and (self.disk_budget is not None)
+                        and (disk_usage > self.disk_budget)
+                    ):
+                        # Wait for running stages to finish and be reclaimed
+                        continue
+
+                    todo.remove(name)
+                    if dry_run:
+                        _LOGGER.info("%s: would run %s", name, stage.command)
+                        done.add(name)
+                        continue
+
+                    _LOGGER.info("%s: running (%s CPU(s))", name, cpus)
+                    running[executor.submit(self._run_stage, stage)] = (name, cpus)
+                    used_cpus += cpus
+                    disk_peaks[name] = disk_usage
+
+                check_todo = False
+
+                if not running:
+                    if todo and not (failed and not dry_run):
+                        # Nothing can run (should not happen)
+                        _LOGGER.error("Can't run stage(s): %s", todo)
+                        return False
+
+                    break
+
+                finished, _ = wait(
+                    running.keys(),
+                    timeout=self.disk_interval or None,
+                    return_when=FIRST_COMPLETED,
+                )
+
+                # Sample disk use (also when stages finish)
+                disk_usage = self.get_disk_usage()
+                for name, _ in running.values():
+                    disk_peaks[name] = max(disk_peaks[name], disk_usage)
+
+                if self.disk_budget is not None:
+                    if (disk_usage > self.disk_budget) and (not over_budget):
+                        _LOGGER.warning(
+                            "Recipe uses %0.1f GB, over disk budget of %0.1f GB",
+                            disk_usage / _GB,
+                            self.disk_budget / _GB,
+                        )
+
+                    over_budget = disk_usage > self.disk_budget
+
+                for future in finished:
+                    check_todo = True
+                    name, cpus = running.pop(future)
+                    used_cpus -= cpus
+                    seconds = future.result()
+
+                    if seconds is None:
+                        _LOGGER.error(
+                            "%s: failed (see %s)", name, self.state_dir / f"{name}.log"
+                        )
+                        failed.add(name)
+                        continue
+
+                    _LOGGER.info(
+                        "%s: finished in %0.1f second(s), peak disk use %0.2f GB",
+                        name,
+                        seconds,
+                        disk_peaks[name] / _GB,
+                    )
+
+                    # Record fingerprint of inputs as they are now, in case the
+                    # stage changed them (e.g., fix_data_dir.sh)
+                    self.state[name] = {
+                        "fingerprint": self.fingerprint(self.stages[name]),
+                        "finished": time.time(),
+                        "seconds": seconds,
+                        "cpus": cpus,
+                        "stats": self.recipe_stats,
+                        "disk_peak": disk_peaks[name],
+                        "disk_after": disk_usage,
+                    }
+                    done.add(name)
+                    self._save_state()
+
+        if self.reclaim and (not dry_run):
+            self.reclaim_intermediates(blocked=failed)
+
+        return not failed
+
+    def _run_stage(self, stage: Stage) -> typing.Optional[float]:
+        """Run stage command, returning elapsed seconds (None on failure)"""
+        for output_str in stage.outputs:
+            output_path = self.recipe_dir / output_str
+            if output_path.is_dir() and (not output_path.is_symlink()):
+                shutil.rmtree(output_path)
+            elif output_path.exists() or output_path.is_symlink():
+                output_path.unlink()
+
+        log_path = self.state_dir / f"{stage.name}.log"
+        start_time = time.perf_counter()
+
+        with open(log_path, "w") as log_file:
+            result = subprocess.run(
+                ["bash", "-c", stage.command],
+                cwd=self.recipe_dir,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                check=False,
+            )
+
+        if result.returncode != 0:
+            return None
+
+        return time.perf_counter() - start_time
+
+    def _save_state(self):
+        state_tmp_path = self.state_path.with_suffix(".tmp")
+        with open(state_tmp_path, "w") as state_file:
+            json.dump(self.state, state_file, indent=4)
+
+        os.replace(state_tmp_path, self.state_path)
+
+
+def read_num_jobs(cmd_path: Path) -> int:
+    """Get nJobs from cmd.sh (1 if missing)"""
+    if cmd_path.is_file():
+        match = re.search(
+            r"^export nJobs=(\d+)", cmd_path.read_text(), flags=re.MULTILINE
+        )
+        if match:
+            return int(match.group(1))
+
+    return 1
+
+
+def read_cmd_var(cmd_path: Path, name: str) -> typing.Optional[str]:
+    """Get value of an exported variable from cmd.sh (None if missing)"""
+    if cmd_path.is_file():
+        match = re.search(
+            rf"^export {re.escape(name)}=(.*)$",
+            cmd_path.read_text(),
+            flags=re.MULTILINE,
+        )
+        if match:
+            values = shlex.split(match.group(1), comments=True)
+            return values[0] if values else ""
+
+    return None
+
+
+def get_recipe_stats(recipe_dir: Path) -> typing.Dict[str, float]:
+    """Get hours of train/test audio and number of LM n-grams (if known)"""
+    stats: typing.Dict[str, float] = {}
+    for data_name in ["train", "test"]:
+        total_sec = read_total_duration(recipe_dir / "data" / data_name)
+        if total_sec is not None:
+            stats[f"{data_name}_hours"] = total_sec / (60 * 60)
+
+    for lm_path in [
+        recipe_dir / "data" / "local" / "lm" / "lm_filtered.arpa.gz",
+        recipe_dir / "lm" / "lm.arpa.gz",
+    ]:
+        if lm_path.is_file():
+            with maybe_gzip_open(lm_path, "r") as lm_file:
+                stats["lm_ngrams"] = sum(ArpaReader(lm_file).counts)
+
+            break
+
+    return stats
+
+
+def _expand_input(recipe_dir: Path, input_str: str) -> typing.List[Path]:
+    """Get files for an input (missing files are skipped)"""
+    input_paths = sorted(recipe_dir.glob(input_str))
+    files: typing.List[Path] = []
+    for input_path in input_paths:
+        if input_path.is_dir():
+            files.extend(sorted(p for p in input_path.rglob("*") if p.is_file()))
+        elif input_path.is_file():
+            files.append(input_path)
+
+    return files
+
+
+def get_disk_usage(dir_path: Path) -> int:
+    """Bytes allocated for files in a directory (symlinks aren't followed)"""
+    total_bytes = 0
+    dirs_todo = [str(dir_path)]
+    while dirs_todo:
+        try:
+            with os.scandir(dirs_todo.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs_todo.append(entry.path)
+                        else:
+                            total_bytes += (
+                                entry.stat(follow_symlinks=False).st_blocks * 512
+                            )
+                    except OSError:
+                        # Deleted while walking
+                        pass
+        except OSError:
+            pass
+
+    return total_bytes
+
+
+def _reclaim_path(path: Path, compress: bool) -> int:
+    """Delete a file/directory (or pack a directory), returning bytes freed"""
+    if path.is_symlink() or (not path.is_dir()):
+        freed_bytes = path.lstat().st_blocks * 512
+        path.unlink()
+        return freed_bytes
+
+    freed_bytes = get_disk_usage(path)
+    if compress:
+        tar_path = path.with_name(path.name + ".tar.gz")
+        with tarfile.open(tar_path, "w:gz") as tar_file:
+            tar_file.add(str(path), arcname=path.name)
+
+        freed_bytes -= tar_path.stat().st_blocks * 512
+
+    shutil.rmtree(path)
+
+    return freed_bytes
+
+
+# -----------------------------------------------------------------------------
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    """Entry point for ipa2kaldi run"""
+    parser = argparse.ArgumentParser(prog="ipa2kaldi run")
+    parser.add_argument("--recipe-dir", required=True, help="Path to Kaldi recipe dir")
+    parser.add_argument(
+        "--until",
+        action="append",
+        help="Only run these stages and what they depend on (default: all)",
+    )
+    parser.add_argument(
+        "--force",
+        action="append",
+        default=[],
+        help="Re-run stage even if it's up to date",
+    )
+    parser.add_argument(
+        "--cpus", type=int, help="CPU budget for stages running at once (default: all)"
+    )
+    parser.add_argument(
+        "--reclaim",
+        action="store_true",
+        help="Delete/compress intermediate files once the stages that read them have finished (lattices, hires features, and i-vectors are kept when cmd.sh has an egsCacheDir, since re-making them for retraining would miss the egs cache)",
+    )
+    parser.add_argument(
+        "--disk-budget",
+        type=float,
+        help="Don't start more stages while the recipe uses more GB than this (implies --reclaim)",
+    )
+    parser.add_argument(
+        "--disk-interval",
+        type=float,
+        default=30,
+        help="Seconds between samples of disk use (default: 30, 0 for only when stages finish)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Print stages that would run"
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="List stages with their last timings"
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="Print DEBUG messages to console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    runner = StageRunner(
+        Path(args.recipe_dir),
+        max_cpus=args.cpus,
+        reclaim=args.reclaim,
+        disk_budget=(
+            int(args.disk_budget * _GB) if args.disk_budget is not None else None
+        ),
+        disk_interval=args.disk_interval,
+    )
+
+    if args.list:
+        for name in runner.needed_stages(args.until):
+            stage = runner.stages[name]
+            stage_state = runner.state.get(name, {})
+            seconds = stage_state.get("seconds")
+            disk_peak = stage_state.get("disk_peak")
+            reclaimed_bytes = sum(
+                r["bytes"] for r in stage_state.get("reclaimed", {}).values()
+            )
+            print(
+                name,
+                f"{seconds:0.1f}s" if seconds is not None else "-",
+                f"{disk_peak / _GB:0.2f}GB" if disk_peak is not None else "-",
+                f"{reclaimed_bytes / _GB:0.2f}GB" if reclaimed_bytes else "-",
+                ",".join(stage.after) or "-",
+                sep="\t",
+            )
+
+        return
+
+    if not runner.run(args.until, force=args.force, dry_run=args.dry_run):
+        sys.exit(1)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
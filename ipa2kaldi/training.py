@@ -0,0 +1,143 @@
+"""Settings for nnet3 chain training and decoding based on the build host"""
+import logging
+import os
+import re
+import shutil
+import subprocess
+import typing
+from dataclasses import dataclass
+from pathlib import Path
+
+_LOGGER = logging.getLogger("ipa2kaldi.training")
+
+_GB = 1024 ** 3
+
+# Memory of one CPU nnet3-chain-train job for tdnn_250 (with minibatch 128)
+_CPU_JOB_MEMORY = 2 * _GB
+
+# Shorter iterations on CPU keep model averaging between jobs frequent
+_CPU_FRAMES_PER_ITER = 400000
+
+# 10ms frames in an hour of audio, times 3 for speed perturbation
+_FRAMES_PER_TRAIN_HOUR = 100 * 60 * 60 * 3
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class TrainingProfile:
+    """Options for steps/nnet3/chain/train.py and steps/nnet3/decode.sh"""
+
+    # --use-gpu (wait, false)
+    use_gpu: str = "wait"
+    num_jobs_initial: int = 1
+    num_jobs_final: int = 1
+    minibatch_size: int = 512
+    frames_per_iter: int = 1500000
+    decode_threads: int = 1
+
+    def to_cmd_vars(self) -> typing.Dict[str, str]:
+        """Get variables for cmd.sh"""
+        return {
+            "nnetUseGpu": self.use_gpu,
+            "nnetJobsInitial": str(self.num_jobs_initial),
+            "nnetJobsFinal": str(self.num_jobs_final),
+            "nnetMinibatchSize": str(self.minibatch_size),
+            "nnetFramesPerIter": str(self.frames_per_iter),
+            "nDecodeThreads": str(self.decode_threads),
+        }
+
+
+def has_gpu(kaldi_dir: typing.Optional[Path] = None) -> bool:
+    """True if an NVIDIA GPU is visible (and Kaldi was compiled with CUDA)"""
+    if shutil.which("nvidia-smi") is None:
+        return False
+
+    try:
+        gpu_list = subprocess.check_output(
+            ["nvidia-smi", "-L"], stderr=subprocess.DEVNULL, universal_newlines=True
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return False
+
+    if "GPU" not in gpu_list:
+        return False
+
+    _LOGGER.debug(gpu_list.strip())
+
+    if kaldi_dir is not None:
+        cuda_compiled = kaldi_dir / "src" / "bin" / "cuda-compiled"
+        if cuda_compiled.is_file():
+            # Exits with 0 only if Kaldi has CUDA
+            return subprocess.call([str(cuda_compiled)]) == 0
+
+    return True
+
+
+def get_memory_bytes() -> typing.Optional[int]:
+    """Get physical memory of this machine (None if unknown)"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_training_profile(
+    use_gpu: bool,
+    cpus: typing.Optional[int] = None,
+    memory_bytes: typing.Optional[int] = None,
+    train_hours: typing.Optional[float] = None,
+    num_decode_jobs: int = 1,
+) -> TrainingProfile:
+    """Choose training/decoding options for a machine.
+
+    GPU training keeps the recipe's settings. CPU training runs one job per
+    core (limited by memory and the number of egs archives) with minibatches
+    of 128 chunks, as described in Kaldi's run_tdnn.sh.
+    """
+    cpus = cpus or os.cpu_count() or 1
+    decode_threads = max(1, cpus // max(1, num_decode_jobs))
+
+    if use_gpu:
+        return TrainingProfile(decode_threads=decode_threads)
+
+    num_jobs = cpus
+    if memory_bytes is not None:
+        num_jobs = min(num_jobs, max(1, memory_bytes // _CPU_JOB_MEMORY))
+
+    if train_hours is not None:
+        # train.py fails if there are more final jobs than egs archives
+        num_archives = int(train_hours * _FRAMES_PER_TRAIN_HOUR) // (
+            _CPU_FRAMES_PER_ITER
+        )
+        num_jobs = min(num_jobs, max(1, num_archives))
+
+    return TrainingProfile(
+        use_gpu="false",
+        num_jobs_initial=max(1, num_jobs // 4),
+        num_jobs_final=num_jobs,
+        minibatch_size=128,
+        frames_per_iter=_CPU_FRAMES_PER_ITER,
+        decode_threads=decode_threads,
+    )
+
+
+def set_cmd_vars(cmd_path: Path, cmd_vars: typing.Mapping[str, str]):
+    """Set exported variables in cmd.sh, appending missing ones"""
+    cmd_text = cmd_path.read_text()
+    for name, value in cmd_vars.items():
+        export_line = f"export {name}={value}"
+        cmd_text, num_replaced = re.subn(
+            rf"^export {re.escape(name)}=.*$",
+            export_line,
+            cmd_text,
+            flags=re.MULTILINE,
+        )
+
+        if num_replaced == 0:
+            if not cmd_text.endswith("\n"):
+                cmd_text += "\n"
+
+            cmd_text += export_line + "\n"
+
+    cmd_path.write_text(cmd_text)
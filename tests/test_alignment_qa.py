@@ -0,0 +1,66 @@
+"""Tests for ipa2kaldi.alignment_qa"""
+import numpy as np
+
+from ipa2kaldi.alignment_qa import get_phone_durations, read_phone_ctm, score_alignments
+from ipa2kaldi.alignments import read_phones_file
+
+
+def _write_alignments(tmp_path, num_utts=20, squeezed_utt=None):
+    """Write a phones file and matching phone CTM (10 frames per phone)"""
+    with open(tmp_path / "phones", "w") as phones_file, open(
+        tmp_path / "phone_ctm", "w"
+    ) as ctm_file:
+        for utt_index in range(num_utts):
+            utt_id = f"utt{utt_index:03d}"
+            start_frame = 0
+            for word_index in range(5):
+                phones = ["s_B", "t_I", "o_I", "p_E"]
+                num_frames = 2 if (utt_index, word_index) == squeezed_utt else 40
+                print(
+                    utt_id,
+                    start_frame,
+                    num_frames,
+                    f"word{word_index}",
+                    *phones,
+                    file=phones_file,
+                )
+
+                for phone_index, phone in enumerate(phones):
+                    phone_frames = num_frames // len(phones)
+                    if phone_index == 0:
+                        # Real durations aren't equal shares
+                        phone_frames += num_frames % len(phones)
+
+                    print(
+                        utt_id,
+                        1,
+                        f"{start_frame * 0.01:.2f}",
+                        f"{phone_frames * 0.01:.2f}",
+                        phone,
+                        file=ctm_file,
+                    )
+                    start_frame += phone_frames
+
+    return read_phones_file(tmp_path / "phones")
+
+
+def test_ctm_durations(tmp_path):
+    """Phone durations come from the CTM, not equal shares of words"""
+    alignments = _write_alignments(tmp_path, num_utts=1, squeezed_utt=(0, 1))
+    utt_phones = read_phone_ctm(tmp_path / "phone_ctm")
+
+    _, _, durations, _ = get_phone_durations(alignments, utt_phones=utt_phones)
+    assert np.allclose(durations[4:8], [0.02, 0.0, 0.0, 0.0])
+
+    _, _, durations, _ = get_phone_durations(alignments)
+    assert np.allclose(durations[4:8], [0.005] * 4)
+
+
+def test_squeezed_word_excluded(tmp_path):
+    """Default thresholds catch a 4 phone word squeezed into 2 frames"""
+    alignments = _write_alignments(tmp_path, squeezed_utt=(7, 2))
+
+    _, utt_scores = score_alignments(alignments)
+    assert utt_scores.utt_ids[7] == "utt007"
+    assert np.flatnonzero(utt_scores.excluded).tolist() == [7]
+    assert utt_scores.reasons(7) == ["short_phone", "outlier_phones"]
@@ -0,0 +1,112 @@
+"""Tests for ipa2kaldi.arpa"""
+import gzip
+import math
+import typing
+from pathlib import Path
+
+from ipa2kaldi.arpa import BOS, EOS, ArpaReader, BackoffModel, filter_arpa
+from ipa2kaldi.lm import build_lm
+
+_TEXT = """the cat sat on the mat
+the dog sat on the cat
+a cat and a dog
+the mat is on the dog
+a dog sat
+the cat is a cat
+"""
+
+
+def _load(arpa_path: Path) -> BackoffModel:
+    model = BackoffModel()
+    with gzip.open(arpa_path, "rt") as arpa_file:
+        for order, log_prob, ngram, bow in ArpaReader(arpa_file).ngrams():
+            model.add(order, log_prob, ngram, bow or 0.0)
+
+    return model
+
+
+def _context_totals(model: BackoffModel):
+    """Yield (context, sum of p(w|context)) for every usable context"""
+    words = [w for w in model.orders[0] if w != BOS]
+    no_context: typing.List[str] = []
+    contexts = [no_context] + [
+        ngram.split(" ")
+        for ngrams in model.orders[:-1]
+        for ngram in ngrams
+        if not ngram.endswith(EOS)
+    ]
+
+    for context in contexts:
+        yield context, sum(10 ** model.log_prob(context + [w]) for w in words)
+
+
+def test_filter_renormalizes(tmp_path):
+    """Every context still sums to 1 after dropping words"""
+    text_path = tmp_path / "text.txt"
+    text_path.write_text(_TEXT)
+
+    src_path = tmp_path / "lm.arpa.gz"
+    build_lm(src_path, text_paths=[text_path], order=3, unknown_word=None)
+
+    for _, total in _context_totals(_load(src_path)):
+        assert math.isclose(total, 1.0, abs_tol=1e-4)
+
+    dest_path = tmp_path / "filtered.arpa.gz"
+    vocabulary = {BOS, EOS, "the", "a", "cat", "sat", "on", "mat"}
+    counts = filter_arpa(src_path, dest_path, vocabulary)
+
+    model = _load(dest_path)
+    assert counts == [len(ngrams) for ngrams in model.orders]
+    assert set(model.orders[0]) == vocabulary
+
+    for ngrams in model.orders:
+        for ngram in ngrams:
+            assert set(ngram.split(" ")) <= vocabulary
+
+    for context, total in _context_totals(model):
+        assert math.isclose(total, 1.0, abs_tol=1e-4), context
+
+
+def test_filter_degenerate(tmp_path):
+    """Degenerate n-grams are dropped, n-grams without a suffix are kept"""
+    src_path = tmp_path / "lm.arpa.gz"
+    with gzip.open(src_path, "wt") as arpa_file:
+        print(
+            "",
+            "\\data\\",
+            "ngram 1=4",
+            "ngram 2=4",
+            "ngram 3=1",
+            "",
+            "\\1-grams:",
+            "-99\t<s>\t-0.3",
+            "-0.5\t</s>",
+            "-0.4\ta\t-0.2",
+            "-0.6\tb\t-0.1",
+            "",
+            "\\2-grams:",
+            "-0.2\t<s> a\t-0.1",
+            "-0.3\ta </s>",
+            "-1.0\t</s> <s>",
+            "-0.5\t<s> <s>",
+            "",
+            "\\3-grams:",
+            "-0.1\t<s> a b",
+            "",
+            "\\end\\",
+            sep="\n",
+            file=arpa_file,
+        )
+
+    dest_path = tmp_path / "filtered.arpa.gz"
+    counts = filter_arpa(src_path, dest_path, {BOS, EOS, "a", "b"})
+    assert counts == [4, 2, 1]
+
+    model = _load(dest_path)
+    assert set(model.orders[1]) == {"<s> a", "a </s>"}
+
+    # "a b" isn't in the model, but "<s> a b" still has its history
+    assert set(model.orders[2]) == {"<s> a b"}
+
+    for context, total in _context_totals(model):
+        assert math.isclose(total, 1.0, abs_tol=1e-4), context
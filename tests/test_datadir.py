@@ -0,0 +1,156 @@
+"""Tests for ipa2kaldi.datadir"""
+import random
+
+import pytest
+
+from ipa2kaldi.datadir import (
+    VALIDATED_NAME,
+    get_num_frames,
+    read_scp,
+    select_shortest,
+    select_speaker_hours,
+    validate_data_dir,
+    write_durations,
+    write_subset,
+)
+
+
+def _write_data_dir(data_dir, **files):
+    """Write a data dir with two speakers (file name -> lines)"""
+    files = {
+        "utt2spk": ["s1-a s1", "s1-b s1", "s2-a s2"],
+        "spk2utt": ["s1 s1-a s1-b", "s2 s2-a"],
+        "text": ["s1-a hello", "s1-b world", "s2-a hello world"],
+        "wav.scp": ["s1-a a.wav", "s1-b b.wav", "s2-a c.wav"],
+        **files,
+    }
+
+    data_dir.mkdir(parents=True, exist_ok=True)
+    for file_name, lines in files.items():
+        (data_dir / file_name).write_text("".join(f"{line}\n" for line in lines))
+
+
+def test_num_frames_exact():
+    """Frame counts match Kaldi's integer formula for every sample count"""
+    for num_samples in range(0, 16000 * 30, 16):
+        expected = 0
+        if num_samples >= 400:
+            expected = 1 + ((num_samples - 400) // 160)
+
+        assert get_num_frames(num_samples / 16000, 0.01) == expected, num_samples
+
+    assert get_num_frames(16.025, 0.01) == 1601
+    assert get_num_frames(0.024, 0.01) == 0
+    assert get_num_frames(0.025, 0.01) == 1
+
+
+def test_write_durations(tmp_path):
+    """utt2dur, reco2dur, and utt2num_frames are sorted and consistent"""
+    write_durations(tmp_path, {"b": 16.025, "a": 1.0, "c": 0.01}, frame_shift=0.01)
+
+    assert list(read_scp(tmp_path / "utt2dur").items()) == [
+        ("a", "1.000"),
+        ("b", "16.025"),
+        ("c", "0.010"),
+    ]
+    assert read_scp(tmp_path / "reco2dur") == read_scp(tmp_path / "utt2dur")
+    assert read_scp(tmp_path / "utt2num_frames") == {"a": "98", "b": "1601", "c": "0"}
+
+
+def test_write_durations_no_frames(tmp_path):
+    """utt2num_frames is only written with a frame shift"""
+    write_durations(tmp_path, {"a": 1.0})
+    assert not (tmp_path / "utt2num_frames").exists()
+
+
+def test_validate_data_dir(tmp_path):
+    """A consistent data dir has no problems"""
+    _write_data_dir(tmp_path)
+    assert validate_data_dir(tmp_path) == []
+
+
+def test_validate_data_dir_problems(tmp_path):
+    """Order, duplicate, and mismatched keys are reported"""
+    _write_data_dir(
+        tmp_path / "unsorted", text=["s1-b world", "s1-a hello", "s2-a hello world"]
+    )
+    assert validate_data_dir(tmp_path / "unsorted") == ["text:2: s1-a is out of order"]
+
+    _write_data_dir(
+        tmp_path / "duplicate", **{"wav.scp": ["s1-a a.wav", "s1-a a.wav", "s2-a c"]}
+    )
+    assert validate_data_dir(tmp_path / "duplicate") == [
+        "wav.scp:2: s1-a is duplicated",
+        "wav.scp: 1 missing and 0 extra key(s), e.g. s1-b",
+    ]
+
+    _write_data_dir(tmp_path / "missing", text=["s1-a hello", "s2-a hello world"])
+    assert validate_data_dir(tmp_path / "missing") == [
+        "text: 1 missing and 0 extra key(s), e.g. s1-b"
+    ]
+
+    _write_data_dir(tmp_path / "spk2utt", spk2utt=["s1 s1-a", "s2 s1-b s2-a"])
+    assert validate_data_dir(tmp_path / "spk2utt") == ["spk2utt doesn't match utt2spk"]
+
+    _write_data_dir(tmp_path / "no_spk2utt")
+    (tmp_path / "no_spk2utt" / "spk2utt").unlink()
+    assert validate_data_dir(tmp_path / "no_spk2utt") == ["Missing utt2spk or spk2utt"]
+
+
+def test_select_shortest():
+    """Shortest utterances are returned in sorted order (ties by id)"""
+    utt_durations = {"d": 1.0, "a": 3.0, "c": 2.0, "b": 1.0}
+    assert select_shortest(utt_durations, 3) == ["b", "c", "d"]
+    assert select_shortest(utt_durations, 10) == ["a", "b", "c", "d"]
+
+
+def test_select_speaker_hours():
+    """Every speaker contributes in proportion to their audio"""
+    utt_speakers = {f"s{s}-{u:02d}": f"s{s}" for s in range(3) for u in range(40)}
+    utt_durations = {
+        utt_id: (10.0 if speaker == "s0" else 1.0)
+        for utt_id, speaker in utt_speakers.items()
+    }
+    utt_durations["s2-00"] = 100.0
+
+    selected = select_speaker_hours(
+        utt_speakers, utt_durations, 0.05, max_utt_sec=30, rng=random.Random(0)
+    )
+    assert selected == sorted(selected)
+    assert "s2-00" not in selected
+
+    # 3 minutes of 7 minutes 59 seconds (without s2-00)
+    speaker_sec = {
+        speaker: sum(utt_durations[u] for u in selected if u.startswith(speaker))
+        for speaker in ["s0", "s1", "s2"]
+    }
+    assert speaker_sec == {"s0": 150.0, "s1": 15.0, "s2": 14.0}
+
+    assert select_speaker_hours(utt_speakers, utt_durations, 100) == sorted(
+        utt_speakers
+    )
+    assert select_speaker_hours(utt_speakers, {}, 1) == []
+
+
+def test_write_subset(tmp_path):
+    """Subset has only the selected utterances and a matching spk2utt"""
+    _write_data_dir(tmp_path / "train")
+    write_subset(tmp_path / "train", tmp_path / "subset", ["s1-b", "s2-a"])
+
+    assert read_scp(tmp_path / "subset" / "text") == {
+        "s1-b": "world",
+        "s2-a": "hello world",
+    }
+    assert read_scp(tmp_path / "subset" / "spk2utt") == {"s1": "s1-b", "s2": "s2-a"}
+    assert (tmp_path / "subset" / VALIDATED_NAME).is_file()
+
+
+def test_write_subset_invalid(tmp_path):
+    """An invalid subset raises ValueError instead of being marked valid"""
+    _write_data_dir(
+        tmp_path / "train", text=["s1-b world", "s1-a hello", "s2-a hello world"]
+    )
+    with pytest.raises(ValueError, match="out of order"):
+        write_subset(tmp_path / "train", tmp_path / "subset", ["s1-a", "s1-b"])
+
+    assert not (tmp_path / "subset" / VALIDATED_NAME).exists()
@@ -0,0 +1,60 @@
+"""Tests for ipa2kaldi.dedup"""
+import wave
+
+import numpy as np
+
+from ipa2kaldi.audio import probe_wav
+from ipa2kaldi.dedup import find_duplicates, normalize_text
+
+
+def _write_wav(wav_path, seed: int):
+    samples = np.random.RandomState(seed).randint(-1000, 1000, 1600).astype("<i2")
+    with wave.open(str(wav_path), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(16000)
+        wav_file.writeframes(samples.tobytes())
+
+
+def test_normalize_text():
+    """Case and punctuation don't matter"""
+    assert normalize_text("  Hello, World!  ") == "hello world"
+    assert normalize_text("don't") == "don't"
+
+
+def test_find_duplicates(tmp_path):
+    """Copies of the same audio are dropped and grouped with same-text items"""
+    seeds = {"a1": 1, "a2": 1, "a3": 1, "b": 2, "c": 3, "d": 4}
+    for name, seed in seeds.items():
+        _write_wav(tmp_path / f"{name}.wav", seed)
+
+    names = list(seeds) + ["missing"]
+    texts = [
+        "other text",
+        "Same text.",
+        "same text",
+        "b text",
+        "C text",
+        "c text!",
+        "",
+    ]
+    keys = [(tmp_path / f"{name}.wav", None, None) for name in names]
+    audio_infos = {path: probe_wav(path) for path, _, _ in keys[:-1]}
+
+    duplicates = find_duplicates(keys, texts, audio_infos=audio_infos)
+
+    # Missing audio has no hash
+    assert duplicates.audio_hashes[-1] is None
+    assert len(set(duplicates.audio_hashes[:3])) == 1
+    assert len(set(duplicates.audio_hashes[:-1])) == 4
+
+    # First copy with the most common transcript is kept
+    assert duplicates.clusters[:3] == [0, 0, 0]
+    assert duplicates.keep == [False, True, False, True, True, True, True]
+    assert duplicates.num_dropped == 2
+
+    # Same audio or same normalized text end up in the same split group
+    groups = duplicates.split_groups
+    assert groups[0] == groups[1] == groups[2]
+    assert groups[4] == groups[5]
+    assert len(set(groups)) == 4
@@ -0,0 +1,102 @@
+"""Tests for ipa2kaldi.stages"""
+from ipa2kaldi.stages import Intermediate, Stage, StageRunner
+
+# make -> ali -> train, where train reads the alignments made by ali
+_STAGES = [
+    Stage(
+        "make",
+        "mkdir -p feats && cp input.txt feats/ && echo x >> make.log",
+        inputs=["input.txt"],
+        outputs=["feats"],
+    ),
+    Stage(
+        "ali",
+        "mkdir -p ali && cp feats/input.txt ali/ali.1 && echo x >> ali.log",
+        outputs=["ali"],
+        after=["make"],
+    ),
+    Stage(
+        "train",
+        "cat ali/ali.1 > model && echo x >> train.log",
+        inputs=["train.conf"],
+        outputs=["model"],
+        after=["ali"],
+    ),
+]
+
+
+def _runner(recipe_dir, egs_input=False, **kwargs):
+    return StageRunner(
+        recipe_dir,
+        stages=_STAGES,
+        max_cpus=1,
+        num_jobs=1,
+        intermediates=[
+            Intermediate("ali", ["ali/ali.*"], "ali", ["train"], egs_input=egs_input)
+        ],
+        disk_interval=0,
+        **kwargs,
+    )
+
+
+def _num_runs(recipe_dir, name):
+    log_path = recipe_dir / f"{name}.log"
+    return len(log_path.read_text().splitlines()) if log_path.is_file() else 0
+
+
+def test_stale_stages(tmp_path):
+    """Only stages whose inputs changed (and their dependents) re-run"""
+    (tmp_path / "input.txt").write_text("a\n")
+    (tmp_path / "train.conf").write_text("1\n")
+
+    assert _runner(tmp_path).run()
+    assert _runner(tmp_path).stale_stages(["make", "ali", "train"]) == set()
+
+    (tmp_path / "train.conf").write_text("2\n")
+    assert _runner(tmp_path).stale_stages(["make", "ali", "train"]) == {"train"}
+
+    (tmp_path / "input.txt").write_text("b\n")
+    assert _runner(tmp_path).stale_stages(["make", "ali", "train"]) == {
+        "make",
+        "ali",
+        "train",
+    }
+
+    assert _runner(tmp_path).run()
+    assert [_num_runs(tmp_path, n) for n in ["make", "ali", "train"]] == [2, 2, 2]
+    assert (tmp_path / "model").read_text() == "b\n"
+
+
+def test_reclaim(tmp_path):
+    """Reclaimed files are re-made when a stage that reads them re-runs"""
+    (tmp_path / "input.txt").write_text("a\n")
+    (tmp_path / "train.conf").write_text("1\n")
+
+    assert _runner(tmp_path, reclaim=True, egs_cache=False).run()
+    assert not (tmp_path / "ali" / "ali.1").exists()
+
+    # Reclaimed outputs don't make the producer stale by themselves
+    assert _runner(tmp_path).stale_stages(["make", "ali", "train"]) == set()
+
+    (tmp_path / "train.conf").write_text("2\n")
+    assert _runner(tmp_path).stale_stages(["make", "ali", "train"]) == {
+        "ali",
+        "train",
+    }
+
+    assert _runner(tmp_path, reclaim=True, egs_cache=False).run()
+    assert [_num_runs(tmp_path, n) for n in ["make", "ali", "train"]] == [1, 2, 2]
+
+
+def test_reclaim_keeps_egs_inputs(tmp_path):
+    """Egs inputs aren't reclaimed with an egs cache, so retraining skips them"""
+    (tmp_path / "input.txt").write_text("a\n")
+    (tmp_path / "train.conf").write_text("1\n")
+    (tmp_path / "cmd.sh").write_text("export egsCacheDir=/tmp/egs-cache\n")
+
+    assert _runner(tmp_path, egs_input=True, reclaim=True).run()
+    assert (tmp_path / "ali" / "ali.1").is_file()
+
+    (tmp_path / "train.conf").write_text("2\n")
+    assert _runner(tmp_path, egs_input=True, reclaim=True).run()
+    assert [_num_runs(tmp_path, n) for n in ["make", "ali", "train"]] == [1, 1, 2]